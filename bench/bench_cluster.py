@@ -0,0 +1,106 @@
+'''
+Compare the "Similar" stage of cluster.nil_clustering with the naive
+pairwise implementation it replaced, on synthetic NIL mention texts with
+spelling variants. Both must map every text to the same cluster.
+
+    python bench/bench_cluster.py [<N_TEXTS>] [<SEED>]
+'''
+import os
+import sys
+import time
+import random
+import jellyfish
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from edl.fuzzy import EditDistanceIndex
+
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def make_texts(n, seed=0):
+    rng = random.Random(seed)
+    words = [''.join(rng.choice(ALPHABET) for _ in range(rng.randint(3, 9)))
+             for _ in range(max(n // 4, 10))]
+    bases = [' '.join(rng.sample(words, rng.randint(1, 3)))
+             for _ in range(max(n // 3, 1))]
+    res = []
+    seen = set()
+    while len(res) < n:
+        text = list(rng.choice(bases))
+        for _ in range(rng.choice([0, 0, 1, 1, 2, 3])):
+            i = rng.randrange(len(text))
+            op = rng.random()
+            if op < 0.4:
+                text[i] = rng.choice(ALPHABET)
+            elif op < 0.7:
+                text.insert(i, rng.choice(ALPHABET))
+            elif len(text) > 1:
+                del text[i]
+        text = ''.join(text)
+        if text not in seen:
+            seen.add(text)
+            res.append(text)
+    return res
+
+
+def similar_naive(texts):
+    '''
+    The original stage: cluster text of every text.
+    '''
+    count = 0
+    new_clusters = {}
+    res = []
+    for text in texts:
+        similar = []
+        if len(text) > 5:
+            for new_cluster_text in new_clusters:
+                distance = jellyfish.levenshtein_distance(text,
+                                                          new_cluster_text)
+                count += 1
+                if distance < len(text) // 8 + 1:
+                    similar.append((new_cluster_text, distance))
+            similar = sorted(similar, key=lambda x: x[1])
+        if similar:
+            res.append(similar[0][0])
+        else:
+            new_clusters[text] = True
+            res.append(text)
+    return res, count
+
+
+def similar_indexed(texts):
+    index = EditDistanceIndex()
+    res = []
+    for text in texts:
+        similar = None
+        if len(text) > 5:
+            similar = index.nearest(text, len(text) // 8)
+        if similar is not None:
+            res.append(similar)
+        else:
+            index.add(text)
+            res.append(text)
+    return res, index.n_distances
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3:
+        print('USAGE: [<N_TEXTS>] [<SEED>]')
+        sys.exit()
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    texts = make_texts(n, seed)
+
+    results = {}
+    for name, func in [('naive', similar_naive),
+                       ('indexed', similar_indexed)]:
+        start = time.time()
+        res, count = func(texts)
+        elapsed = time.time() - start
+        results[name] = res
+        print('%-8s %8.2fs %12d distances %8d clusters' %
+              (name, elapsed, count, len(set(res))))
+    same = results['naive'] == results['indexed']
+    print('same output: %s' % same)
+    if not same:
+        sys.exit(1)
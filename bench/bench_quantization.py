@@ -0,0 +1,140 @@
+'''
+Accuracy and footprint of the quantized embedding formats: the entity and
+word embeddings of a synthetic KB are exported as float32, float16 and
+int8, and the documents are linked with each. Context similarities and
+top-ranked entities are compared with the float32 run.
+
+    python bench/bench_quantization.py --size 10000
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+from configparser import ConfigParser
+import ujson as json
+import numpy as np
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from edl import util
+from edl import linker
+from edl.engine import Engine
+from edl.embedding import export_embedding, quantize_embedding
+from synthetic_kb import SyntheticKB, get_mongo_kb
+
+
+FORMATS = ['float32', 'float16', 'int8']
+
+
+def export(mongo_kb, workdir):
+    '''
+    {format: (entity path, word path)}, entity vectors are normalized in
+    the quantized formats.
+    '''
+    res = {}
+    for name in ['entity', 'word']:
+        export_embedding(mongo_kb.db_emb['%s_embeddings' % name],
+                         os.path.join(workdir, name))
+    res['float32'] = (os.path.join(workdir, 'entity'),
+                      os.path.join(workdir, 'word'))
+    for dtype in FORMATS[1:]:
+        paths = []
+        for name in ['entity', 'word']:
+            path = os.path.join(workdir, '%s.%s' % (name, dtype))
+            quantize_embedding(os.path.join(workdir, name), path,
+                               dtype=dtype, normalize=name == 'entity')
+            paths.append(path)
+        res[dtype] = tuple(paths)
+    return res
+
+
+def footprint(path):
+    return sum(os.path.getsize(path + ext)
+               for ext in ['.npy', '.scales.npy'] if os.path.exists(path + ext))
+
+
+def link(mongo_kb, config_path, docs):
+    '''
+    {(doc, mention): (top kbid, {kbid: context similarity})} and the
+    linking time.
+    '''
+    res = {}
+    seconds = 0.0
+    with Engine(config_path, kb=mongo_kb):
+        for i, doc in enumerate(docs):
+            ems = util.read_tac_bio_format(doc)
+            start = time.perf_counter()
+            linker.link_entitymentions(ems)
+            seconds += time.perf_counter() - start
+            for j, em in enumerate(ems):
+                cs = em.features.get('CONTEXT_SIMILARITY', ())
+                res[(i, j)] = (em.entity.kbid if em.entity else None,
+                               {ce.kbid: float(c)
+                                for ce, c in zip(em.candidates, cs)})
+    return res, seconds
+
+
+def compare(reference, res):
+    deltas = []
+    agree = 0
+    for key, (kbid, cs) in reference.items():
+        other_kbid, other_cs = res[key]
+        agree += kbid == other_kbid
+        deltas += [abs(c - other_cs[i]) for i, c in cs.items()]
+    deltas = np.array(deltas or [0.0])
+    return {
+        'top1_agreement': round(agree / len(reference), 6),
+        'cs_max_abs_delta': float(deltas.max()),
+        'cs_mean_abs_delta': float(deltas.mean()),
+    }
+
+
+def run(args, out):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='edl_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    kb = SyntheticKB(args.size, dim=args.dim, seed=args.seed)
+    mongo_kb = get_mongo_kb(kb)
+    docs = [kb.make_bio(args.sentences, docid='BENCH_DOC_%d' % i)
+            for i in range(args.docs)]
+    paths = export(mongo_kb, workdir)
+    reference = None
+    for dtype in FORMATS:
+        entity, word = paths[dtype]
+        config = ConfigParser()
+        config.read(os.path.join(ROOT, 'global.conf'))
+        for section in ['snapshot', 'warmup']:
+            config.remove_section(section)
+        config.set('embedding', 'entity', entity)
+        config.set('embedding', 'word', word)
+        config_path = os.path.join(workdir, 'bench_%s.conf' % dtype)
+        with open(config_path, 'w') as f:
+            config.write(f)
+        res, seconds = link(mongo_kb, config_path, docs)
+        if reference is None:
+            reference = res
+        record = {
+            'benchmark': 'quantization',
+            'format': dtype,
+            'size': args.size,
+            'mentions': len(res),
+            'entity_bytes': footprint(entity),
+            'word_bytes': footprint(word),
+            'throughput': round(len(res) / seconds, 3),
+        }
+        record.update(compare(reference, res))
+        out.write('%s\n' % json.dumps(record))
+        out.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantized embeddings')
+    parser.add_argument('--size', type=int, default=10000,
+                        help='KB size in mentions')
+    parser.add_argument('--docs', type=int, default=20)
+    parser.add_argument('--sentences', type=int, default=50,
+                        help='sentences per document')
+    parser.add_argument('--dim', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None)
+    args = parser.parse_args()
+    run(args, sys.stdout)
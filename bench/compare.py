@@ -0,0 +1,52 @@
+'''
+Compare two result files of bench/run.py, benchmark by benchmark.
+
+    python bench/compare.py <BASELINE> <NEW> [<THRESHOLD>]
+
+Exits with status 1 if a throughput dropped or a p99 latency grew by more
+than THRESHOLD (0.2 by default).
+'''
+import sys
+import ujson as json
+
+
+def read_results(path):
+    res = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                key = (record['benchmark'], record['backend'], record['size'])
+                res[key] = record
+    return res
+
+
+def compare(baseline, new, threshold=0.2):
+    regressions = []
+    print('%-24s %-9s %8s %12s %12s %8s %8s' %
+          ('benchmark', 'backend', 'size', 'base', 'new', 'ratio',
+           'p99'))
+    for key in sorted(set(baseline) & set(new)):
+        old_record, new_record = baseline[key], new[key]
+        ratio = new_record['throughput'] / old_record['throughput']
+        p99 = new_record['p99_ms'] / old_record['p99_ms'] \
+            if old_record['p99_ms'] else 1.0
+        flag = ''
+        if ratio < 1 - threshold or p99 > 1 + threshold:
+            flag = ' REGRESSION'
+            regressions.append(key)
+        print('%-24s %-9s %8s %12.1f %12.1f %7.2fx %7.2fx%s' %
+              (key + (old_record['throughput'], new_record['throughput'],
+                      ratio, p99, flag)))
+    return regressions
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        print('USAGE: <BASELINE> <NEW> [<THRESHOLD>]')
+        sys.exit()
+    threshold = float(sys.argv[3]) if len(sys.argv) == 4 else 0.2
+    regressions = compare(read_results(sys.argv[1]),
+                          read_results(sys.argv[2]), threshold)
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,257 @@
+'''
+Benchmark suite: builds a synthetic KB for each size, serves it from the
+SQLite backend or from mongomock, and measures the throughput and the
+latency percentiles of the main entry points. Results are written as one
+JSON object per line, compare two runs with bench/compare.py.
+
+    python bench/run.py --sizes 1000,10000 --output results.jsonl
+'''
+import os
+import sys
+import time
+import logging
+import argparse
+import subprocess
+import tempfile
+from configparser import ConfigParser
+import ujson as json
+import numpy as np
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from edl.api import api
+from edl import util
+from edl import linker
+from edl import cluster
+from edl import storage
+from edl import metrics
+from edl.engine import Engine
+from edl.models.text import EntityMention
+from synthetic_kb import SyntheticKB, get_mongo_kb
+
+
+logger = logging.getLogger()
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+                                        'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL) \
+                         .decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_config(path, kb_path=None):
+    '''
+    global.conf with the KB, snapshot and warmup of the benchmark.
+    '''
+    config = ConfigParser()
+    config.read(os.path.join(ROOT, 'global.conf'))
+    if kb_path:
+        config.set('kb', 'backend', 'sqlite')
+        config.set('kb', 'path', kb_path)
+    for section in ['snapshot', 'warmup', 'embedding']:
+        config.remove_section(section)
+    with open(path, 'w') as f:
+        config.write(f)
+
+
+def timed(func, items):
+    '''
+    Latency in seconds of func(item) for each item.
+    '''
+    res = []
+    for item in items:
+        start = time.perf_counter()
+        func(item)
+        res.append(time.perf_counter() - start)
+    return res
+
+
+def summarize(latencies, n_items=None):
+    latencies = np.array(latencies)
+    total = float(latencies.sum())
+    n_items = len(latencies) if n_items is None else n_items
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+    return {
+        'calls': len(latencies),
+        'items': n_items,
+        'seconds': round(total, 6),
+        'throughput': round(n_items / total, 3) if total else None,
+        'p50_ms': round(float(p50), 4),
+        'p90_ms': round(float(p90), 4),
+        'p99_ms': round(float(p99), 4),
+        'max_ms': round(float(latencies.max()) * 1000, 4),
+    }
+
+
+def bench_read_bio(kb, docs, args):
+    latencies = timed(util.read_tac_bio_format, docs)
+    n = sum(len(util.read_tac_bio_format(doc)) for doc in docs)
+    return summarize(latencies, n), 'mentions/s'
+
+
+def bench_process_mention(kb, docs, args):
+    rng = kb.rng
+    queries = []
+    for _ in range(args.queries):
+        i = int(rng.paretovariate(1.2)) - 1
+        queries.append((kb.mentions[i % len(kb.mentions)],
+                        rng.choice([None, 'PER', 'ORG', 'GPE'])))
+    latencies = timed(lambda q: api.process_mention(q[0], 'en', q[1]),
+                      queries)
+    return summarize(latencies), 'calls/s'
+
+
+def bench_process_mentions(kb, docs, args):
+    rng = kb.rng
+    items = []
+    for _ in range(args.queries):
+        i = int(rng.paretovariate(1.2)) - 1
+        items.append({'mention': kb.mentions[i % len(kb.mentions)],
+                      'lang': 'en',
+                      'type': rng.choice([None, 'PER', 'ORG', 'GPE'])})
+    batches = [items[i:i+args.batch_size]
+               for i in range(0, len(items), args.batch_size)]
+    latencies = timed(api.process_mentions, batches)
+    return summarize(latencies, len(items)), 'mentions/s'
+
+
+def bench_process_bio(kb, docs, args):
+    with metrics.breakdown() as timing:
+        latencies = timed(lambda doc: list(api.iter_process_bio(doc, 'en')),
+                          docs)
+    n = sum(len(util.read_tac_bio_format(doc)) for doc in docs)
+    res = summarize(latencies, n)
+    res['reuse_ratio'] = round(metrics.reuse_ratio(timing['reuse']), 4)
+    return res, 'mentions/s'
+
+
+def bench_rank(kb, docs, args):
+    ems = [em for doc in docs for em in util.read_tac_bio_format(doc)]
+    linker.add_candidate_entities_batch(ems)
+    linker.add_context_vectors(ems)
+    latencies = timed(lambda em: linker.rank_candidate_entities(
+        em, rankings=['CONTEXT_SIMILARITY']), ems)
+    return summarize(latencies), 'mentions/s'
+
+
+def bench_nil_clustering(kb, docs, args):
+    texts = kb.make_nil_mentions(args.size)
+    latencies = []
+    for _ in range(args.repeat):
+        corpus = {'BENCH_DOC': [EntityMention(text) for text in texts]}
+        latencies += timed(lambda c: cluster.nil_clustering(c, 'en'),
+                           [corpus])
+    return summarize(latencies, len(texts) * args.repeat), 'mentions/s'
+
+
+def bench_nil_clustering_parallel(kb, docs, args):
+    texts = kb.make_nil_mentions(args.size)
+    res = {}
+    for workers in [int(i) for i in args.workers.split(',')]:
+        latencies = []
+        for _ in range(args.repeat):
+            corpus = {'BENCH_DOC': [EntityMention(text) for text in texts]}
+            latencies += timed(lambda c: cluster.nil_clustering_parallel(
+                c, 'en', workers=workers), [corpus])
+        res[workers] = summarize(latencies, len(texts) * args.repeat)
+    # The summary of the largest worker count, with the throughput of each
+    summary = res[max(res)]
+    summary['workers'] = {i: res[i]['throughput'] for i in sorted(res)}
+    return summary, 'mentions/s'
+
+
+BENCHMARKS = [
+    ('read_tac_bio_format', bench_read_bio),
+    ('process_mention', bench_process_mention),
+    ('process_mentions', bench_process_mentions),
+    ('process_bio', bench_process_bio),
+    ('rank_candidate_entities', bench_rank),
+    ('nil_clustering', bench_nil_clustering),
+    ('nil_clustering_parallel', bench_nil_clustering_parallel),
+]
+
+
+def run(args, out):
+    commit = get_commit()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='edl_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    selected = set(args.benchmarks.split(',')) if args.benchmarks else None
+    for size in [int(i) for i in args.sizes.split(',')]:
+        args.size = size
+        start = time.time()
+        kb = SyntheticKB(size, dim=args.dim, seed=args.seed)
+        mongo_kb = get_mongo_kb(kb)
+        config_path = os.path.join(workdir, 'bench_%s.conf' % size)
+        if args.backend == 'sqlite':
+            kb_path = os.path.join(workdir, 'kb_%s.sqlite' % size)
+            if os.path.exists(kb_path):
+                os.remove(kb_path)
+            storage.build_sqlite_kb(mongo_kb, kb_path)
+            write_config(config_path, kb_path)
+            engine = Engine(config_path)
+        else:
+            write_config(config_path)
+            engine = Engine(config_path, kb=mongo_kb)
+        docs = [kb.make_bio(args.sentences, docid='BENCH_DOC_%d' % i)
+                for i in range(args.docs)]
+        logger.info('size %s: KB built in %.1fs' %
+                    (size, time.time() - start))
+
+        # Every benchmark starts from empty caches
+        for name, func in BENCHMARKS:
+            if selected and name not in selected:
+                continue
+            for cache in engine.caches.values():
+                cache.clear()
+            with engine:
+                res, unit = func(kb, docs, args)
+            record = {
+                'benchmark': name,
+                'backend': args.backend,
+                'size': size,
+                'commit': commit,
+                'unit': unit,
+            }
+            record.update(res)
+            out.write('%s\n' % json.dumps(record))
+            out.flush()
+            logger.info('%-24s size %-8s %10.1f %-10s p50 %.3fms '
+                        'p99 %.3fms' % (name, size, res['throughput'] or 0,
+                                        unit, res['p50_ms'], res['p99_ms']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EDL benchmark suite')
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='KB sizes in mentions, comma separated')
+    parser.add_argument('--backend', default='sqlite',
+                        choices=['sqlite', 'mongomock'])
+    parser.add_argument('--benchmarks', default=None,
+                        help='comma separated, default: all of %s' %
+                             ','.join(name for name, _ in BENCHMARKS))
+    parser.add_argument('--queries', type=int, default=1000,
+                        help='process_mention calls')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='mentions per process_mentions call')
+    parser.add_argument('--docs', type=int, default=20)
+    parser.add_argument('--sentences', type=int, default=50,
+                        help='sentences per document')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='nil_clustering runs')
+    parser.add_argument('--workers', default='1,2,4',
+                        help='nil_clustering_parallel worker counts, comma '
+                             'separated')
+    parser.add_argument('--dim', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--output', default=None,
+                        help='JSON lines file, default: stdout')
+    args = parser.parse_args()
+    if args.output:
+        with open(args.output, 'w') as out:
+            run(args, out)
+    else:
+        run(args, sys.stdout)
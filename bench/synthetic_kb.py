@@ -0,0 +1,171 @@
+'''
+Synthetic knowledge base and documents for the benchmarks: mention table,
+entity types, dictionary, word and entity embeddings and the W / b
+context projection, written to MongoDB collections (a MongoClient or a
+mongomock.MongoClient) and optionally compiled into a SQLite KB.
+
+    python bench/synthetic_kb.py <N_MENTIONS> <OUTPUT SQLITE PATH>
+'''
+import os
+import sys
+import random
+import _pickle as cPickle
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from edl import storage
+
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ru', 'sen', 'ta', 'vo', 'ne', 'shi', 'dar',
+             'bel', 'qu', 'an', 'tor', 'is', 'gu', 'ri', 'fa', 'zen', 'po']
+ETYPES = ['PER', 'ORG', 'GPE', 'LOC']
+
+
+class SyntheticKB(object):
+    '''
+    Random KB of n_mentions mentions, as many entities, and the
+    vocabulary used to generate documents with the same mentions.
+    '''
+
+    def __init__(self, n_mentions, dim=100, seed=0):
+        self.rng = random.Random(seed)
+        self.nrng = np.random.RandomState(seed)
+        self.dim = dim
+        self.kbids = ['Entity_%d' % i for i in range(n_mentions)]
+        self.words = self.make_names(max(n_mentions // 2, 1000), 1, 1)
+        self.mentions = self.make_names(n_mentions, 1, 3)
+
+    def make_name(self, n_min, n_max):
+        tokens = []
+        for _ in range(self.rng.randint(n_min, n_max)):
+            n = self.rng.randint(2, 4)
+            tokens.append(''.join(self.rng.choice(SYLLABLES)
+                                  for _ in range(n)))
+        return ' '.join(tokens)
+
+    def make_names(self, n, n_min, n_max):
+        res = {}
+        while len(res) < n:
+            res[self.make_name(n_min, n_max)] = True
+        return list(res)
+
+    def vector(self):
+        return cPickle.dumps(self.nrng.randn(self.dim).astype(np.float32))
+
+    def populate(self, client, kb='kb', dict='dict', emb='emb_ntee',
+                 batch_size=10000):
+        '''
+        Write the KB to the kb, dict and emb databases of client.
+        '''
+        def insert(collection, docs):
+            batch = []
+            for doc in docs:
+                batch.append(doc)
+                if len(batch) == batch_size:
+                    collection.insert_many(batch)
+                    batch = []
+            if batch:
+                collection.insert_many(batch)
+
+        rng = self.rng
+        db_kb, db_dict, db_emb = client[kb], client[dict], client[emb]
+
+        def entities():
+            scores = sorted((rng.random() for _ in range(rng.randint(1, 15))),
+                            reverse=True)
+            tol = sum(scores)
+            return [[rng.choice(self.kbids), score / tol] for score in scores]
+
+        insert(db_kb['mention_table'],
+               ({'mention': m, 'entities': entities()}
+                for m in self.mentions))
+        db_kb['mention_table'].create_index('mention')
+        # A few entities have no type or no embedding, as in the real KB
+        insert(db_kb['etypes'],
+               ({'kbid': kbid, 'etype': rng.choice(ETYPES)}
+                for kbid in self.kbids if rng.random() < 0.95))
+        db_kb['etypes'].create_index('kbid')
+        insert(db_emb['entity_embeddings'],
+               ({'item': 'en.wikipedia.org/wiki/%s' % kbid,
+                 'vector': self.vector()}
+                for kbid in self.kbids if rng.random() < 0.9))
+        insert(db_emb['word_embeddings'],
+               ({'item': word, 'vector': self.vector()}
+                for word in self.words))
+        for collection in ['entity_embeddings', 'word_embeddings']:
+            db_emb[collection].create_index('item')
+        W = self.nrng.randn(self.dim, self.dim).astype(np.float32)
+        b = self.nrng.randn(self.dim).astype(np.float32)
+        db_emb['misc'].insert_many([
+            {'item': 'W', 'vector': cPickle.dumps(W)},
+            {'item': 'b', 'vector': cPickle.dumps(b)},
+        ])
+        insert(db_dict['zh'],
+               ({'lemma': 'zh_%d' % i, 'gloss': m,
+                 'priority': rng.randint(1, 5)}
+                for i, m in enumerate(self.mentions)))
+        db_dict['zh'].create_index('lemma')
+
+    def make_bio(self, n_sentences, docid='BENCH_DOC', p_mention=0.15):
+        '''
+        A BIO document whose mentions are drawn from the KB, with a
+        few unknown ones.
+        '''
+        rng = self.rng
+        lines = []
+        offset = 0
+        for _ in range(n_sentences):
+            for _ in range(rng.randint(8, 25)):
+                if rng.random() < p_mention:
+                    if rng.random() < 0.9:
+                        # Frequent mentions first, as in real corpora
+                        i = int(rng.paretovariate(1.2)) - 1
+                        mention = self.mentions[i % len(self.mentions)]
+                    else:
+                        mention = self.make_name(1, 2)
+                    etype = rng.choice(ETYPES)
+                    tags = ['B-' + etype] + \
+                           ['I-' + etype] * mention.count(' ')
+                    tokens = mention.split(' ')
+                else:
+                    tags = ['O']
+                    tokens = [rng.choice(self.words)]
+                for token, tag in zip(tokens, tags):
+                    lines.append('%s %s:%d-%d %s' %
+                                 (token, docid, offset,
+                                  offset + len(token) - 1, tag))
+                    offset += len(token) + 1
+            lines.append('')
+        return '\n'.join(lines)
+
+    def make_nil_mentions(self, n):
+        '''
+        Mention texts with spelling variants, for NIL clustering.
+        '''
+        rng = self.rng
+        res = []
+        for _ in range(n):
+            text = list(rng.choice(self.mentions))
+            for _ in range(rng.choice([0, 0, 0, 1, 2])):
+                i = rng.randrange(len(text))
+                text[i] = rng.choice('aeioukmnrst')
+            res.append(''.join(text).title())
+        return res
+
+
+def get_mongo_kb(synthetic_kb):
+    '''
+    The synthetic KB in a mongomock stand-in for MongoDB.
+    '''
+    import mongomock
+    client = mongomock.MongoClient()
+    synthetic_kb.populate(client)
+    return storage.MongoKB(None, None, client=client)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('USAGE: <N_MENTIONS> <OUTPUT SQLITE PATH>')
+        sys.exit()
+    mongo_kb = get_mongo_kb(SyntheticKB(int(sys.argv[1])))
+    storage.build_sqlite_kb(mongo_kb, sys.argv[2])
+    print('KB compiled to %s' % sys.argv[2])
@@ -0,0 +1,196 @@
+'''
+Asyncio (ASGI) serving mode with the routes of web.py, run with
+`python aio.py <PORT> [<WORKERS>]` or any ASGI server (hypercorn aio:app).
+Blocking KB work runs on a bounded thread pool, and concurrent requests
+for the same (mention, lang, type) share one in-flight computation.
+Requests with timing=1 get a Server-Timing header as in web.py, and are
+computed on their own so that the timing is theirs.
+'''
+import io
+import sys
+import atexit
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from quart import Quart, Response, request, jsonify
+import api
+from edl import metrics
+from edl.engine import get_engine
+
+
+app = Quart(__name__)
+executor = ThreadPoolExecutor(max_workers=16)
+inflight = {}
+
+
+async def run_blocking(func, *args):
+    loop = asyncio.get_running_loop()
+    # Keep the engine of the current context in the worker thread
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(executor, ctx.run, func, *args)
+
+
+async def single_flight(key, func, *args):
+    '''
+    Run func(*args) once for all concurrent callers with the same key.
+    '''
+    future = inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(run_blocking(func, *args))
+        inflight[key] = future
+        future.add_done_callback(lambda _: inflight.pop(key, None))
+    # A cancelled request must not cancel the others waiting on it
+    return await asyncio.shield(future)
+
+
+async def iterate_blocking(iterator):
+    '''
+    Yield the items of a blocking iterator, each one computed on the
+    thread pool.
+    '''
+    done = object()
+    while True:
+        item = await run_blocking(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+async def with_timing(func):
+    '''
+    Response of await func(), with the time spent in each stage in a
+    Server-Timing header when the request has timing=1.
+    '''
+    if request.args.get('timing') != '1':
+        return await func()
+    with metrics.breakdown() as timing:
+        res = await func()
+    response = await app.make_response(res)
+    response.headers['Server-Timing'] = metrics.server_timing(timing)
+    return response
+
+
+def error_message():
+    exc_type, exc_obj, exc_tb = sys.exc_info()
+    return 'unexpected error: %s %s %s' % \
+           (exc_type, exc_obj, exc_tb.tb_lineno)
+
+
+@app.route('/linking', methods=["GET"])
+async def linking():
+    args = request.args
+    for i in ['mention', 'lang']:
+        try:
+            assert i in args
+        except AssertionError:
+            return 'ERROR: Missing argument: %s' % i
+
+    mention = args.get('mention')
+    lang = args.get('lang')
+    etype = args.get('type') if 'type' in args else None
+    key = ('linking', mention, lang, etype)
+
+    async def link():
+        if request.args.get('timing') == '1':
+            res = await run_blocking(api.process_mention, mention, lang,
+                                     etype)
+        else:
+            res = await single_flight(key, api.process_mention, mention,
+                                      lang, etype)
+        return jsonify(res)
+    return await with_timing(link)
+
+
+@app.route('/linking_batch', methods=["POST"])
+async def linking_batch():
+    items = await request.get_json(silent=True)
+    error = api.check_mentions(items)
+    if error:
+        return error
+
+    async def link():
+        return jsonify(await run_blocking(api.process_mentions, items))
+    try:
+        return await with_timing(link)
+    except Exception:
+        return error_message()
+
+
+@app.route('/linking_bio', methods=["POST"])
+async def linking_bio():
+    '''
+    BIO data is read from the bio_str form field, or from a raw request
+    body with lang in the query string. TAB lines are sent back in chunks
+    as they are linked, or at once with timing=1. Unlike web.py, a raw
+    body is read whole before linking starts.
+    '''
+    form = await request.form
+    if 'bio_str' in form:
+        bio = form.get('bio_str')
+        lang = form.get('lang')
+    else:
+        bio = io.StringIO(await request.get_data(as_text=True))
+        lang = request.args.get('lang')
+    for i, value in [('bio_str', bio), ('lang', lang)]:
+        try:
+            assert value is not None
+        except AssertionError:
+            return 'ERROR: Missing argument: %s' % i
+
+    async def generate():
+        try:
+            lines = iterate_blocking(api.iter_process_bio(bio, lang))
+            n = 0
+            async for line in lines:
+                yield '\n' + line if n else line
+                n += 1
+        except Exception:
+            yield error_message()
+    if request.args.get('timing') == '1':
+        async def link():
+            return Response(''.join([i async for i in generate()]),
+                            mimetype='text/plain')
+        return await with_timing(link)
+    return Response(generate(), mimetype='text/plain')
+
+
+@app.route('/linking_amr', methods=["POST"])
+async def linking_amr():
+    form = await request.form
+    for i in ['amr_str']:
+        try:
+            assert i in form
+        except AssertionError:
+            return 'ERROR: Missing argument: %s' % i
+
+    amr_str = form.get('amr_str')
+    try:
+        res = await run_blocking(api.process_amr, amr_str)
+    except Exception:
+        return error_message()
+    return jsonify(res)
+
+
+@app.route('/cache_stats', methods=["GET"])
+async def cache_stats():
+    return jsonify(get_engine().cache_stats())
+
+
+@app.route('/metrics', methods=["GET"])
+async def prometheus_metrics():
+    return Response(metrics.render(get_engine().cache_stats()),
+                    mimetype='text/plain; version=0.0.4')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print('USAGE: <PORT> [<WORKERS>]')
+        sys.exit()
+    if len(sys.argv) == 3:
+        executor = ThreadPoolExecutor(max_workers=int(sys.argv[2]))
+    engine = get_engine()
+    engine.load_snapshot()
+    engine.warmup()
+    engine.start_snapshot_timer()
+    atexit.register(engine.dump_snapshot)
+    app.run('0.0.0.0', port=int(sys.argv[1]))
@@ -7,56 +7,147 @@ from edl import linker
 from edl import cluster
 from edl import translator
 from edl import util
+from edl import metrics
 from edl.models.text import EntityMention, NominalMention, Entity
 sys.path.append('/nas/data/m1/panx2/code/amr-reader/amrreader')
-from src import reader
-from src import ne
+try:
+    from src import reader
+    from src import ne
+except ImportError:
+    # Only needed by process_amr
+    reader = ne = None
 
 
 def process_mention(mention, lang='en', etype=None):
-    em = EntityMention(mention)
-    if lang != 'en':
-        em.translations = translator.get_translation(em.text, lang)
-    linker.add_candidate_entities(em, lang=lang)
-    linker.rank_candidate_entities(em, etype=etype)
-
-    lres = []
-    for ce in em.candidates:
-        lres.append(
-            {
-                'kbid': ce.kbid,
-                'confidence': ce.confidence,
-            }
-        )
-    res = {
-        'mention': em.text,
-        'type': etype,
-        'language': lang,
-        'translation': em.translations,
-        'results': lres,
-    }
-    return res
+    item = {'mention': mention, 'lang': lang, 'type': etype}
+    return process_mentions([item])[0]
 
 
-def process_bio(bio, lang='en'):
-    entitymentions = util.read_tac_bio_format(bio)
-    for em in entitymentions:
+def check_mentions(items):
+    '''
+    Error message for a /linking_batch body that is not a list of
+    {mention, lang, type, context} objects with string fields, None if
+    it is valid.
+    '''
+    if not isinstance(items, list):
+        return 'ERROR: Expecting a JSON array of ' \
+               '{mention, lang, type, context} objects'
+    for n, item in enumerate(items):
+        if not isinstance(item, dict):
+            return 'ERROR: Expecting an object (item %s)' % n
+        for i in ['mention', 'lang']:
+            if i not in item:
+                return 'ERROR: Missing argument: %s (item %s)' % (i, n)
+        for i in ['mention', 'lang', 'type', 'context']:
+            value = item.get(i)
+            # type and context are optional
+            if value is None and i in ['type', 'context']:
+                continue
+            if not isinstance(value, str):
+                return 'ERROR: Invalid argument: %s must be a string ' \
+                       '(item %s)' % (i, n)
+    return None
+
+
+def process_mentions(items):
+    '''
+    Link a batch of {mention, lang, type, context} items, type and context
+    are optional. Identical items are linked once, translations and
+    candidates are retrieved in bulk per language. Results are returned in
+    the order of items.
+    '''
+    keys = [(i['mention'], i['lang'], i.get('type'), i.get('context'))
+            for i in items]
+    ems = {}
+    for key in keys:
+        if key in ems:
+            continue
+        mention, lang, etype, context = key
+        em = EntityMention(mention)
+        if context:
+            em.text_tok = mention.split()
+            em.context = context.split()
+        ems[key] = em
+
+    by_lang = defaultdict(list)
+    for key, em in ems.items():
+        by_lang[key[1]].append(em)
+    for lang, lang_ems in by_lang.items():
         if lang != 'en':
-            em.translations = translator.get_translation(em.text, lang)
+            translations = translator.get_translations(
+                [em.text for em in lang_ems], lang)
+            for em in lang_ems:
+                em.translations = translations[em.text]
+        linker.add_candidate_entities_batch(lang_ems, lang=lang)
+
+    # Context similarity only for English mentions sent with a context
+    by_rankings = defaultdict(list)
+    for key, em in ems.items():
+        _, lang, _, context = key
+        rankings = ('CONTEXT_SIMILARITY',) if context and lang == 'en' else ()
+        by_rankings[rankings].append(key)
+    for rankings, group in by_rankings.items():
+        linker.rank_candidate_entities_batch([ems[k] for k in group],
+                                             etypes=[k[2] for k in group],
+                                             rankings=list(rankings))
+
+    res = {}
+    for key, em in ems.items():
+        _, lang, etype, _ = key
+        lres = []
+        for ce, confidence in zip(em.candidates, em.confidences):
+            lres.append(
+                {
+                    'kbid': ce.kbid,
+                    'confidence': confidence.item(),
+                }
+            )
+        res[key] = {
+            'mention': em.text,
+            'type': etype,
+            'language': lang,
+            'translation': em.translations,
+            'results': lres,
+        }
+    return [res[key] for key in keys]
 
-        rankings = []
-        if lang == 'en':
-            rankings = ['CONTEXT_SIMILARITY']
-        linker.add_candidate_entities(em, lang=lang)
-        linker.rank_candidate_entities(em, etype=em.etype, rankings=rankings)
 
-    tab = util.get_tac_tab_format(entitymentions, add_trans=True)
-    util.add_tac_runid_and_mid(tab, runid='elisa-ie', mid_prefix='elisa-ie')
-    res = '\n'.join(['\t'.join(i) for i in tab])
+def process_bio(bio, lang='en'):
+    res = '\n'.join(iter_process_bio(bio, lang=lang))
     return res
 
 
+def iter_process_bio(bio, lang='en', batch_size=200):
+    '''
+    Yield the TAB lines of BIO data (a string or an iterable of lines) as
+    they are linked, in micro-batches of about batch_size mentions.
+    '''
+    count = 0
+    batch = []
+    for em in util.iter_tac_bio_format(bio):
+        batch.append(em)
+        if len(batch) >= batch_size:
+            tab, count = link_bio_batch(batch, lang, count)
+            yield from tab
+            batch = []
+    if batch:
+        tab, count = link_bio_batch(batch, lang, count)
+        yield from tab
+
+
+def link_bio_batch(entitymentions, lang, count):
+    linker.link_entitymentions(entitymentions, lang=lang)
+    with metrics.timer('tab_format'):
+        tab = util.get_tac_tab_format(entitymentions, add_trans=True)
+        count = util.add_tac_runid_and_mid(tab, runid='elisa-ie',
+                                           mid_prefix='elisa-ie',
+                                           start=count)
+        return ['\t'.join(i) for i in tab], count
+
+
 def process_amr(raw_amr):
+    if reader is None:
+        raise ImportError('process_amr needs the AMR reader (src)')
     sents = reader.main(raw_amr)
     ne.add_named_entity(sents)
     sent = sents[0]
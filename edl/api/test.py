@@ -13,6 +13,18 @@ if __name__ == '__main__':
         print(r.status_code)
         print(r.text)
 
+    url = 'http://blender02.cs.rpi.edu:3301/linking_batch'
+    payload = [
+        {'mention': 'rpi', 'lang': 'en'},
+        {'mention': 'Apple', 'lang': 'en', 'type': 'ORG',
+         'context': 'Apple is a computer company'},
+        {'mention': '中国', 'lang': 'zh'},
+        {'mention': 'rpi', 'lang': 'en'},
+    ]
+    r = requests.post(url, json=payload)
+    print(r.status_code)
+    print(r.text)
+
     url = 'http://blender02.cs.rpi.edu:3301/linking_bio'
     pdata = 'tmp/CMN_DF_000020_20140219_G00A0BX20.bio'
     data = open(pdata).read()
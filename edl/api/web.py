@@ -1,12 +1,30 @@
+import io
 import sys
-from flask import Flask, request, jsonify
-import ujson as json
+import atexit
+from flask import Flask, Response, request, jsonify, \
+                  stream_with_context
 import api
+from edl import metrics
+from edl.engine import get_engine
 
 
 app = Flask(__name__)
 
 
+def with_timing(func):
+    '''
+    Response of func(), with the time spent in each stage in a
+    Server-Timing header when the request has timing=1.
+    '''
+    if request.args.get('timing') != '1':
+        return func()
+    with metrics.breakdown() as timing:
+        res = func()
+    response = app.make_response(res)
+    response.headers['Server-Timing'] = metrics.server_timing(timing)
+    return response
+
+
 @app.route('/linking', methods=["GET"])
 def linking():
     args = request.args
@@ -19,29 +37,59 @@ def linking():
     mention = request.args.get('mention')
     lang = request.args.get('lang')
     etype = request.args.get('type') if 'type' in request.args else None
-    res = api.process_mention(mention, lang, etype=etype)
-    return jsonify(res)
+    return with_timing(lambda: jsonify(api.process_mention(mention, lang,
+                                                           etype=etype)))
 
 
-@app.route('/linking_bio', methods=["POST"])
-def linking_bio():
-    form = request.form
-    for i in ['bio_str', 'lang']:
-        try:
-            assert i in form
-        except AssertionError:
-            return 'ERROR: Missing argument: %s' % i
+@app.route('/linking_batch', methods=["POST"])
+def linking_batch():
+    items = request.get_json(silent=True)
+    error = api.check_mentions(items)
+    if error:
+        return error
 
-    bio_str = request.form.get('bio_str')
-    lang = request.form.get('lang')
     try:
-        res = api.process_bio(bio_str, lang)
+        return with_timing(lambda: jsonify(api.process_mentions(items)))
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         msg = 'unexpected error: %s %s %s' % \
               (exc_type, exc_obj, exc_tb.tb_lineno)
         return msg
-    return res
+
+
+@app.route('/linking_bio', methods=["POST"])
+def linking_bio():
+    '''
+    BIO data is read from the bio_str form field, or streamed from a raw
+    request body with lang in the query string. TAB lines are sent back
+    in chunks as they are linked, or at once with timing=1.
+    '''
+    form = request.form
+    if 'bio_str' in form:
+        bio = form.get('bio_str')
+        lang = form.get('lang')
+    else:
+        bio = io.TextIOWrapper(request.stream, encoding='utf-8')
+        lang = request.args.get('lang')
+    for i, value in [('bio_str', bio), ('lang', lang)]:
+        try:
+            assert value is not None
+        except AssertionError:
+            return 'ERROR: Missing argument: %s' % i
+
+    def generate():
+        try:
+            for n, line in enumerate(api.iter_process_bio(bio, lang)):
+                yield '\n' + line if n else line
+        except Exception as e:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            msg = 'unexpected error: %s %s %s' % \
+                  (exc_type, exc_obj, exc_tb.tb_lineno)
+            yield msg
+    if request.args.get('timing') == '1':
+        return with_timing(lambda: Response(''.join(generate()),
+                                            mimetype='text/plain'))
+    return Response(stream_with_context(generate()), mimetype='text/plain')
 
 
 @app.route('/linking_amr', methods=["POST"])
@@ -64,8 +112,24 @@ def linking_amr():
     return jsonify(res)
 
 
+@app.route('/cache_stats', methods=["GET"])
+def cache_stats():
+    return jsonify(get_engine().cache_stats())
+
+
+@app.route('/metrics', methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(get_engine().cache_stats()),
+                    mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     if len(sys.argv) != 2:
         print('USAGE: <PORT>')
         sys.exit()
+    engine = get_engine()
+    engine.load_snapshot()
+    engine.warmup()
+    engine.start_snapshot_timer()
+    atexit.register(engine.dump_snapshot)
     app.run('0.0.0.0', port=int(sys.argv[1]), threaded=True)
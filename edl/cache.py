@@ -0,0 +1,191 @@
+import re
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+import numpy as np
+
+
+_MISSING = object()
+_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+
+def approx_size(obj):
+    '''
+    Approximate number of bytes held by a cached value.
+    '''
+    if obj is None:
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (str, bytes, int, float)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(approx_size(i) for i in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(approx_size(k) + approx_size(v)
+                                        for k, v in obj.items())
+    if hasattr(obj, '__dict__'):
+        return approx_size(vars(obj))
+    if hasattr(obj, '__slots__'):
+        return sys.getsizeof(obj) + sum(approx_size(getattr(obj, i, None))
+                                        for i in obj.__slots__)
+    return sys.getsizeof(obj)
+
+
+def parse_limit(limit):
+    '''
+    '100000' is an entry count, '512MB' (B, KB, MB, GB) approximate bytes.
+    Returns (maxsize, maxbytes).
+    '''
+    m = re.match(r'^\s*(\d+)\s*([KMG]?B)?\s*$', limit.upper())
+    if not m:
+        raise ValueError('Invalid cache limit: %s' % limit)
+    if m.group(2):
+        return None, int(m.group(1)) * _UNITS[m.group(2)]
+    return int(m.group(1)), None
+
+
+class Cache(object):
+    '''
+    Thread-safe bounded cache with LRU or LFU eviction.
+    '''
+
+    def __init__(self, name, maxsize=None, maxbytes=None, policy='lru'):
+        assert policy in ('lru', 'lfu')
+        self.name = name
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.sizes = {}
+        # LFU: key -> frequency, frequency -> keys in insertion order
+        self.freq = {}
+        self.freq_keys = defaultdict(OrderedDict)
+        self.min_freq = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.data)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._touch(key)
+            return value
+
+    def put(self, key, value, frequency=1):
+        '''
+        Add or replace an entry, a new entry of an LFU cache starts at
+        frequency, e.g. when reloaded from a snapshot.
+        '''
+        size = approx_size(value) if self.maxbytes else 0
+        with self.lock:
+            if key in self.data:
+                self.bytes += size - self.sizes[key]
+                self.data[key] = value
+                self.sizes[key] = size
+                self._touch(key)
+                while len(self.data) > 1 and self._full(0, 0):
+                    self._evict()
+                return
+            while self.data and self._full(1, size):
+                self._evict()
+            if self.policy == 'lfu':
+                if not self.data or frequency < self.min_freq:
+                    self.min_freq = frequency
+                self.freq[key] = frequency
+                self.freq_keys[frequency][key] = None
+            self.data[key] = value
+            self.sizes[key] = size
+            self.bytes += size
+
+    def items(self, frequencies=False):
+        '''
+        (key, value) pairs from the next to be evicted to the last, or
+        (key, value, frequency) triples with frequencies, the frequency is
+        None under LRU.
+        '''
+        with self.lock:
+            if self.policy == 'lru':
+                if frequencies:
+                    return [(k, v, None) for k, v in self.data.items()]
+                return list(self.data.items())
+            return [(key, self.data[key], f) if frequencies
+                    else (key, self.data[key])
+                    for f in sorted(self.freq_keys)
+                    for key in self.freq_keys[f]]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.freq.clear()
+            self.freq_keys.clear()
+            self.min_freq = 0
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'policy': self.policy,
+                'size': len(self.data),
+                'bytes': self.bytes,
+                'maxsize': self.maxsize,
+                'maxbytes': self.maxbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _full(self, count, size):
+        '''
+        Whether adding count entries of size bytes exceeds the limits.
+        '''
+        if self.maxsize is not None and \
+           len(self.data) + count > self.maxsize:
+            return True
+        if self.maxbytes is not None and self.bytes + size > self.maxbytes:
+            return True
+        return False
+
+    def _touch(self, key):
+        if self.policy == 'lru':
+            self.data.move_to_end(key)
+            return
+        f = self.freq[key]
+        del self.freq_keys[f][key]
+        if not self.freq_keys[f]:
+            del self.freq_keys[f]
+            if self.min_freq == f:
+                self.min_freq = f + 1
+        self.freq[key] = f + 1
+        self.freq_keys[f + 1][key] = None
+
+    def _evict(self):
+        if self.policy == 'lru':
+            key, _ = self.data.popitem(last=False)
+        else:
+            keys = self.freq_keys[self.min_freq]
+            key, _ = keys.popitem(last=False)
+            if not keys:
+                del self.freq_keys[self.min_freq]
+                self.min_freq = min(self.freq_keys) if self.freq_keys else 0
+            del self.freq[key]
+            del self.data[key]
+        self.bytes -= self.sizes.pop(key)
+        self.evictions += 1
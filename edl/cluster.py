@@ -1,11 +1,11 @@
+import os
 import re
 from collections import defaultdict
-import jellyfish._jellyfish as jf
-import jellyfish
-import unidecode
+from multiprocessing import Pool
 import logging
 import ujson as json
 from edl.models.text import EntityMention, NominalMention, Entity
+from edl.fuzzy import EditDistanceIndex
 
 
 logger = logging.getLogger()
@@ -28,9 +28,10 @@ class Cluster:
         self.results.extend(cluster.results)
 
 
-def nil_clustering(corpus, lang, resources=None,
-                   propagate=False, verbose=False):
-    # Load resources
+def load_resources(resources):
+    '''
+    Designators, stop words and stems used to normalize mentions.
+    '''
     designators = set()
     stop_words = set()
     morph = {}
@@ -54,6 +55,50 @@ def nil_clustering(corpus, lang, resources=None,
                         designators.add(morph[designator])
         if 'stop_word' in resources:
             stop_words = json.load(open(resources['stop_word']))
+    return designators, stop_words, morph
+
+
+def normalize_text(text, designators, stop_words, morph):
+    '''
+    Remove designators and stop words, stemming.
+    '''
+    tokens = []
+    for token in text.split(' '):
+        if token in stop_words or token in designators:
+            continue
+        if token in morph:
+            token = morph[token]
+        if token in stop_words or token in designators:
+            continue
+        tokens.append(token)
+    return ' '.join(tokens) if tokens else text
+
+
+def trim_text(text):
+    text_trim = re.sub(r'[ʼ’‘´′]', '\'', text) # normalize
+    text_trim = re.sub(r'(.)\1+', r'\1', text_trim) # shorten double letters
+    if len(text_trim) < 4:
+        text_trim = text
+    return text_trim
+
+
+def get_group_index(groups):
+    '''
+    Inverted index of groups: mention -> numbers of the groups containing
+    it, in order.
+    '''
+    res = defaultdict(list)
+    for n, group in enumerate(groups):
+        for mention in group:
+            numbers = res[mention]
+            if not numbers or numbers[-1] != n:
+                numbers.append(n)
+    return res
+
+
+def nil_clustering(corpus, lang, resources=None,
+                   propagate=False, verbose=False):
+    designators, stop_words, morph = load_resources(resources)
 
     # Create initial clusters
     result_cluster_map = {}
@@ -77,16 +122,7 @@ def nil_clustering(corpus, lang, resources=None,
     new_clusters = {}
     cluster_map = []
     for _, cluster in clusters.items():
-        tokens = []
-        for token in cluster.text.split(' '):
-            if token in stop_words or token in designators:
-                continue
-            if token in morph:
-                token = morph[token]
-            if token in stop_words or token in designators:
-                continue
-            tokens.append(token)
-        text = ' '.join(tokens) if tokens else cluster.text
+        text = normalize_text(cluster.text, designators, stop_words, morph)
         if text not in new_clusters:
             new_cluster = Cluster('NIL{:07d}'.format(len(new_clusters)), text)
             new_clusters[text] = new_cluster
@@ -102,11 +138,7 @@ def nil_clustering(corpus, lang, resources=None,
     new_clusters = {}
     cluster_map = []
     for _, cluster in clusters.items():
-        text = cluster.text
-        text_trim = re.sub(r'[ʼ’‘´′]', '\'', text) # normalize
-        text_trim = re.sub(r'(.)\1+', r'\1', text_trim) # shorten double letters
-        if len(text_trim) < 4:
-            text_trim = text
+        text_trim = trim_text(cluster.text)
         if text_trim not in new_clusters:
             new_cluster = Cluster('NIL{:07d}'.format(len(new_clusters)),
                                   text_trim)
@@ -120,23 +152,22 @@ def nil_clustering(corpus, lang, resources=None,
     logger.info('  # clusters: {} (NYSIIS)'.format(len(clusters)))
 
     # 3. Similar
+    # The closest earlier cluster within a distance of len(text) // 8 is
+    # looked up in an index instead of comparing with every cluster
     new_clusters = {}
     cluster_map = []
+    index = EditDistanceIndex()
     for _, cluster in clusters.items():
         text = cluster.text
-        similar = []
+        similar = None
         if len(text) > 5:
-            for new_cluster_text, new_cluster in new_clusters.items():
-                distance = jellyfish.levenshtein_distance(text,
-                                                          new_cluster_text)
-                if distance < len(text) // 8 + 1:
-                    similar.append((new_cluster_text, distance))
-            similar = sorted(similar, key=lambda x : x[1])
-        if similar:
-            cluster_map.append((cluster, new_clusters[similar[0][0]]))
+            similar = index.nearest(text, len(text) // 8)
+        if similar is not None:
+            cluster_map.append((cluster, new_clusters[similar]))
         else:
             new_cluster = Cluster('NIL{:07d}'.format(len(new_clusters)), text)
             new_clusters[text] = new_cluster
+            index.add(text)
             cluster_map.append((cluster, new_clusters[text]))
     for old_cluster, new_cluster in cluster_map:
         new_cluster.merge(old_cluster)
@@ -152,11 +183,13 @@ def nil_clustering(corpus, lang, resources=None,
     cluster_map = []
     translation_map = {}
     for _, cluster in clusters.items():
-        translation_set = set()
+        # Translations in order of appearance, so the cluster a translation
+        # is merged into does not depend on set ordering
+        translation_set = {}
         for result in cluster.results:
             for translation in result.translations:
                 if translation:
-                    translation_set.add(translation.lower())
+                    translation_set[translation.lower()] = True
         if len(translation_set) > 0:
             new_cluster = None
             for translation in translation_set:
@@ -184,19 +217,17 @@ def nil_clustering(corpus, lang, resources=None,
     # 6. Group
     new_clusters = {}
     if resources and 'group' in resources:
+        group_index = get_group_index(resources['group'])
+
         # clean group
         all_mentions = set()
         for _, cluster in clusters.items():
             for result in cluster.results:
                 all_mentions.add(result.text)
-        groups = []
-        for group in resources['group']:
-            found = False
-            for mention in group:
-                if mention in all_mentions:
-                    found = True
-            if found:
-                groups.append(group)
+        found = set()
+        for mention in all_mentions:
+            found.update(group_index.get(mention, ()))
+        groups = [resources['group'][n] for n in sorted(found)]
         for group in groups:
             new_cluster = Cluster('NIL{:07d}'.format(len(new_clusters)),
                                   group[0])
@@ -204,11 +235,11 @@ def nil_clustering(corpus, lang, resources=None,
         for _, cluster in clusters.items():
             text = cluster.text
             group_text = None
+            # The first group of the last result found in a group
             for result in cluster.results:
-                for group in res['group']:
-                    if result.text in group:
-                        group_text = group[0]
-                        break
+                if result.text in group_index:
+                    n = group_index[result.text][0]
+                    group_text = resources['group'][n][0]
             if group_text and group_text in new_clusters:
                 new_clusters[group_text].merge(cluster)
             elif text in new_clusters:
@@ -231,7 +262,16 @@ def nil_clustering(corpus, lang, resources=None,
             if result.text not in mention_cluster:
                 mention_cluster[result.text] = cluster.name
 
-    # Assign NIL id
+    assign_nilids(corpus, mention_cluster)
+    if propagate:
+        propagate_clusters(corpus, mention_cluster, verbose=verbose)
+
+
+def assign_nilids(corpus, mention_cluster):
+    '''
+    Give the unlinked entity mentions of corpus the NIL id of their
+    cluster, mention_cluster maps mention texts to NIL ids.
+    '''
     nil_table = {}
     count = {
         'nilmention': 0,
@@ -254,42 +294,45 @@ def nil_clustering(corpus, lang, resources=None,
     logger.info('  # of NIL IDs: %s' % (count['nilid']))
     logger.info('  # of NIL mentions: %s' % (count['nilmention']))
 
-    # Propagate kbid in the same cluster
-    if propagate:
-        logger.info('APPLYING CLUSTER PROPAGATION...')
-        clusters = defaultdict(list)
-        for docid in corpus:
-            for em in corpus[docid]:
-                cluster_id = mention_cluster[em.text]
-                clusters[cluster_id].append(em)
-        history = defaultdict(int)
-        for clu in clusters:
-            kbids = defaultdict(list)
-            for em in clusters[clu]:
-                kbids[em.entity.kbid].append(em)
-            if len(kbids) > 1:
-                kbid_clu = sorted(kbids,
-                                  key=lambda x: len(kbids[x]), reverse=True)[0]
-                if kbid_clu.startswith('NIL'):
+
+def propagate_clusters(corpus, mention_cluster, verbose=False):
+    '''
+    Give the NIL mentions of a cluster its most frequent kbid.
+    '''
+    logger.info('APPLYING CLUSTER PROPAGATION...')
+    clusters = defaultdict(list)
+    for docid in corpus:
+        for em in corpus[docid]:
+            cluster_id = mention_cluster[em.text]
+            clusters[cluster_id].append(em)
+    history = defaultdict(int)
+    for clu in clusters:
+        kbids = defaultdict(list)
+        for em in clusters[clu]:
+            kbids[em.entity.kbid].append(em)
+        if len(kbids) > 1:
+            kbid_clu = sorted(kbids,
+                              key=lambda x: len(kbids[x]), reverse=True)[0]
+            if kbid_clu.startswith('NIL'):
+                continue
+            for kbid in kbids:
+                if kbid == kbid_clu:
                     continue
-                for kbid in kbids:
-                    if kbid == kbid_clu:
-                        continue
-                    if len(kbids[kbid_clu]) < len(kbids[kbid]):
-                        continue
-                    if not kbid.startswith('NIL'):
-                        continue
-                    for em in kbids[kbid]:
-                        msg = '  %s | %s -> %s' % (em.text, em.entity.kbid,
-                                                   kbids[kbid_clu][0].entity.kbid)
-                        history[msg] += 1
-                        em.entity = kbids[kbid_clu][0].entity
-                        em.translations = kbids[kbid_clu][0].translations
-
-        logger.info('  # of mention propagated: %s' % (len(history)))
-        if verbose:
-            for i in history:
-                logger.info('%s | %s' % (i, history[i]))
+                if len(kbids[kbid_clu]) < len(kbids[kbid]):
+                    continue
+                if not kbid.startswith('NIL'):
+                    continue
+                for em in kbids[kbid]:
+                    msg = '  %s | %s -> %s' % (em.text, em.entity.kbid,
+                                               kbids[kbid_clu][0].entity.kbid)
+                    history[msg] += 1
+                    em.entity = kbids[kbid_clu][0].entity
+                    em.translations = kbids[kbid_clu][0].translations
+
+    logger.info('  # of mention propagated: %s' % (len(history)))
+    if verbose:
+        for i in history:
+            logger.info('%s | %s' % (i, history[i]))
 
 
 def nil_clustering_exact_match(corpus):
@@ -315,3 +358,364 @@ def nil_clustering_exact_match(corpus):
                 em.entity = nilentity
     logger.info('  # of NIL IDs: %s' % (count['nilid']))
     logger.info('  # of NIL mentions: %s' % (count['nilmention']))
+
+
+class ClusterState(object):
+    '''
+    Persistent state of an incremental NIL clustering: each new mention is
+    assigned to an existing or a new NIL id in the same stages as
+    nil_clustering (normalization, trimming, similar texts, translations
+    and groups), without reclustering the mentions seen before, so ids
+    never change once given out.
+
+    The partition is not the one of nil_clustering, even on a single
+    batch: clusters are never merged, so a mention keeps the id of its
+    first sight when a later mention links it to another cluster, and
+    translations are only looked up for unseen mentions. 'aaaa' [x],
+    'bbbb' [y], 'bbbb' [x] gives two clusters here and one in
+    nil_clustering. Expect more clusters than nil_clustering on the same
+    mentions.
+
+        state = ClusterState.load(path, 'en', resources)
+        state.cluster(corpus)
+        state.save(path)
+
+    With exact=True mentions are only clustered by their text, as in
+    nil_clustering_exact_match.
+    '''
+
+    def __init__(self, lang, resources=None, exact=False):
+        self.lang = lang
+        self.exact = exact
+        self.designators, self.stop_words, self.morph = \
+            load_resources(resources)
+        if resources and 'group' in resources:
+            self.groups = resources['group']
+        else:
+            self.groups = []
+        self.group_index = get_group_index(self.groups)
+        self.count = 0
+        self.mentions = {}
+        # Trimmed text -> NIL id, the texts that started a cluster are in
+        # the fuzzy index
+        self.texts = {}
+        self.index = EditDistanceIndex()
+        self.translations = {}
+        # First mention of a group -> NIL id
+        self.group_ids = {}
+        self.nil_table = {}
+
+    def new_nilid(self):
+        nilid = 'NIL{:07d}'.format(self.count)
+        self.count += 1
+        return nilid
+
+    def get_nilid(self, mention, translations=None):
+        '''
+        NIL id of mention, assigned on first sight.
+        '''
+        translations = [i.lower() for i in translations or [] if i]
+        if mention in self.mentions:
+            nilid = self.mentions[mention]
+        elif self.exact:
+            nilid = self.new_nilid()
+        else:
+            nilid = self.assign(mention, translations)
+        self.mentions[mention] = nilid
+        for translation in translations:
+            if translation not in self.translations:
+                self.translations[translation] = nilid
+        return nilid
+
+    def assign(self, mention, translations):
+        text = normalize_text(mention.lower(), self.designators,
+                              self.stop_words, self.morph)
+        text = trim_text(text)
+        similar = None
+        if text not in self.texts and len(text) > 5:
+            similar = self.index.nearest(text, len(text) // 8)
+        group_text = None
+        if mention in self.group_index:
+            group_text = self.groups[self.group_index[mention][0]][0]
+
+        # Groups take precedence as in the last stage of nil_clustering,
+        # then similar texts, then shared translations
+        nilid = None
+        if group_text in self.group_ids:
+            nilid = self.group_ids[group_text]
+        elif text in self.texts:
+            nilid = self.texts[text]
+        elif similar is not None:
+            nilid = self.texts[similar]
+        else:
+            for translation in translations:
+                if translation in self.translations:
+                    nilid = self.translations[translation]
+                    break
+        if nilid is None:
+            nilid = self.new_nilid()
+
+        if text not in self.texts:
+            self.texts[text] = nilid
+            if similar is None:
+                self.index.add(text)
+        if group_text and group_text not in self.group_ids:
+            self.group_ids[group_text] = nilid
+        return nilid
+
+    def get_nilentity(self, nilid):
+        if nilid not in self.nil_table:
+            nilentity = Entity(nilid)
+            if not self.exact:
+                nilentity.kbid2 = nilid
+            nilentity.confidence = 1.0
+            self.nil_table[nilid] = nilentity
+        return self.nil_table[nilid]
+
+    def cluster(self, corpus):
+        '''
+        Assign NIL entities to the unlinked entity mentions of corpus, in
+        time proportional to its size.
+        '''
+        start = self.count
+        count = 0
+        for docid in corpus:
+            for em in corpus[docid]:
+                if self.exact and em.entity:
+                    continue
+                nilid = self.get_nilid(em.text, em.translations)
+                if not em.entity:
+                    em.entity = self.get_nilentity(nilid)
+                    count += 1
+        logger.info('  # of new NIL IDs: %s' % (self.count - start))
+        logger.info('  # of NIL mentions: %s' % count)
+
+    def cluster_batch(self, batch):
+        '''
+        cluster for a MentionBatch, NIL ids are written to its kbid column.
+        '''
+        start = self.count
+        count = 0
+        for i, text in enumerate(batch.texts):
+            linked = batch.kbids[i] >= 0
+            if self.exact and linked:
+                continue
+            nilid = self.get_nilid(text, batch.translations[i])
+            if not linked:
+                batch.set_entity(i, nilid, 1.0)
+                count += 1
+        logger.info('  # of new NIL IDs: %s' % (self.count - start))
+        logger.info('  # of NIL mentions: %s' % count)
+
+    def save(self, path):
+        data = {
+            'lang': self.lang,
+            'exact': self.exact,
+            'count': self.count,
+            'mentions': self.mentions,
+            'texts': self.texts,
+            'index': self.index.texts,
+            'translations': self.translations,
+            'group_ids': self.group_ids,
+        }
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path, lang, resources=None, exact=False):
+        '''
+        The state saved at path, or a new one if there is none. Resources
+        are not saved and must be the same as in previous runs, lang and
+        exact must be the saved ones.
+        '''
+        if not os.path.exists(path):
+            return cls(lang, resources=resources, exact=exact)
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if (data['lang'], data['exact']) != (lang, exact):
+            raise ValueError('%s: saved with lang=%s exact=%s, not lang=%s '
+                             'exact=%s' % (path, data['lang'], data['exact'],
+                                           lang, exact))
+        state = cls(lang, resources=resources, exact=exact)
+        state.count = data['count']
+        state.mentions = data['mentions']
+        state.texts = data['texts']
+        for text in data['index']:
+            state.index.add(text)
+        state.translations = data['translations']
+        state.group_ids = data['group_ids']
+        return state
+
+
+class UnionFind(object):
+    '''
+    Disjoint sets of 0..n-1, the root of a set is its smallest element.
+    '''
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        i = self.find(i)
+        j = self.find(j)
+        if i < j:
+            self.parent[j] = i
+        elif j < i:
+            self.parent[i] = j
+
+
+_worker = {}
+
+
+def _init_worker(resources):
+    _worker['normalize'] = load_resources(resources)
+
+
+def _get_keys(mentions):
+    designators, stop_words, morph = _worker['normalize']
+    return [trim_text(normalize_text(i, designators, stop_words, morph))
+            for i in mentions]
+
+
+def _get_similar_links(job):
+    '''
+    (i, j) for each text i of queries and the closest text j before it,
+    band holds the (j, text) of every text within reach of the queries.
+    '''
+    queries, band = job
+    index = EditDistanceIndex()
+    positions = []
+    texts = {}
+    for j, text in band:
+        index.add(text)
+        positions.append(j)
+        texts[j] = text
+    res = []
+    for i in queries:
+        text = texts[i]
+        similar = [(d, positions[order]) for d, order, _ in
+                   index.search(text, len(text) // 8)
+                   if positions[order] < i]
+        if similar:
+            res.append((i, min(similar)[1]))
+    return res
+
+
+def get_similar_jobs(texts, chunk_size):
+    '''
+    Chunks of the texts longer than 5 characters sorted by length, each
+    with the band of texts whose length is within len(text) // 8 of one
+    of its texts, in their original order.
+    '''
+    queries = sorted((i for i, text in enumerate(texts) if len(text) > 5),
+                     key=lambda i: (len(texts[i]), i))
+    by_length = defaultdict(list)
+    for j, text in enumerate(texts):
+        by_length[len(text)].append(j)
+    res = []
+    for n in range(0, len(queries), chunk_size):
+        chunk = queries[n:n+chunk_size]
+        lo = len(texts[chunk[0]])
+        hi = len(texts[chunk[-1]])
+        band = sorted(j for length in range(lo - lo // 8, hi + hi // 8 + 1)
+                      for j in by_length.get(length, ()))
+        res.append((chunk, [(j, texts[j]) for j in band]))
+    return res
+
+
+def nil_clustering_parallel(corpus, lang, resources=None, workers=None,
+                            chunk_size=10000, propagate=False,
+                            verbose=False):
+    '''
+    A NIL clustering for process pools, not a drop-in for nil_clustering:
+    it runs the same stages but merges clusters transitively, so the
+    partition differs and usually has a few percent fewer clusters.
+
+    Normalization runs on chunks of mentions. For the Similar stage,
+    texts are blocked by length and each chunk of texts of similar
+    lengths is linked to the closest earlier text within len(text) // 8.
+    Clusters are then merged with a union-find over these links, shared
+    translations and groups. NIL ids are numbered in order of first
+    appearance, the result does not depend on the number of workers.
+    '''
+    if workers is None:
+        workers = os.cpu_count()
+    mentions = {}
+    for docid in corpus:
+        for result in corpus[docid]:
+            if result.text not in mentions:
+                mentions[result.text] = result.text.lower()
+    lowers = list(dict.fromkeys(mentions.values()))
+    logger.info('# initial cluster: {}'.format(len(lowers)))
+
+    # 1-2. Normalization, NYSIIS
+    chunks = [lowers[i:i+chunk_size]
+              for i in range(0, len(lowers), chunk_size)]
+    with Pool(workers, initializer=_init_worker,
+              initargs=(resources,)) as pool:
+        keys = [key for res in pool.imap(_get_keys, chunks) for key in res]
+    lower_key = dict(zip(lowers, keys))
+    texts = list(dict.fromkeys(keys))
+    position = {text: i for i, text in enumerate(texts)}
+    logger.info('  # clusters: {} (NYSIIS)'.format(len(texts)))
+    uf = UnionFind(len(texts))
+
+    # 3. Similar, each job only ships and indexes the texts of the length
+    # band its chunk can reach
+    jobs = get_similar_jobs(texts, chunk_size)
+    with Pool(workers, initializer=_init_worker,
+              initargs=(resources,)) as pool:
+        for links in pool.imap(_get_similar_links, jobs):
+            for i, j in links:
+                uf.union(i, j)
+
+    # 5. Translation
+    translation_map = {}
+    for docid in corpus:
+        for result in corpus[docid]:
+            i = position[lower_key[mentions[result.text]]]
+            for translation in result.translations:
+                if not translation:
+                    continue
+                translation = translation.lower()
+                if translation in translation_map:
+                    uf.union(i, translation_map[translation])
+                else:
+                    translation_map[translation] = i
+
+    # 6. Group
+    if resources and 'group' in resources:
+        group_index = get_group_index(resources['group'])
+        group_map = {}
+        for mention, lower in mentions.items():
+            if mention not in group_index:
+                continue
+            i = position[lower_key[lower]]
+            n = group_index[mention][0]
+            if n in group_map:
+                uf.union(i, group_map[n])
+            else:
+                group_map[n] = i
+
+    roots = {}
+    for i in range(len(texts)):
+        root = uf.find(i)
+        if root not in roots:
+            roots[root] = 'NIL{:07d}'.format(len(roots))
+    logger.info('  # clusters: {} (Union-find)'.format(len(roots)))
+    mention_cluster = {}
+    for mention, lower in mentions.items():
+        root = uf.find(position[lower_key[lower]])
+        mention_cluster[mention] = roots[root]
+
+    assign_nilids(corpus, mention_cluster)
+    if propagate:
+        propagate_clusters(corpus, mention_cluster, verbose=verbose)
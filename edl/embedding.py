@@ -0,0 +1,173 @@
+import os
+import sys
+import shutil
+import _pickle as cPickle
+import ujson as json
+import numpy as np
+
+
+class Embedding(object):
+    '''
+    Embedding matrix exported from a MongoDB collection.
+
+    <path>.npy is a float32 (n, dim) matrix loaded with np.memmap, so
+    processes on one box share its pages through the OS page cache, and
+    <path>.keys holds the item of each row, one per line.
+    '''
+
+    # Rows have a unit L2 norm, candidate entities then skip computing it
+    normalized = False
+
+    def __init__(self, path):
+        self.path = path
+        self.matrix = np.load(path + '.npy', mmap_mode='r')
+        self.index = {}
+        with open(path + '.keys', 'r', encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                self.index[line.rstrip('\n')] = i
+        assert len(self.index) == self.matrix.shape[0]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def get(self, key):
+        i = self.index.get(key)
+        if i is None:
+            return None
+        return np.asarray(self.matrix[i])
+
+    def rows(self, keys):
+        '''
+        Row numbers of keys, -1 for missing keys.
+        '''
+        return np.array([self.index.get(key, -1) for key in keys],
+                        dtype=np.int64)
+
+    def take(self, rows):
+        '''
+        float32 (len(rows), dim) matrix of the vectors of rows.
+        '''
+        return np.asarray(self.matrix[rows])
+
+
+class QuantizedEmbedding(Embedding):
+    '''
+    Embedding written by quantize_embedding: <path>.npy is float16, or
+    int8 with the float32 scale of each row in <path>.scales.npy, and
+    <path>.json describes the format. Vectors are dequantized to float32
+    on lookup. An int8 matrix takes a quarter of the memory of the
+    float32 one.
+    '''
+
+    def __init__(self, path):
+        super(QuantizedEmbedding, self).__init__(path)
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.normalized = meta['normalized']
+        self.scales = None
+        if meta['dtype'] == 'int8':
+            self.scales = np.load(path + '.scales.npy', mmap_mode='r')
+
+    def get(self, key):
+        i = self.index.get(key)
+        if i is None:
+            return None
+        return self.take([i])[0]
+
+    def take(self, rows):
+        res = np.asarray(self.matrix[rows]).astype(np.float32)
+        if self.scales is not None:
+            res *= np.asarray(self.scales[rows])[:, None]
+        return res
+
+
+def open_embedding(path):
+    if os.path.exists(path + '.json'):
+        return QuantizedEmbedding(path)
+    return Embedding(path)
+
+
+def quantize_embedding(path, output, dtype='int8', normalize=False,
+                       batch_size=100000):
+    '''
+    Write the float32 embedding exported to path as a QuantizedEmbedding
+    of dtype, float16 or int8, to output. With normalize, rows are scaled
+    to a unit L2 norm first, so that the cosine similarity of two vectors
+    is their dot product. Only suitable for vectors compared by cosine,
+    such as entity vectors, word vectors are averaged.
+    '''
+    matrix = np.load(path + '.npy', mmap_mode='r')
+    n, dim = matrix.shape
+    res = np.lib.format.open_memmap(output + '.npy', mode='w+',
+                                    dtype=np.dtype(dtype), shape=(n, dim))
+    scales = np.ones(n, dtype=np.float32)
+    for beg in range(0, n, batch_size):
+        batch = np.array(matrix[beg:beg + batch_size], dtype=np.float32)
+        if normalize:
+            norms = np.linalg.norm(batch, axis=1, keepdims=True)
+            batch /= np.where(norms > 0, norms, 1.0)
+        if dtype == 'int8':
+            # Symmetric per-row scale, the largest value maps to 127
+            scale = np.abs(batch).max(axis=1) / 127.0
+            scale[scale == 0] = 1.0
+            scales[beg:beg + len(batch)] = scale
+            batch = np.rint(batch / scale[:, None])
+        res[beg:beg + len(batch)] = batch
+    res.flush()
+    if dtype == 'int8':
+        np.save(output + '.scales.npy', scales)
+    shutil.copyfile(path + '.keys', output + '.keys')
+    with open(output + '.json', 'w') as f:
+        json.dump({'dtype': dtype, 'normalized': normalize}, f)
+    return n
+
+
+def export_embedding(collection, path):
+    '''
+    Write every {'item', 'vector'} document of collection to <path>.npy
+    and <path>.keys.
+    '''
+    count = collection.count_documents({})
+    first = collection.find_one()
+    dim = cPickle.loads(first['vector']).shape[0]
+    matrix = np.lib.format.open_memmap(path + '.npy', mode='w+',
+                                       dtype=np.float32, shape=(count, dim))
+    n = 0
+    with open(path + '.keys', 'w', encoding='utf-8') as f:
+        for response in collection.find():
+            matrix[n] = cPickle.loads(response['vector'])
+            f.write('%s\n' % response['item'].replace('\n', ' '))
+            n += 1
+    assert n == count
+    matrix.flush()
+    return n
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == '--quantize':
+        args = [i for i in sys.argv[2:] if i != '--normalize']
+        if len(args) != 3 or args[0] not in ['float16', 'int8']:
+            print('USAGE: --quantize <float16|int8> [--normalize] '
+                  '<EXPORTED PATH> <OUTPUT PATH>')
+            sys.exit()
+        n = quantize_embedding(args[1], args[2], dtype=args[0],
+                               normalize='--normalize' in sys.argv)
+        print('%s vectors quantized to %s' % (n, args[2]))
+        sys.exit()
+    if len(sys.argv) != 3:
+        print('USAGE: <COLLECTION (e.g. entity_embeddings)> <OUTPUT PATH>')
+        print('       --quantize <float16|int8> [--normalize] '
+              '<EXPORTED PATH> <OUTPUT PATH>')
+        sys.exit()
+    from edl.engine import get_engine
+    from edl.storage import get_mongo_kb
+    mongo_kb = get_mongo_kb(get_engine().config)
+    n = export_embedding(mongo_kb.db_emb[sys.argv[1]], sys.argv[2])
+    print('%s vectors exported to %s' % (n, sys.argv[2]))
@@ -0,0 +1,310 @@
+import os
+import logging
+import functools
+import threading
+import contextvars
+from configparser import ConfigParser
+from edl import storage
+from edl import snapshot
+from edl import metrics
+from edl.cache import Cache, parse_limit
+from edl.embedding import open_embedding
+from edl.fuzzy import SymmetricDeleteIndex
+
+
+logger = logging.getLogger()
+
+_MISSING = object()
+
+
+def default_config_path():
+    '''
+    $EDL_CONFIG, ./global.conf, or the global.conf of this repository.
+    '''
+    if 'EDL_CONFIG' in os.environ:
+        return os.environ['EDL_CONFIG']
+    if os.path.exists('global.conf'):
+        return 'global.conf'
+    return os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'global.conf')
+
+
+def load_glossary(kb, lang):
+    '''
+    Compact in-memory dictionary: glosses are tuples of strings shared
+    between lemmas.
+    '''
+    strings = {}
+    res = {}
+    for lemma, glosses in kb.iter_glosses(lang):
+        res[lemma] = tuple(strings.setdefault(i, i) for i in glosses)
+    return res
+
+
+class Engine(object):
+    '''
+    Owns the config, KB connection, caches and models used by the linker,
+    vector and translator modules. Everything is initialized lazily on
+    first use, so creating an engine is cheap.
+
+    Module functions use the current engine, the default one unless set
+    with a with statement:
+
+        with Engine('other.conf'):
+            api.process_bio(bio)
+    '''
+
+    def __init__(self, config_path=None, kb=None):
+        self.config_path = config_path or default_config_path()
+        self.lock = threading.RLock()
+        self.caches = {}
+        self._config = None
+        # A KB object replaces the backend of the [kb] section
+        self._kb = metrics.InstrumentedKB(kb) if kb is not None else None
+        self._W = None
+        self._b = None
+        self._entity_emb = _MISSING
+        self._word_emb = _MISSING
+        self._fuzzy_index = _MISSING
+        self._glossaries = {}
+        self._tokens = []
+        self._snapshot_timer = None
+
+    def __enter__(self):
+        self._tokens.append(_current.set(self))
+        return self
+
+    def __exit__(self, *args):
+        _current.reset(self._tokens.pop())
+
+    @property
+    def config(self):
+        with self.lock:
+            if self._config is None:
+                config = ConfigParser()
+                if not config.read(self.config_path):
+                    raise IOError('Config not found: %s' % self.config_path)
+                self._config = config
+            return self._config
+
+    @property
+    def kb(self):
+        with self.lock:
+            if self._kb is None:
+                self._kb = metrics.InstrumentedKB(
+                    storage.open_kb(self.config))
+            return self._kb
+
+    @property
+    def W(self):
+        with self.lock:
+            if self._W is None:
+                self._W = self.kb.get_misc('W')
+            return self._W
+
+    @property
+    def b(self):
+        with self.lock:
+            if self._b is None:
+                self._b = self.kb.get_misc('b')
+            return self._b
+
+    @property
+    def entity_emb(self):
+        with self.lock:
+            if self._entity_emb is _MISSING:
+                self._entity_emb = self._load_embedding('entity')
+            return self._entity_emb
+
+    @property
+    def word_emb(self):
+        with self.lock:
+            if self._word_emb is _MISSING:
+                self._word_emb = self._load_embedding('word')
+            return self._word_emb
+
+    @property
+    def fuzzy_index(self):
+        '''
+        SymmetricDeleteIndex of the mention table keys, None unless
+        [fuzzy] index is set.
+        '''
+        with self.lock:
+            if self._fuzzy_index is _MISSING:
+                path = self.config.get('fuzzy', 'index', fallback=None)
+                self._fuzzy_index = SymmetricDeleteIndex(path) if path \
+                    else None
+            return self._fuzzy_index
+
+    def _load_embedding(self, name):
+        if not self.config.has_option('embedding', name):
+            return None
+        return open_embedding(self.config.get('embedding', name))
+
+    def glossary(self, lang):
+        '''
+        {lemma: ranked glosses} of the whole dictionary of lang when lang
+        is listed in [translation] preload, else None. Loaded once.
+        '''
+        with self.lock:
+            if lang not in self._glossaries:
+                preload = self.config.get('translation', 'preload',
+                                          fallback='')
+                glossary = None
+                if lang in [i.strip() for i in preload.split(',')]:
+                    glossary = load_glossary(self.kb, lang)
+                    logger.info('glossary %s: %s lemmas' %
+                                (lang, len(glossary)))
+                self._glossaries[lang] = glossary
+            return self._glossaries[lang]
+
+    def cache(self, name):
+        '''
+        Cache named name, sized by the [cache] section of the config.
+        '''
+        with self.lock:
+            if name not in self.caches:
+                config = self.config
+                policy = config.get('cache', 'policy', fallback='lru')
+                limit = config.get('cache', name,
+                                   fallback=config.get('cache', 'default',
+                                                       fallback='100000'))
+                maxsize, maxbytes = parse_limit(limit)
+                self.caches[name] = Cache(name, maxsize=maxsize,
+                                          maxbytes=maxbytes, policy=policy)
+            return self.caches[name]
+
+    def cache_stats(self):
+        with self.lock:
+            caches = sorted(self.caches.items())
+        return {name: cache.stats() for name, cache in caches}
+
+    def snapshot_dir(self, directory=None):
+        return directory or self.config.get('snapshot', 'path',
+                                            fallback=None)
+
+    def dump_snapshot(self, directory=None):
+        '''
+        Dump every cache to directory, [snapshot] path by default.
+        '''
+        directory = self.snapshot_dir(directory)
+        if not directory:
+            return {}
+        with self.lock:
+            caches = dict(self.caches)
+        return snapshot.dump_caches(caches, directory)
+
+    def load_snapshot(self, directory=None):
+        '''
+        Reload the caches dumped by dump_snapshot.
+        '''
+        directory = self.snapshot_dir(directory)
+        if not directory:
+            return {}
+        return snapshot.load_caches(self.cache, directory)
+
+    def start_snapshot_timer(self, interval=None, directory=None):
+        '''
+        Dump the caches every interval seconds, [snapshot] interval by
+        default, in a daemon thread.
+        '''
+        if interval is None:
+            interval = self.config.getint('snapshot', 'interval',
+                                          fallback=0)
+        if not interval or not self.snapshot_dir(directory):
+            return
+
+        def run():
+            try:
+                self.dump_snapshot(directory)
+            except Exception:
+                logger.exception('snapshot failed')
+            self.start_snapshot_timer(interval, directory)
+
+        self._snapshot_timer = threading.Timer(interval, run)
+        self._snapshot_timer.daemon = True
+        self._snapshot_timer.start()
+
+    def stop_snapshot_timer(self):
+        if self._snapshot_timer:
+            self._snapshot_timer.cancel()
+            self._snapshot_timer = None
+
+    def warmup(self, hotlist=None, size=None, n=10, batch_size=1000):
+        '''
+        Preload the candidate entities, etypes and entity vectors of the
+        first size mentions of hotlist, a file with one mention per line
+        from the most to the least frequent. Defaults to the [warmup]
+        section of the config.
+        '''
+        # linker imports this module
+        from edl import linker
+        hotlist = hotlist or self.config.get('warmup', 'hotlist',
+                                             fallback=None)
+        if not hotlist:
+            return 0
+        if size is None:
+            size = self.config.getint('warmup', 'size', fallback=10000)
+        mentions = []
+        with open(hotlist, 'r', encoding='utf-8') as f:
+            for line in f:
+                mention = line.rstrip('\n').lower()
+                if mention:
+                    mentions.append(mention)
+                if len(mentions) == size:
+                    break
+        with self:
+            for i in range(0, len(mentions), batch_size):
+                groups = [(False, (m,)) for m in mentions[i:i+batch_size]]
+                linker.get_candidate_entities_batch(groups, n)
+        logger.info('warmup: %s mentions from %s' % (len(mentions), hotlist))
+        return len(mentions)
+
+
+_current = contextvars.ContextVar('edl_engine', default=None)
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_engine():
+    '''
+    The engine of the current context, or the default engine.
+    '''
+    global _default
+    engine = _current.get()
+    if engine is not None:
+        return engine
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                _default = Engine()
+    return _default
+
+
+def set_engine(engine):
+    '''
+    Replace the default engine.
+    '''
+    global _default
+    with _default_lock:
+        _default = engine
+
+
+def cached(name):
+    '''
+    Memoize a function with hashable arguments in the cache named name of
+    the current engine, a bounded replacement for
+    functools.lru_cache(maxsize=None).
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            cache = get_engine().cache(name)
+            value = cache.get(args, _MISSING)
+            if value is _MISSING:
+                value = func(*args)
+                cache.put(args, value)
+            return value
+        wrapper.get_cache = lambda: get_engine().cache(name)
+        return wrapper
+    return decorator
@@ -0,0 +1,244 @@
+import sys
+import zlib
+from array import array
+import ujson as json
+import numpy as np
+import jellyfish
+
+
+def partition(length, k):
+    '''
+    (start, size) of the k + 1 segments a string of length is split into.
+    '''
+    size, extra = divmod(length, k + 1)
+    res = []
+    start = 0
+    for i in range(k + 1):
+        n = size + 1 if i >= k + 1 - extra else size
+        res.append((start, n))
+        start += n
+    return res
+
+
+class EditDistanceIndex(object):
+    '''
+    Strings bucketed by length and by the segments of their partitions.
+    If two strings are within an edit distance of k, one of the k + 1
+    segments of the first appears unchanged in the second, shifted by at
+    most k characters, so only the strings sharing a segment with a query
+    are compared with it.
+    '''
+
+    def __init__(self, distance=jellyfish.levenshtein_distance):
+        self.distance = distance
+        self.texts = []
+        self.orders = {}
+        self.by_length = {}
+        # length -> {k: {(segment number, segment): [order, ...]}}
+        self.tables = {}
+        self.n_distances = 0
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __contains__(self, text):
+        return text in self.orders
+
+    def add(self, text):
+        '''
+        Insert text, strings are ranked by insertion order on ties.
+        '''
+        if text in self.orders:
+            return
+        order = len(self.texts)
+        self.texts.append(text)
+        self.orders[text] = order
+        self.by_length.setdefault(len(text), []).append(order)
+        for k, table in self.tables.get(len(text), {}).items():
+            self._index(table, text, order, k)
+
+    def _index(self, table, text, order, k):
+        for i, (start, size) in enumerate(partition(len(text), k)):
+            key = (i, text[start:start + size])
+            if key in table:
+                table[key].append(order)
+            else:
+                table[key] = [order]
+
+    def _table(self, length, k):
+        # Partitions are built the first time a distance is queried
+        tables = self.tables.setdefault(length, {})
+        if k not in tables:
+            table = {}
+            for order in self.by_length[length]:
+                self._index(table, self.texts[order], order, k)
+            tables[k] = table
+        return tables[k]
+
+    def search(self, text, max_distance):
+        '''
+        (distance, order, string) of every string within max_distance of
+        text, order being the insertion order.
+        '''
+        k = max_distance
+        n = len(text)
+        res = []
+        seen = set()
+        for length in range(max(n - k, 0), n + k + 1):
+            if length not in self.by_length:
+                continue
+            table = self._table(length, k)
+            for i, (start, size) in enumerate(partition(length, k)):
+                for p in range(max(start - k, 0),
+                               min(start + k, n - size) + 1):
+                    for order in table.get((i, text[p:p + size]), ()):
+                        if order in seen:
+                            continue
+                        seen.add(order)
+                        d = self.distance(text, self.texts[order])
+                        self.n_distances += 1
+                        if d <= k:
+                            res.append((d, order, self.texts[order]))
+        return res
+
+    def nearest(self, text, max_distance):
+        '''
+        The closest string within max_distance of text, the first inserted
+        one on ties, None if there is none.
+        '''
+        res = self.search(text, max_distance)
+        if not res:
+            return None
+        return min(res)[2]
+
+
+def deletions(text, max_distance):
+    '''
+    Every string obtained by deleting up to max_distance characters of
+    text, text included.
+    '''
+    res = {text}
+    level = {text}
+    for _ in range(max_distance):
+        level = set(i[:p] + i[p + 1:] for i in level for p in range(len(i)))
+        res |= level
+    return res
+
+
+def hash_text(text):
+    # Stable across processes, unlike hash(); collisions only cost a
+    # distance computation
+    data = text.encode('utf-8')
+    return zlib.crc32(data) << 32 | zlib.adler32(data)
+
+
+class SymmetricDeleteIndex(object):
+    '''
+    Approximate lookup of mention table keys. Two strings within a
+    Damerau-Levenshtein distance of k share a string obtained by deleting
+    at most k characters from each, so the deletions of every key are
+    hashed once by build_index and a query only probes the hashes of its
+    own deletions before checking the distance of the few matching keys.
+
+    <path>.hashes.npy is the sorted uint64 hashes and <path>.ids.npy the
+    key number of each, <path>.keys the keys, one per line, and
+    <path>.offsets.npy where each starts. All are loaded with mmap, as
+    embedding.Embedding matrices, so at tens of millions of keys they
+    stay in the OS page cache instead of the Python heap.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.max_distance = meta['max_distance']
+        self.min_length = meta['min_length']
+        # Plain arrays over the mapped memory, slicing a np.memmap is slow
+        self.hashes = np.asarray(np.load(path + '.hashes.npy', mmap_mode='r'))
+        self.ids = np.asarray(np.load(path + '.ids.npy', mmap_mode='r'))
+        self.offsets = np.asarray(np.load(path + '.offsets.npy',
+                                          mmap_mode='r'))
+        self.keys = np.asarray(np.memmap(path + '.keys', dtype=np.uint8,
+                                         mode='r')) \
+            if self.offsets[-1] else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def key(self, i):
+        beg, end = self.offsets[i:i + 2].tolist()
+        return self.keys[beg:end - 1].tobytes().decode('utf-8')
+
+    def search(self, text, k=5, max_distance=None):
+        '''
+        (distance, key) of the k keys closest to text, other than text
+        itself, within max_distance, by distance then key number.
+        '''
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        if len(text) < self.min_length or not len(self.hashes):
+            return []
+        hashes = np.array(sorted(hash_text(i) for i in
+                                 deletions(text, max_distance)),
+                          dtype=np.uint64)
+        begs = np.searchsorted(self.hashes, hashes, side='left')
+        ends = np.searchsorted(self.hashes, hashes, side='right')
+        ids = set()
+        for beg, end in zip(begs.tolist(), ends.tolist()):
+            if beg < end:
+                ids.update(self.ids[beg:end].tolist())
+        res = []
+        for i in ids:
+            key = self.key(i)
+            if key == text:
+                continue
+            d = jellyfish.damerau_levenshtein_distance(text, key)
+            if d <= max_distance:
+                res.append((d, i, key))
+        res.sort()
+        return [(d, key) for d, i, key in res[:k]]
+
+
+def build_index(keys, path, max_distance=1, min_length=4):
+    '''
+    Write the SymmetricDeleteIndex of keys, shorter keys than
+    min_length - max_distance are left out as no query is compared with
+    them.
+    '''
+    hashes = array('Q')
+    ids = array('I')
+    offsets = array('q', [0])
+    n = 0
+    with open(path + '.keys', 'wb') as f:
+        for key in keys:
+            key = key.replace('\n', ' ')
+            if len(key) < min_length - max_distance:
+                continue
+            data = key.encode('utf-8') + b'\n'
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+            for i in deletions(key, max_distance):
+                hashes.append(hash_text(i))
+                ids.append(n)
+            n += 1
+    hashes = np.frombuffer(hashes, dtype=np.uint64)
+    ids = np.frombuffer(ids, dtype=np.uint32)
+    order = np.argsort(hashes, kind='stable')
+    np.save(path + '.hashes.npy', hashes[order])
+    np.save(path + '.ids.npy', ids[order])
+    np.save(path + '.offsets.npy', np.frombuffer(offsets, dtype=np.int64))
+    with open(path + '.json', 'w') as f:
+        json.dump({'max_distance': max_distance, 'min_length': min_length,
+                   'keys': n, 'entries': len(order)}, f)
+    return n
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [2, 3]:
+        print('USAGE: <OUTPUT PATH> [<MAX DISTANCE>]')
+        sys.exit()
+    from edl.engine import get_engine
+    max_distance = int(sys.argv[2]) if len(sys.argv) == 3 else 1
+    n = build_index(get_engine().kb.iter_mentions(), sys.argv[1],
+                    max_distance=max_distance)
+    print('%s mention table keys indexed to %s' % (n, sys.argv[1]))
@@ -0,0 +1,165 @@
+import os
+import time
+import logging
+import argparse
+from multiprocessing import Pool
+from edl import linker
+from edl import util
+from edl.engine import Engine, set_engine
+
+
+logger = logging.getLogger()
+
+CORENLP_LANGS = {
+    'en': 'eng',
+    'zh': 'cmn',
+}
+
+
+def list_documents(indir):
+    '''
+    BIO (.bio) and CoreNLP JSON (.json) files of indir in sorted order.
+    '''
+    res = []
+    for filename in sorted(os.listdir(indir)):
+        if filename.endswith('.bio') or filename.endswith('.json'):
+            res.append(filename)
+    return res
+
+
+def check_lang(filenames, lang):
+    '''
+    Error message if CoreNLP JSON documents can not be read in lang, None
+    otherwise. Checked before starting the workers.
+    '''
+    if lang in CORENLP_LANGS or \
+            not any(i.endswith('.json') for i in filenames):
+        return None
+    return 'CoreNLP JSON documents are only read for %s, not %s' % \
+        (', '.join(sorted(CORENLP_LANGS)), lang)
+
+
+def read_document(path, lang):
+    if path.endswith('.json'):
+        docid = os.path.splitext(os.path.basename(path))[0]
+        corenlp_res, entitymentions = util.read_corenlp_json_format(
+            path, docid=docid, lang=CORENLP_LANGS[lang])
+        return entitymentions, corenlp_res
+    with open(path, 'r', encoding='utf-8') as f:
+        return util.read_tac_bio_format(f), None
+
+
+def link_document(path, lang):
+    '''
+    TAB rows of a document, without run and mention ids.
+    '''
+    entitymentions, corenlp_res = read_document(path, lang)
+    linker.link_entitymentions(entitymentions, lang=lang)
+    if corenlp_res:
+        util.add_corenlp_nominalmentions(entitymentions, corenlp_res)
+    return util.get_tac_tab_format(entitymentions, add_trans=True)
+
+
+def init_worker(config_path, hotlist):
+    # Each worker has its own engine and connections, warmed from the
+    # snapshot and the hotlist
+    engine = Engine(config_path)
+    set_engine(engine)
+    engine.load_snapshot()
+    engine.warmup(hotlist=hotlist)
+
+
+def process_document(job):
+    '''
+    Link one document into <workdir>/<filename>.tab, written atomically so
+    that a finished document is never linked again after a crash.
+    '''
+    indir, workdir, filename, lang = job
+    tab = link_document(os.path.join(indir, filename), lang)
+    path = os.path.join(workdir, filename + '.tab')
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        for row in tab:
+            f.write('%s\n' % '\t'.join(row))
+    os.replace(path + '.tmp', path)
+    return filename, len(tab)
+
+
+def merge(workdir, filenames, outpath, runid):
+    '''
+    Concatenate the TAB files of the documents in order, with mention ids
+    numbered over the whole corpus.
+    '''
+    count = 0
+    with open(outpath + '.tmp', 'w', encoding='utf-8') as w:
+        for filename in filenames:
+            path = os.path.join(workdir, filename + '.tab')
+            with open(path, 'r', encoding='utf-8') as f:
+                tab = [line.rstrip('\n').split('\t') for line in f]
+            count = util.add_tac_runid_and_mid(tab, runid=runid,
+                                               mid_prefix=runid, start=count)
+            for row in tab:
+                w.write('%s\n' % '\t'.join(row))
+    os.replace(outpath + '.tmp', outpath)
+    return count
+
+
+def link_corpus(indir, outpath, lang='en', workers=None, workdir=None,
+                runid='elisa-ie', config_path=None, hotlist=None,
+                log_every=100):
+    filenames = list_documents(indir)
+    error = check_lang(filenames, lang)
+    if error:
+        raise ValueError(error)
+    workdir = workdir or outpath + '.work'
+    os.makedirs(workdir, exist_ok=True)
+    todo = [i for i in filenames
+            if not os.path.exists(os.path.join(workdir, i + '.tab'))]
+    logger.info('%s documents, %s already linked, %s to link' %
+                (len(filenames), len(filenames) - len(todo), len(todo)))
+
+    jobs = [(indir, workdir, filename, lang) for filename in todo]
+    start = time.time()
+    n_docs = 0
+    n_mentions = 0
+    # Nothing left to link, e.g. when resuming a finished run
+    if jobs:
+        with Pool(workers, initializer=init_worker,
+                  initargs=(config_path, hotlist)) as pool:
+            for filename, n in pool.imap_unordered(process_document, jobs):
+                n_docs += 1
+                n_mentions += n
+                if n_docs % log_every == 0 or n_docs == len(jobs):
+                    elapsed = time.time() - start
+                    logger.info('%s/%s documents, %.1f docs/s, '
+                                '%.1f mentions/s' %
+                                (n_docs, len(jobs), n_docs / elapsed,
+                                 n_mentions / elapsed))
+
+    count = merge(workdir, filenames, outpath, runid)
+    logger.info('%s mentions written to %s' % (count, outpath))
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Link a directory of BIO (.bio) or CoreNLP JSON (.json) '
+                    'documents into one TAC TAB file.')
+    parser.add_argument('indir')
+    parser.add_argument('outpath')
+    parser.add_argument('--lang', default='en')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes, default: cpu count')
+    parser.add_argument('--workdir', default=None,
+                        help='per-document results used to resume, '
+                             'default: <outpath>.work')
+    parser.add_argument('--runid', default='elisa-ie')
+    parser.add_argument('--config', default=None)
+    parser.add_argument('--hotlist', default=None)
+    args = parser.parse_args()
+    error = check_lang(list_documents(args.indir), args.lang)
+    if error:
+        parser.error(error)
+    link_corpus(args.indir, args.outpath, lang=args.lang,
+                workers=args.workers, workdir=args.workdir,
+                runid=args.runid, config_path=args.config,
+                hotlist=args.hotlist)
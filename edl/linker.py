@@ -1,87 +1,203 @@
-import functools
-from copy import deepcopy
-from configparser import ConfigParser
 from collections import defaultdict
-from pymongo import MongoClient
-from scipy.spatial.distance import cosine
-from edl.models.text import EntityMention, NominalMention, Entity
+import numpy as np
+from edl.models.text import EntityMention, NominalMention, Entity, \
+                            CandidateEntity
 from edl import vector
+from edl import translator
+from edl import metrics
+from edl.engine import get_engine, cached
 
 
-config_path = 'global.conf'
-config = ConfigParser()
-config.read(config_path)
-host = config.get('mongodb', 'host')
-port = config.getint('mongodb', 'port')
-db_name = config.get('mongodb', 'kb')
-client = MongoClient(host=host, port=port)
-db = client[db_name]
-collection_mention_table = db['mention_table']
-collection_etypes = db['etypes']
-
-
-@functools.lru_cache(maxsize=None)
+@cached('get_etype')
 def get_etype(kbid):
-    query = {'kbid': kbid}
-    response = collection_etypes.find_one(query)
-    if response:
-        return response['etype']
-    return None
-
-
-@functools.lru_cache(maxsize=None)
-def get_candidate_entities(mention, n):
+    return get_engine().kb.find_etype(kbid)
+
+
+def make_candidate_entities(entities, etypes, vectors):
+    '''
+    Immutable candidate entities from (kbid, commonness) pairs, with the
+    ETYPE_COMMONNESS feature and the norm of each vector precomputed.
+    Vectors of an entity embedding exported normalized are taken to have
+    a unit norm, 0 for zero vectors.
+    '''
+    entity_emb = get_engine().entity_emb
+    normalized = entity_emb is not None and entity_emb.normalized
+    etype_probs = defaultdict(float)
+    for kbid, score in entities:
+        etype_probs[etypes.get(kbid)] += score
     res = []
-    query = {'mention': mention.lower()}
-    response = collection_mention_table.find_one(query)
-    if response:
-        for kbid, score in response['entities'][:n+1]:
-            ce = Entity(kbid, etype=get_etype(kbid))
-            ce.vector = vector.get_entity_vector(kbid)
-            ce.features = {
-                'COMMONNESS': score
-            }
-            res.append(ce)
-    add_etype_commonness(res)
-    return res
+    for kbid, score in entities:
+        etype = etypes.get(kbid)
+        vec = vectors.get(kbid)
+        norm = None
+        if vec is not None:
+            vec.flags.writeable = False
+            if normalized:
+                norm = 1.0 if vec.any() else 0.0
+            else:
+                norm = float(np.linalg.norm(vec))
+        res.append(CandidateEntity(kbid, etype, vec, norm, score,
+                                   score / etype_probs[etype]))
+    return tuple(res)
+
+
+def merge_mention_table_entries(entries):
+    '''
+    Sum the commonness of the same kbid over several mention table
+    entries and normalize it.
+    '''
+    merged = {}
+    for entities in entries:
+        for kbid, score in entities:
+            if kbid not in merged:
+                merged[kbid] = score
+            else:
+                merged[kbid] += score
+    tol = sum([merged[kbid] for kbid in merged])
+    return [(kbid, merged[kbid] / tol) for kbid in merged]
+
+
+def merge_fuzzy_entries(matches, entries, n, penalty):
+    '''
+    Mention table entries of the (distance, key) matches of a mention
+    averaged with weights penalty ** distance, then scaled by penalty **
+    the smallest distance, so that a close key counts more than a far one
+    and a fuzzy match less than an exact one.
+    '''
+    merged = {}
+    total = 0.0
+    for d, key in matches:
+        weight = penalty ** d
+        total += weight
+        for kbid, score in entries[key]:
+            merged[kbid] = merged.get(kbid, 0.0) + weight * score
+    scale = penalty ** min(d for d, _ in matches) / total
+    res = sorted(merged.items(), key=lambda x: x[1], reverse=True)
+    return [(kbid, score * scale) for kbid, score in res[:n+1]]
+
+
+def get_fuzzy_entries(mentions, n):
+    '''
+    {mention: merged entries of the closest mention table keys} for
+    mentions missing from the mention table, empty unless the engine has
+    a fuzzy index. The fuzzy stage is only timed when there is one.
+    '''
+    engine = get_engine()
+    index = engine.fuzzy_index
+    if index is None:
+        return {}
+    with metrics.timer('fuzzy'):
+        k = engine.config.getint('fuzzy', 'keys', fallback=5)
+        penalty = engine.config.getfloat('fuzzy', 'penalty', fallback=0.5)
+        matches = {mention: index.search(mention, k) for mention in mentions}
+        keys = set(key for res in matches.values() for _, key in res)
+        if not keys:
+            return {}
+        entries = engine.kb.find_mentions(keys, n)
+        res = {}
+        for mention, found in matches.items():
+            found = [(d, key) for d, key in found if entries.get(key)]
+            if found:
+                res[mention] = merge_fuzzy_entries(found, entries, n,
+                                                   penalty)
+        return res
+
+
+@cached('get_candidate_entities')
+def get_candidate_entities(mention, n):
+    entities = get_engine().kb.find_mention(mention.lower(), n) or []
+    if not entities:
+        entities = get_fuzzy_entries([mention.lower()], n) \
+            .get(mention.lower(), [])
+    etypes = {kbid: get_etype(kbid) for kbid, _ in entities}
+    vectors = {kbid: vector.get_entity_vector(kbid) for kbid, _ in entities}
+    return make_candidate_entities(entities, etypes, vectors)
 
 
-@functools.lru_cache(maxsize=None)
+@cached('get_candidate_entities_multi_mentions')
 def get_candidate_entities_multi_mentions(mentions, n):
-    res = []
-    merged_ce = {}
+    entries = []
     for mention in mentions:
-        query = {'mention': mention.lower()}
-        response = collection_mention_table.find_one(query)
-        if response:
-            for kbid, score in response['entities'][:n+1]:
-                if kbid not in merged_ce:
-                    ce = Entity(kbid, etype=get_etype(kbid))
-                    ce.vector = vector.get_entity_vector(kbid)
-                    ce.features = {
-                        'COMMONNESS': score
-                    }
-                    merged_ce[kbid] = ce
-                else:
-                    merged_ce[kbid].features['COMMONNESS'] += score
-    tol = sum([merged_ce[kbid].features['COMMONNESS'] for kbid in merged_ce])
-    for kbid in merged_ce:
-        merged_ce[kbid].features['COMMONNESS'] /= tol
-        res.append(merged_ce[kbid])
-    add_etype_commonness(res)
+        entities = get_engine().kb.find_mention(mention.lower(), n)
+        if entities:
+            entries.append(entities)
+    entities = merge_mention_table_entries(entries)
+    etypes = {kbid: get_etype(kbid) for kbid, _ in entities}
+    vectors = {kbid: vector.get_entity_vector(kbid) for kbid, _ in entities}
+    return make_candidate_entities(entities, etypes, vectors)
+
+
+@metrics.timed('etypes')
+def get_etypes(kbids):
+    res = {}
+    missing = set()
+    for kbid in set(kbids):
+        etype = get_etype.get_cache().get((kbid,), missing)
+        if etype is missing:
+            missing.add(kbid)
+        else:
+            res[kbid] = etype
+    if not missing:
+        return res
+    res.update(get_engine().kb.find_etypes(missing))
+    for kbid in missing:
+        get_etype.get_cache().put((kbid,), res.setdefault(kbid, None))
     return res
 
 
-def add_etype_commonness(candidate_entities):
-    etype_probs = defaultdict(float)
-    for ce in candidate_entities:
-        etype_probs[ce.etype] += ce.features['COMMONNESS']
-    for ce in candidate_entities:
-        a = ce.features['COMMONNESS']
-        b = etype_probs[ce.etype]
-        ce.features['ETYPE_COMMONNESS'] =  a / b
+def get_candidate_entities_batch(mention_groups, n):
+    '''
+    Candidate entities for a batch of mentions with a few bulk queries.
+    Each item of mention_groups is a (multi, mentions) pair, matching
+    get_candidate_entities_multi_mentions(mentions, n) if multi is set and
+    get_candidate_entities(mentions[0], n) otherwise.
+    Returns {(multi, mentions): candidate entities}, shared with the caches
+    of those two functions.
+    '''
+    res = {}
+    caches = {
+        True: get_candidate_entities_multi_mentions.get_cache(),
+        False: get_candidate_entities.get_cache()
+    }
+    missing = []
+    for multi, group in set(mention_groups):
+        key = (group, n) if multi else (group[0], n)
+        candidates = caches[multi].get(key)
+        if candidates is None:
+            missing.append((multi, group))
+        else:
+            res[(multi, group)] = candidates
+    if not missing:
+        return res
+
+    mentions = set(m.lower() for _, group in missing for m in group)
+    entries = get_engine().kb.find_mentions(mentions, n)
+    # Mentions missing from the mention table fall back to close keys
+    fuzzy = get_fuzzy_entries(set(group[0].lower()
+                                  for multi, group in missing
+                                  if not multi and
+                                  not entries.get(group[0].lower())), n)
+    kbids = set(kbid for table in [entries, fuzzy]
+                for entities in table.values() for kbid, _ in entities)
+    etypes = get_etypes(kbids)
+    vectors = vector.get_entity_vectors(kbids)
+
+    for multi, group in missing:
+        if multi:
+            entities = merge_mention_table_entries(
+                [entries[m.lower()] for m in group if m.lower() in entries])
+            key = (group, n)
+        else:
+            entities = entries.get(group[0].lower()) or \
+                fuzzy.get(group[0].lower(), [])
+            key = (group[0], n)
+        candidates = make_candidate_entities(entities, etypes, vectors)
+        caches[multi].put(key, candidates)
+        res[(multi, group)] = candidates
+    return res
 
 
+@metrics.timed('candidates')
 def add_candidate_entities(entitymention, n=10, lang='eng'):
     em = entitymention
     if lang == 'eng':
@@ -95,54 +211,293 @@ def add_candidate_entities(entitymention, n=10, lang='eng'):
             em.candidates = get_candidate_entities(query, n)
 
 
+@metrics.timed('candidates')
+def add_candidate_entities_batch(entitymentions, n=10, lang='eng'):
+    '''
+    Same as add_candidate_entities for all mentions of a document or batch,
+    the mention table, etypes and entity vectors are fetched with a few
+    $in queries instead of per-mention round trips. The mention text is
+    only looked up, and fuzzy matched, when its translations have no
+    candidates.
+    '''
+    groups = []
+    for em in entitymentions:
+        if lang != 'eng' and em.translations:
+            groups.append((True, tuple(em.translations)))
+        else:
+            # Without translations the multi-mention lookup is empty
+            groups.append((False, (em.text.lower(),)))
+    candidates = get_candidate_entities_batch(set(groups), n)
+    fallbacks = []
+    for em, group in zip(entitymentions, groups):
+        em.candidates = candidates[group]
+        if not em.candidates and group[0]:
+            fallbacks.append(em)
+    if not fallbacks:
+        return
+    groups = [(False, (em.text.lower(),)) for em in fallbacks]
+    candidates = get_candidate_entities_batch(set(groups), n)
+    for em, group in zip(fallbacks, groups):
+        em.candidates = candidates[group]
+
+
+def get_salience(candidate_entities, etype=None):
+    commonness = np.array([ce.commonness for ce in candidate_entities],
+                          dtype=float)
+    if etype and etype in ['PER', 'ORG', 'GPE']:
+        etype_commonness = np.array([ce.etype_commonness
+                                     for ce in candidate_entities],
+                                    dtype=float)
+        match = np.array([bool(ce.etype) and ce.etype == etype
+                          for ce in candidate_entities], dtype=bool)
+        return np.where(match, etype_commonness,
+                        commonness * 0.3) # TO-DO: thres
+    return commonness
+
+
 def add_salience(entitymention, etype=None):
     em = entitymention
-    if etype and etype in ['PER', 'ORG', 'GPE']:
+    em.features['SALIENCE'] = get_salience(em.candidates, etype=etype)
+
+
+@metrics.timed('context_vectors')
+def add_context_vectors(entitymentions):
+    '''
+    Set em.vector for all mentions, the contexts missing from the
+    get_text_vector cache are computed together in one batch.
+    '''
+    cache = vector.get_text_vector.get_cache()
+    contexts = {}
+    for em in entitymentions:
+        context = tuple(sorted(set(em.context)-set(em.text_tok)))
+        em.vector = None
+        if context:
+            contexts.setdefault(context, []).append(em)
+    missing = []
+    for context, ems in contexts.items():
+        vec = cache.get((context,), missing)
+        if vec is missing:
+            missing.append(context)
+        for em in ems:
+            em.vector = vec if vec is not missing else None
+    if not missing:
+        return
+    for context, vec in zip(missing, vector.get_text_vectors(missing)):
+        vec = vec if vec.any() else None
+        cache.put((context,), vec)
+        for em in contexts[context]:
+            em.vector = vec
+
+
+@metrics.timed('context_similarity')
+def get_context_similarities(entitymentions):
+    '''
+    Cosine similarity between em.vector and the vector of each candidate,
+    clipped at 0, for all mentions with one batched product.
+    Returns one array per mention.
+    '''
+    sizes = [len(em.candidates) for em in entitymentions]
+    res = np.zeros(sum(sizes))
+    rows, norms, mention_vectors, candidate_vectors = [], [], [], []
+    n = 0
+    for em in entitymentions:
+        if em.vector is not None:
+            em_norm = np.linalg.norm(em.vector)
         for ce in em.candidates:
-            if ce.etype and ce.etype == etype :
-                ce.features['SALIENCE'] = ce.features['ETYPE_COMMONNESS']
-            else:
-                ce.features['SALIENCE'] = ce.features['COMMONNESS'] * 0.3 # TO-DO: thres
-    else:
-        for ce in em.candidates:
-            ce.features['SALIENCE'] = ce.features['COMMONNESS']
+            if em.vector is not None and ce.vector is not None:
+                rows.append(n)
+                norms.append(em_norm * ce.norm)
+                mention_vectors.append(em.vector)
+                candidate_vectors.append(ce.vector)
+            n += 1
+    if rows:
+        a = np.array(mention_vectors, dtype=float)
+        b = np.array(candidate_vectors, dtype=float)
+        cs = np.einsum('ij,ij->i', a, b) / norms
+        res[rows] = np.maximum(cs, 0.0)
+    return np.split(res, np.cumsum(sizes)[:-1])
 
 
 def add_context_similarity(entitymention):
     em = entitymention
-    context = tuple(sorted(set(em.context)-set(em.text_tok)))
-    em.vector = vector.get_text_vector(context) if context else None
-    for ce in em.candidates:
-        if em.vector is not None and ce.vector is not None:
-            cs = 1 - cosine(em.vector, ce.vector)
-            cs = max(cs, 0.0)
-            ce.features['CONTEXT_SIMILARITY'] = cs
-        else:
-            ce.features['CONTEXT_SIMILARITY'] = 0.0
+    add_context_vectors([em])
+    em.features['CONTEXT_SIMILARITY'] = get_context_similarities([em])[0]
 
 
 def rank_candidate_entities(entitymention, etype=None, rankings=[]):
-    em = entitymention
-    add_salience(em, etype=etype)
+    rank_candidate_entities_batch([entitymention], etypes=[etype],
+                                  rankings=rankings)
+
+
+@metrics.timed('ranking')
+def rank_candidate_entities_batch(entitymentions, etypes=None, rankings=[]):
+    '''
+    rank_candidate_entities for all mentions of a document, features are
+    computed as NumPy columns. etypes defaults to the etype of each mention.
+
+    The shared candidate entities are not modified, features and
+    confidences are stored per mention in em.features and em.confidences,
+    aligned with em.candidates.
+    '''
+    if etypes is None:
+        etypes = [em.etype for em in entitymentions]
+    for em, etype in zip(entitymentions, etypes):
+        em.features = {
+            'COMMONNESS': np.array([ce.commonness for ce in em.candidates],
+                                   dtype=float),
+            'ETYPE_COMMONNESS': np.array([ce.etype_commonness
+                                          for ce in em.candidates],
+                                         dtype=float),
+        }
+        add_salience(em, etype=etype)
 
     if 'CONTEXT_SIMILARITY' in rankings:
-        add_context_similarity(em)
-
-    # Ranking
-    for ce in em.candidates:
-        ce.confidence = ce.features['SALIENCE']
+        add_context_vectors(entitymentions)
+        cs = get_context_similarities(entitymentions)
+        for em, c in zip(entitymentions, cs):
+            em.features['CONTEXT_SIMILARITY'] = c
+
+    for em in entitymentions:
+        # Ranking
+        confidence = em.features['SALIENCE'].copy()
         for r in rankings:
-            ce.confidence += ce.features[r]
+            confidence += em.features[r]
+
+        # Softmax, uniform when every feature is zero
+        total = confidence.sum()
+        if total > 0:
+            confidence /= total
+        else:
+            confidence[:] = 1.0 / max(len(confidence), 1)
+
+        order = np.argsort(-confidence, kind='stable')
+        em.candidates = [em.candidates[i] for i in order]
+        em.confidences = confidence[order]
+        for name in em.features:
+            em.features[name] = em.features[name][order]
+        if em.candidates:
+            em.entity = get_ranked_entity(em, 0)
+
+
+def get_reuse_key(entitymention, lang, context='exact'):
+    '''
+    Everything the linking of a mention depends on: mentions with the same
+    key get the same candidates and ranking. Translations are looked up
+    by text, and English mentions are looked up by lowercased text and
+    ranked by the words of their context. context sets the part of the
+    key standing for these words:
+
+        exact     the words themselves, results are identical to linking
+                  each mention separately
+        document  the docid, mentions of a document share the ranking of
+                  the first one
+        none      nothing, every mention shares the ranking of the first
+                  one with the same text and etype
+    '''
+    em = entitymention
+    if lang != 'en':
+        return (em.text, em.etype, lang)
+    if context == 'document':
+        signature = em.docid
+    elif context == 'none':
+        signature = None
+    else:
+        signature = tuple(sorted(set(em.context)-set(em.text_tok)))
+    return (em.text.lower(), em.etype, lang, tuple(em.translations),
+            signature)
 
-    # Softmax
-    tol = sum([ce.confidence for ce in em.candidates])
-    for ce in em.candidates:
-        ce.confidence /= tol
 
-    em.candidates = sorted(em.candidates, key=lambda x: x.confidence,
-                           reverse=True)
+def set_linking_result(entitymention, result):
+    em = entitymention
+    translations, candidates, features, confidences = result
+    em.translations = translations
+    em.candidates = list(candidates)
+    em.features = dict(features)
+    em.confidences = confidences
     if em.candidates:
-        em.entity = deepcopy(entitymention.candidates[0])
+        em.entity = get_ranked_entity(em, 0)
+
+
+def link_entitymentions(entitymentions, lang='en', context=None):
+    '''
+    Translate, retrieve and rank the candidates of the mentions of a
+    document, ranking English mentions by context similarity as well.
+
+    Mentions with the same get_reuse_key are linked once, and results are
+    kept in the link_entitymentions cache for the following documents.
+    context is the context signature of the key, [reuse] context by
+    default, or off to link every mention.
+    '''
+    if context is None:
+        context = get_engine().config.get('reuse', 'context',
+                                          fallback='exact')
+    if context == 'off':
+        groups = [(None, [em]) for em in entitymentions]
+    else:
+        groups = defaultdict(list)
+        for em in entitymentions:
+            groups[get_reuse_key(em, lang, context)].append(em)
+        groups = list(groups.items())
+
+    cache = get_engine().cache('link_entitymentions')
+    missing = []
+    for key, ems in groups:
+        result = cache.get(key) if key is not None else None
+        if result is None:
+            missing.append((key, ems))
+        else:
+            for em in ems:
+                set_linking_result(em, result)
+    metrics.observe_reuse(len(entitymentions), len(missing))
+    if not missing:
+        return
+    linked = [ems[0] for _, ems in missing]
+
+    if lang != 'en':
+        translations = translator.get_translations(
+            [em.text for em in linked], lang)
+        for em in linked:
+            em.translations = translations[em.text]
+
+    rankings = []
+    if lang == 'en':
+        rankings = ['CONTEXT_SIMILARITY']
+    add_candidate_entities_batch(linked, lang=lang)
+    rank_candidate_entities_batch(linked, rankings=rankings)
+
+    for key, ems in missing:
+        em = ems[0]
+        result = (em.translations, tuple(em.candidates), dict(em.features),
+                  em.confidences)
+        if key is not None:
+            cache.put(key, result)
+        for other in ems[1:]:
+            set_linking_result(other, result)
+
+
+def link_mention_batch(batch, lang='en', chunk_size=1000):
+    '''
+    link_entitymentions for a MentionBatch, chunk_size mentions at a time
+    so that only one chunk of EntityMention objects exists at once.
+    '''
+    for start in range(0, len(batch), chunk_size):
+        ems = batch.entitymentions(start, start + chunk_size)
+        link_entitymentions(ems, lang=lang)
+        batch.update(start, ems)
+
+
+def get_ranked_entity(entitymention, i):
+    '''
+    Entity for the i-th ranked candidate of a mention, with its features
+    and confidence.
+    '''
+    em = entitymention
+    ce = em.candidates[i]
+    features = {name: values[i].item() for name, values in em.features.items()}
+    entity = Entity(ce.kbid, etype=ce.etype, vector=ce.vector,
+                    features=features)
+    entity.confidence = em.confidences[i].item()
+    return entity
 
 
 
@@ -0,0 +1,270 @@
+'''
+Per-stage latency histograms, KB round-trip counters and the Prometheus
+text format of both. Stages are timed with
+
+    with metrics.timer('candidates'):
+        ...
+
+or the timed(stage) decorator. Stages may be nested, e.g. etypes inside
+candidates. Inside a breakdown() block, the stages and KB calls of the
+current request are also summed into a dict.
+'''
+import time
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        '''
+        Cumulative (bound, count) pairs, count and sum.
+        '''
+        with self.lock:
+            res = []
+            total = 0
+            for bound, count in zip(self.buckets, self.counts):
+                total += count
+                res.append((bound, total))
+            return res, self.count, self.sum
+
+
+_lock = threading.Lock()
+_stages = {}
+_kb_calls = {}
+_kb_documents = {}
+# Mentions given to and linked by linker.link_entitymentions
+_reuse = {'mentions': 0, 'linked': 0}
+_request = contextvars.ContextVar('edl_request_timing', default=None)
+
+
+def _histogram(table, name):
+    if name not in table:
+        with _lock:
+            table.setdefault(name, Histogram())
+    return table[name]
+
+
+def observe(stage, seconds):
+    _histogram(_stages, stage).observe(seconds)
+    timing = _request.get()
+    if timing is not None:
+        stages = timing['stages']
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe_kb(method, seconds, documents):
+    '''
+    One KB round trip of method returning documents documents.
+    '''
+    _histogram(_kb_calls, method).observe(seconds)
+    with _lock:
+        _kb_documents[method] = _kb_documents.get(method, 0) + documents
+    timing = _request.get()
+    if timing is not None:
+        calls = timing['kb'].setdefault(method, {'calls': 0, 'documents': 0,
+                                                 'seconds': 0.0})
+        calls['calls'] += 1
+        calls['documents'] += documents
+        calls['seconds'] += seconds
+
+
+def observe_reuse(mentions, linked):
+    '''
+    Of mentions, linked were linked and the others reused earlier results.
+    '''
+    with _lock:
+        _reuse['mentions'] += mentions
+        _reuse['linked'] += linked
+    timing = _request.get()
+    if timing is not None:
+        timing['reuse']['mentions'] += mentions
+        timing['reuse']['linked'] += linked
+
+
+def reuse_ratio(reuse=None):
+    '''
+    Share of the mentions whose results were reused, of a breakdown or
+    since the start.
+    '''
+    reuse = reuse or _reuse
+    if not reuse['mentions']:
+        return 0.0
+    return 1.0 - reuse['linked'] / reuse['mentions']
+
+
+@contextmanager
+def breakdown():
+    '''
+    Collect the stage times and KB calls of the enclosed code:
+
+        with metrics.breakdown() as timing:
+            api.process_bio(bio)
+        timing == {'total': s, 'stages': {stage: s}, 'kb': {method: {...}},
+                   'reuse': {'mentions': n, 'linked': n}}
+    '''
+    timing = {'total': 0.0, 'stages': {}, 'kb': {},
+              'reuse': {'mentions': 0, 'linked': 0}}
+    token = _request.set(timing)
+    start = time.perf_counter()
+    try:
+        yield timing
+    finally:
+        timing['total'] = time.perf_counter() - start
+        _request.reset(token)
+
+
+def server_timing(timing):
+    '''
+    A breakdown as a Server-Timing header value, durations in ms.
+    '''
+    res = ['total;dur=%.3f' % (timing['total'] * 1000)]
+    for stage, seconds in sorted(timing['stages'].items()):
+        res.append('%s;dur=%.3f' % (stage, seconds * 1000))
+    for method, calls in sorted(timing['kb'].items()):
+        res.append('kb_%s;desc="%s calls, %s documents";dur=%.3f' %
+                   (method, calls['calls'], calls['documents'],
+                    calls['seconds'] * 1000))
+    if timing['reuse']['mentions']:
+        res.append('reuse;desc="%s of %s mentions reused"' %
+                   (timing['reuse']['mentions'] - timing['reuse']['linked'],
+                    timing['reuse']['mentions']))
+    return ', '.join(res)
+
+
+class InstrumentedKB(object):
+    '''
+    Wraps a KB backend to count the round trips and documents fetched by
+    each of its find_* methods.
+    '''
+
+    def __init__(self, kb):
+        self.kb = kb
+
+    def __getattr__(self, name):
+        attr = getattr(self.kb, name)
+        if not name.startswith('find_') or not callable(attr):
+            return attr
+
+        def wrapper(*args):
+            start = time.perf_counter()
+            res = attr(*args)
+            if res is None:
+                documents = 0
+            elif isinstance(res, (dict, list)):
+                documents = len(res)
+            else:
+                documents = 1
+            observe_kb(name, time.perf_counter() - start, documents)
+            return res
+        return wrapper
+
+
+def _render_histogram(lines, name, labels, hist):
+    buckets, count, total = hist.snapshot()
+    for bound, n in buckets:
+        lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, bound, n))
+    lines.append('%s_bucket{%s,le="+Inf"} %s' % (name, labels, count))
+    lines.append('%s_sum{%s} %s' % (name, labels, total))
+    lines.append('%s_count{%s} %s' % (name, labels, count))
+
+
+def render(cache_stats=None):
+    '''
+    Every metric in the Prometheus text exposition format, cache_stats
+    being Engine.cache_stats().
+    '''
+    lines = []
+    lines.append('# HELP edl_stage_seconds Latency of linking stages.')
+    lines.append('# TYPE edl_stage_seconds histogram')
+    with _lock:
+        stages = sorted(_stages.items())
+        kb_calls = sorted(_kb_calls.items())
+        kb_documents = sorted(_kb_documents.items())
+        reuse = dict(_reuse)
+    for stage, hist in stages:
+        _render_histogram(lines, 'edl_stage_seconds',
+                          'stage="%s"' % stage, hist)
+
+    lines.append('# HELP edl_kb_request_seconds Latency of KB round trips.')
+    lines.append('# TYPE edl_kb_request_seconds histogram')
+    for method, hist in kb_calls:
+        _render_histogram(lines, 'edl_kb_request_seconds',
+                          'method="%s"' % method, hist)
+    lines.append('# HELP edl_kb_documents_total Documents fetched from '
+                 'the KB.')
+    lines.append('# TYPE edl_kb_documents_total counter')
+    for method, documents in kb_documents:
+        lines.append('edl_kb_documents_total{method="%s"} %s' %
+                     (method, documents))
+
+    lines.append('# HELP edl_mentions_total Mentions given to the linker, '
+                 'linked or reusing earlier results.')
+    lines.append('# TYPE edl_mentions_total counter')
+    lines.append('edl_mentions_total{result="linked"} %s' % reuse['linked'])
+    lines.append('edl_mentions_total{result="reused"} %s' %
+                 (reuse['mentions'] - reuse['linked']))
+
+    if cache_stats:
+        for key, kind in [('hits', 'counter'), ('misses', 'counter'),
+                          ('evictions', 'counter'), ('size', 'gauge'),
+                          ('hit_ratio', 'gauge')]:
+            name = 'edl_cache_%s' % key
+            if kind == 'counter':
+                name += '_total'
+            lines.append('# TYPE %s %s' % (name, kind))
+            for cache, stats in sorted(cache_stats.items()):
+                lines.append('%s{cache="%s"} %s' %
+                             (name, cache, stats[key] or 0))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _kb_calls.clear()
+        _kb_documents.clear()
+        _reuse['mentions'] = 0
+        _reuse['linked'] = 0
@@ -0,0 +1,176 @@
+import sys
+from array import array
+import numpy as np
+from edl.models.text import EntityMention, Entity
+
+
+class Vocabulary(object):
+    '''
+    Strings stored once and referenced by index, -1 stands for None.
+    '''
+    __slots__ = ('items', 'index')
+
+    def __init__(self):
+        self.items = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        if item is None:
+            return -1
+        i = self.index.get(item)
+        if i is None:
+            i = len(self.items)
+            self.items.append(item)
+            self.index[item] = i
+        return i
+
+    def get(self, i):
+        return self.items[i] if i >= 0 else None
+
+
+class MentionBatch(object):
+    '''
+    Columnar entity mentions: one array per attribute instead of one
+    EntityMention per mention. Docids, entity types and kbids are indices
+    into vocabularies, and the mentions of a sentence share one context
+    tuple of interned tokens. Mention tokens are only kept when they differ from
+    text.split().
+
+    Nominal mentions, features and candidates are not stored, mentions
+    are linked in chunks by linker.link_mention_batch, which only keeps
+    the kbid and confidence of the top-ranked candidate.
+    '''
+    __slots__ = ('texts', 'text_toks', 'begs', 'ends', 'docids', 'etypes',
+                 'kbids', 'confidences', 'sentences', 'contexts',
+                 'translations', 'docid_vocab', 'etype_vocab', 'kbid_vocab',
+                 '_last_context')
+
+    def __init__(self):
+        self.texts = []
+        self.text_toks = []
+        self.begs = array('q')
+        self.ends = array('q')
+        self.docids = array('i')
+        self.etypes = array('i')
+        self.kbids = array('i')
+        self.confidences = array('d')
+        self.sentences = array('i')
+        self.contexts = []
+        self.translations = []
+        self.docid_vocab = Vocabulary()
+        self.etype_vocab = Vocabulary()
+        self.kbid_vocab = Vocabulary()
+        self._last_context = None
+
+    def __len__(self):
+        return len(self.texts)
+
+    @classmethod
+    def from_entitymentions(cls, entitymentions):
+        batch = cls()
+        for em in entitymentions:
+            batch.append(em)
+        return batch
+
+    def append(self, em):
+        '''
+        Add the attributes of an EntityMention.
+        '''
+        self.texts.append(em.text)
+        text_tok = tuple(em.text_tok)
+        self.text_toks.append(None if list(text_tok) == em.text.split()
+                              else text_tok)
+        self.begs.append(em.beg)
+        self.ends.append(em.end)
+        self.docids.append(self.docid_vocab.add(em.docid))
+        self.etypes.append(self.etype_vocab.add(em.etype))
+        if em.context is not self._last_context:
+            self._last_context = em.context
+            # Tokens repeat across sentences, keep one copy of each
+            self.contexts.append(tuple(sys.intern(i) for i in em.context))
+        self.sentences.append(len(self.contexts) - 1)
+        self.translations.append(tuple(em.translations) or None)
+        self.kbids.append(-1)
+        self.confidences.append(0.0)
+        if em.entity:
+            self.set_entity(len(self) - 1, em.entity.kbid,
+                            em.entity.confidence)
+
+    def set_entity(self, i, kbid, confidence=1.0):
+        self.kbids[i] = self.kbid_vocab.add(kbid)
+        self.confidences[i] = confidence
+
+    def set_translations(self, i, translations):
+        self.translations[i] = tuple(translations) or None
+
+    def kbid(self, i):
+        return self.kbid_vocab.get(self.kbids[i])
+
+    def entitymention(self, i):
+        '''
+        The mention at row i as an EntityMention.
+        '''
+        text = self.texts[i]
+        text_tok = self.text_toks[i]
+        entity = None
+        if self.kbids[i] >= 0:
+            entity = Entity(self.kbid(i))
+            entity.confidence = self.confidences[i]
+        return EntityMention(text,
+                             beg=self.begs[i],
+                             end=self.ends[i],
+                             text_tok=text.split() if text_tok is None
+                             else text_tok,
+                             docid=self.docid_vocab.get(self.docids[i]),
+                             context=self.contexts[self.sentences[i]],
+                             etype=self.etype_vocab.get(self.etypes[i]),
+                             entity=entity,
+                             translations=self.translations[i])
+
+    def entitymentions(self, start=0, end=None):
+        end = len(self) if end is None else min(end, len(self))
+        return [self.entitymention(i) for i in range(start, end)]
+
+    def update(self, start, entitymentions):
+        '''
+        Copy the entities and translations of linked mentions back to the
+        rows from start.
+        '''
+        for i, em in enumerate(entitymentions, start):
+            self.set_translations(i, em.translations)
+            if em.entity:
+                self.set_entity(i, em.entity.kbid, em.entity.confidence)
+
+    def offsets(self):
+        '''
+        (begs, ends) as NumPy arrays sharing the memory of the columns.
+        '''
+        return (np.frombuffer(self.begs, dtype=np.int64),
+                np.frombuffer(self.ends, dtype=np.int64))
+
+    def to_tac_tab_format(self, add_trans=False):
+        '''
+        Rows of util.get_tac_tab_format for every mention.
+        '''
+        res = []
+        for i, text in enumerate(self.texts):
+            mention = text.replace('\t', ' ') \
+                          .replace('\n', ' ') \
+                          .replace('\r', ' ')
+            offset = '%s:%s-%s' % (self.docid_vocab.get(self.docids[i]),
+                                   self.begs[i], self.ends[i])
+            etype = self.etype_vocab.get(self.etypes[i])
+            if self.kbids[i] < 0:
+                kbid = 'NIL'
+                conf = '1.0'
+            else:
+                kbid = self.kbid(i)
+                conf = '{0:.16f}'.format(self.confidences[i])
+            row = [mention, offset, kbid, etype, 'NAM', conf]
+            if add_trans:
+                row.append('|'.join(self.translations[i] or ()))
+            res.append(row)
+        return res
@@ -1,11 +1,22 @@
+from collections import namedtuple
+
+
 class EntityMention(object):
     '''
     Entity Mention Class
+
+    Slotted to keep corpora of millions of mentions small. The context is
+    the token list of the sentence, shared by reference between its
+    mentions.
     '''
+    __slots__ = ('text', 'beg', 'end', 'text_tok', 'docid', 'context',
+                 'vector', 'etype', 'entity', 'candidates', 'translations',
+                 'nominalmentions', 'features', 'confidences')
 
     def __init__(self, text, beg=0, end=0, text_tok=None, docid=None,
                  context=None, vector=None, etype=None, entity=None,
-                 candidates=None, translations=None, nominalmentions=None):
+                 candidates=None, translations=None, nominalmentions=None,
+                 features=None, confidences=None):
         self.text = text
         self.beg = int(beg)
         self.end = int(end)
@@ -18,6 +29,9 @@ class EntityMention(object):
         self.candidates = candidates or []
         self.translations = translations or []
         self.nominalmentions = nominalmentions or []
+        # Per-mention scores aligned with candidates
+        self.features = features or {}
+        self.confidences = confidences
 
     def __str__(self):
         res = ''
@@ -32,8 +46,14 @@ class EntityMention(object):
             res += 'E: %s\n' % (self.entity.kbid)
         else:
             res += 'E: None\n'
-        for c in self.candidates:
-            res += '   %s\n'  % str(c)
+        for i, c in enumerate(self.candidates):
+            if self.confidences is None:
+                res += '   %s\n'  % str(c)
+                continue
+            features = {k: float(v[i]) for k, v in self.features.items()}
+            res += '   %s %s %s\n%s\n' % (c.kbid, c.etype,
+                                          float(self.confidences[i]),
+                                          features)
         return res
 
     def to_tac_tab_format(self, add_trans=False, kbid_format='kbid'):
@@ -66,6 +86,8 @@ class NominalMention(object):
     '''
     Nominal Mention Class
     '''
+    __slots__ = ('text', 'entitymention', 'beg', 'end', 'docid', 'context',
+                 'mtype', 'etype')
 
     def __init__(self, text, beg=0, end=0, docid=None,
                  context=None, mtype=None, etype=None,
@@ -77,6 +99,7 @@ class NominalMention(object):
         self.docid = docid
         self.context = context
         self.mtype = mtype
+        self.etype = etype
 
     def to_tac_tab_format(self, add_trans=False, kbid_format='kbid'):
         mention = self.text.replace('\t', ' ') \
@@ -105,10 +128,13 @@ class Entity(object):
     '''
     Entity Class
     '''
+    __slots__ = ('kbid', '_kbid', 'kbid2', 'name', 'etype', 'vector',
+                 'features', 'confidence')
 
     def __init__(self, kbid, name=None, etype=None, vector=None, features=None):
         self.kbid = kbid
         self._kbid = None
+        self.kbid2 = None
         self.name = name
         self.etype = etype
         self.vector = vector
@@ -119,3 +145,21 @@ class Entity(object):
         res = '%s %s %s\n%s' % (self.kbid, self.etype, self.confidence,
                                 self.features)
         return res
+
+
+class CandidateEntity(namedtuple('CandidateEntity',
+                                 ['kbid', 'etype', 'vector', 'norm',
+                                  'commonness', 'etype_commonness'])):
+    '''
+    Candidate Entity Class
+
+    Immutable so that cached candidates can be shared by mentions and
+    threads, the ranking of a mention is kept in EntityMention.features
+    and EntityMention.confidences.
+    '''
+    __slots__ = ()
+
+    def __str__(self):
+        res = '%s %s %s %s' % (self.kbid, self.etype, self.commonness,
+                               self.etype_commonness)
+        return res
@@ -0,0 +1,184 @@
+'''
+A cache snapshot is written as two files:
+  <name>.<id>.npy  every vector of the cached values stacked in one
+                   matrix, loaded back with np.memmap
+  <name>.jsonl     a header line with the snapshot id, then one [key,
+                   value] line per entry from the next to be evicted to
+                   the last, [key, value, frequency] for LFU caches,
+                   where arrays are replaced by their row in the matrix
+The matrix is named after the id of its snapshot and written first, so
+replacing the .jsonl switches both files at once and a .jsonl is never
+read with the matrix of another dump.
+Values are tagged JSON: {"v": row} for vectors, {"a": [...], "d": dtype}
+for other arrays such as ranking features, {"t": [...]} for tuples,
+{"m": [[key, value], ...]} for dicts, {"c": [...]} for candidate
+entities, plain JSON otherwise.
+'''
+import os
+import uuid
+import logging
+import ujson as json
+import numpy as np
+from edl.models.text import CandidateEntity
+
+
+logger = logging.getLogger()
+
+
+def _is_vector(obj, vectors):
+    '''
+    Whether obj can be a row of the matrix, float32 and as long as the
+    vectors already in it.
+    '''
+    if obj.ndim != 1 or obj.dtype != np.float32:
+        return False
+    if not vectors:
+        return True
+    _, first = next(iter(vectors.values()))
+    return obj.shape == first.shape
+
+
+def _encode(obj, vectors):
+    if isinstance(obj, np.ndarray):
+        if not _is_vector(obj, vectors):
+            return {'a': obj.tolist(), 'd': obj.dtype.str}
+        # Vectors shared by several entries are stored once
+        if id(obj) not in vectors:
+            vectors[id(obj)] = (len(vectors), obj)
+        return {'v': vectors[id(obj)][0]}
+    if isinstance(obj, CandidateEntity):
+        return {'c': [_encode(i, vectors) for i in obj]}
+    if isinstance(obj, tuple):
+        return {'t': [_encode(i, vectors) for i in obj]}
+    if isinstance(obj, dict):
+        return {'m': [[_encode(k, vectors), _encode(v, vectors)]
+                      for k, v in obj.items()]}
+    if isinstance(obj, list):
+        return [_encode(i, vectors) for i in obj]
+    return obj
+
+
+def _decode(obj, matrix):
+    if isinstance(obj, dict):
+        if 'v' in obj:
+            return np.asarray(matrix[obj['v']])
+        if 'a' in obj:
+            return np.array(obj['a'], dtype=np.dtype(obj['d']))
+        if 'm' in obj:
+            return {_decode(k, matrix): _decode(v, matrix)
+                    for k, v in obj['m']}
+        if 'c' in obj:
+            return CandidateEntity(*[_decode(i, matrix) for i in obj['c']])
+        return tuple(_decode(i, matrix) for i in obj['t'])
+    if isinstance(obj, list):
+        return [_decode(i, matrix) for i in obj]
+    return obj
+
+
+def matrix_path(path, snapshot_id):
+    return '%s.%s.npy' % (path, snapshot_id)
+
+
+def dump_cache(cache, path):
+    '''
+    Write the entries of cache to <path>.<id>.npy and <path>.jsonl, and
+    remove the matrix of the previous snapshot.
+    '''
+    vectors = {}
+    lines = []
+    for key, value, frequency in cache.items(frequencies=True):
+        entry = [_encode(key, vectors), _encode(value, vectors)]
+        if frequency is not None:
+            entry.append(frequency)
+        lines.append(json.dumps(entry))
+    if vectors:
+        matrix = np.array([vec for _, vec in sorted(vectors.values(),
+                                                    key=lambda x: x[0])],
+                          dtype=np.float32)
+    else:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+
+    previous = read_header(path)
+    snapshot_id = uuid.uuid4().hex
+    with open(matrix_path(path, snapshot_id), 'wb') as f:
+        np.save(f, matrix)
+    with open(path + '.jsonl.tmp', 'w', encoding='utf-8') as f:
+        f.write('%s\n' % json.dumps({'id': snapshot_id,
+                                     'rows': matrix.shape[0],
+                                     'entries': len(lines)}))
+        for line in lines:
+            f.write('%s\n' % line)
+    os.replace(path + '.jsonl.tmp', path + '.jsonl')
+    if previous and 'id' in previous:
+        try:
+            os.remove(matrix_path(path, previous['id']))
+        except FileNotFoundError:
+            pass
+    return len(lines)
+
+
+def read_header(path):
+    if not os.path.exists(path + '.jsonl'):
+        return None
+    with open(path + '.jsonl', 'r', encoding='utf-8') as f:
+        return json.loads(f.readline())
+
+
+def load_cache(cache, path):
+    '''
+    Put the entries of a snapshot written by dump_cache into cache, the
+    vectors are read-only views of the memory-mapped matrix.
+    '''
+    if not os.path.exists(path + '.jsonl'):
+        return 0
+    with open(path + '.jsonl', 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        try:
+            matrix = np.load(matrix_path(path, header.get('id')),
+                             mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            matrix = None
+        if matrix is None or header['rows'] != matrix.shape[0]:
+            logger.warning('snapshot %s: matrix does not match, '
+                           'skip it' % path)
+            return 0
+        n = 0
+        for line in f:
+            entry = json.loads(line)
+            frequency = entry[2] if len(entry) > 2 else 1
+            cache.put(_decode(entry[0], matrix), _decode(entry[1], matrix),
+                      frequency=frequency)
+            n += 1
+    return n
+
+
+def dump_caches(caches, directory):
+    os.makedirs(directory, exist_ok=True)
+    res = {}
+    for name, cache in caches.items():
+        # One cache that can not be written does not lose the others
+        try:
+            res[name] = dump_cache(cache, os.path.join(directory, name))
+        except Exception:
+            logger.exception('snapshot: cache %s not dumped' % name)
+    logger.info('snapshot: %s entries dumped to %s' %
+                (sum(res.values()), directory))
+    return res
+
+
+def load_caches(get_cache, directory):
+    '''
+    Load every snapshot of directory into get_cache(name).
+    '''
+    res = {}
+    if not os.path.isdir(directory):
+        return res
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.jsonl'):
+            continue
+        name = filename[:-len('.jsonl')]
+        res[name] = load_cache(get_cache(name),
+                               os.path.join(directory, name))
+    logger.info('snapshot: %s entries loaded from %s' %
+                (sum(res.values()), directory))
+    return res
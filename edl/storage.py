@@ -0,0 +1,379 @@
+import io
+import sys
+import sqlite3
+import threading
+from collections import OrderedDict
+import _pickle as cPickle
+import ujson as json
+import numpy as np
+try:
+    from pymongo import MongoClient
+except ImportError:
+    # Not needed when serving from a compiled SQLite KB
+    MongoClient = None
+
+
+VECTOR_COLLECTIONS = ['entity_embeddings', 'word_embeddings']
+# <lang>.glosses, the ranked glosses of each lemma of the <lang> dictionary
+GLOSSES = '%s.glosses'
+
+
+def rank_glosses(entries):
+    '''
+    Glosses of (gloss, priority) dictionary entries by decreasing total
+    priority, ties in order of first appearance.
+    '''
+    count = OrderedDict()
+    for gloss, priority in entries:
+        count[gloss] = count.get(gloss, 0) + priority
+    return [i for i, c in sorted(count.items(),
+                                 key=lambda x: x[1], reverse=True)]
+
+
+def group_entries(rows):
+    '''
+    {lemma: [(gloss, priority)]} of (lemma, gloss, priority) rows.
+    '''
+    res = OrderedDict()
+    for lemma, gloss, priority in rows:
+        res.setdefault(lemma, []).append((gloss, priority))
+    return res
+
+
+class MongoKB(object):
+    '''
+    Knowledge base served by MongoDB, the kb, dict and emb databases of
+    the [mongodb] section. client replaces the connection to host:port,
+    e.g. a mongomock.MongoClient.
+    '''
+
+    def __init__(self, host, port, kb='kb', dict='dict', emb='emb_ntee',
+                 client=None):
+        self.client = client or MongoClient(host=host, port=port)
+        self.db_kb = self.client[kb]
+        self.db_dict = self.client[dict]
+        self.db_emb = self.client[emb]
+        self.compiled = {}
+
+    def find_mention(self, mention, n):
+        query = {'mention': mention}
+        projection = {'_id': 0, 'entities': {'$slice': n+1}}
+        response = self.db_kb['mention_table'].find_one(query, projection)
+        if response:
+            return response['entities']
+        return None
+
+    def find_mentions(self, mentions, n):
+        res = {}
+        query = {'mention': {'$in': list(set(mentions))}}
+        projection = {'_id': 0, 'mention': 1, 'entities': {'$slice': n+1}}
+        for response in self.db_kb['mention_table'].find(query, projection):
+            res[response['mention']] = response['entities']
+        return res
+
+    def iter_mentions(self):
+        projection = {'_id': 0, 'mention': 1}
+        for response in self.db_kb['mention_table'].find({}, projection):
+            yield response['mention']
+
+    def find_etype(self, kbid):
+        response = self.db_kb['etypes'].find_one({'kbid': kbid})
+        if response:
+            return response['etype']
+        return None
+
+    def find_etypes(self, kbids):
+        res = {}
+        query = {'kbid': {'$in': list(set(kbids))}}
+        projection = {'_id': 0, 'kbid': 1, 'etype': 1}
+        for response in self.db_kb['etypes'].find(query, projection):
+            res[response['kbid']] = response['etype']
+        return res
+
+    def find_vector(self, collection, item):
+        response = self.db_emb[collection].find_one({'item': item})
+        if response:
+            return cPickle.loads(response['vector'])
+        return None
+
+    def find_vectors(self, collection, items):
+        res = {}
+        query = {'item': {'$in': list(set(items))}}
+        for response in self.db_emb[collection].find(query):
+            res[response['item']] = cPickle.loads(response['vector'])
+        return res
+
+    def get_misc(self, item):
+        return cPickle.loads(self.db_emb['misc'].find_one({'item': item})
+                             ['vector'])
+
+    def find_translations(self, text, lang):
+        '''
+        (gloss, priority) of every dictionary entry of text.
+        '''
+        response = self.db_dict[lang].find({'lemma': text})
+        return [(i['gloss'], i['priority']) for i in response]
+
+    def has_glosses(self, lang):
+        if lang not in self.compiled:
+            names = self.db_dict.list_collection_names()
+            self.compiled[lang] = GLOSSES % lang in names
+        return self.compiled[lang]
+
+    def find_glosses(self, texts, lang):
+        '''
+        {text: ranked glosses} for the texts found in the dictionary of
+        lang, read from the compiled <lang>.glosses collection if any.
+        '''
+        query = {'lemma': {'$in': list(set(texts))}}
+        if self.has_glosses(lang):
+            return {i['lemma']: i['glosses']
+                    for i in self.db_dict[GLOSSES % lang].find(query)}
+        rows = ((i['lemma'], i['gloss'], i['priority'])
+                for i in self.db_dict[lang].find(query))
+        return {lemma: rank_glosses(entries)
+                for lemma, entries in group_entries(rows).items()}
+
+    def iter_glosses(self, lang):
+        '''
+        (lemma, ranked glosses) of the whole dictionary of lang.
+        '''
+        if self.has_glosses(lang):
+            for i in self.db_dict[GLOSSES % lang].find():
+                yield i['lemma'], i['glosses']
+            return
+        rows = ((i['lemma'], i['gloss'], i['priority'])
+                for i in self.db_dict[lang].find())
+        for lemma, entries in group_entries(rows).items():
+            yield lemma, rank_glosses(entries)
+
+    def compile_glosses(self, lang, batch_size=10000):
+        '''
+        Write the ranked glosses of every lemma of lang to <lang>.glosses.
+        '''
+        self.compiled[lang] = False
+        collection = self.db_dict[GLOSSES % lang]
+        collection.drop()
+        batch = []
+        n = 0
+        for lemma, glosses in self.iter_glosses(lang):
+            batch.append({'lemma': lemma, 'glosses': glosses})
+            if len(batch) == batch_size:
+                collection.insert_many(batch)
+                n += len(batch)
+                batch = []
+        if batch:
+            collection.insert_many(batch)
+            n += len(batch)
+        collection.create_index('lemma')
+        self.compiled[lang] = True
+        return n
+
+    def languages(self):
+        return [i for i in self.db_dict.list_collection_names()
+                if not i.endswith(GLOSSES % '')]
+
+
+class SQLiteKB(object):
+    '''
+    Read-only knowledge base compiled into a single SQLite file by
+    build_sqlite_kb. Vectors are stored as raw float32 bytes.
+    '''
+
+    # Bound parameters per statement, below SQLITE_MAX_VARIABLE_NUMBER
+    CHUNK = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self._has_glosses = None
+
+    @property
+    def conn(self):
+        # sqlite3 connections can not be shared between threads
+        if not hasattr(self.local, 'conn'):
+            uri = 'file:%s?mode=ro' % self.path
+            self.local.conn = sqlite3.connect(uri, uri=True)
+        return self.local.conn
+
+    def _find_one(self, sql, key):
+        row = self.conn.execute(sql, (key,)).fetchone()
+        return row[0] if row else None
+
+    def _find_many(self, sql, keys, params=()):
+        keys = list(set(keys))
+        for i in range(0, len(keys), self.CHUNK):
+            chunk = keys[i:i+self.CHUNK]
+            query = sql % ','.join('?' * len(chunk))
+            for row in self.conn.execute(query, list(params) + chunk):
+                yield row
+
+    def find_mention(self, mention, n):
+        sql = 'SELECT entities FROM mention_table WHERE mention = ?'
+        entities = self._find_one(sql, mention)
+        if entities is None:
+            return None
+        return json.loads(entities)[:n+1]
+
+    def find_mentions(self, mentions, n):
+        sql = 'SELECT mention, entities FROM mention_table ' \
+              'WHERE mention IN (%s)'
+        return {mention: json.loads(entities)[:n+1]
+                for mention, entities in self._find_many(sql, mentions)}
+
+    def iter_mentions(self):
+        for row in self.conn.execute('SELECT mention FROM mention_table'):
+            yield row[0]
+
+    def find_etype(self, kbid):
+        return self._find_one('SELECT etype FROM etypes WHERE kbid = ?', kbid)
+
+    def find_etypes(self, kbids):
+        sql = 'SELECT kbid, etype FROM etypes WHERE kbid IN (%s)'
+        return dict(self._find_many(sql, kbids))
+
+    def find_vector(self, collection, item):
+        assert collection in VECTOR_COLLECTIONS
+        sql = 'SELECT vector FROM %s WHERE item = ?' % collection
+        vector = self._find_one(sql, item)
+        if vector is None:
+            return None
+        return np.frombuffer(vector, dtype=np.float32)
+
+    def find_vectors(self, collection, items):
+        assert collection in VECTOR_COLLECTIONS
+        sql = 'SELECT item, vector FROM %s WHERE item IN (%%s)' % collection
+        return {item: np.frombuffer(vector, dtype=np.float32)
+                for item, vector in self._find_many(sql, items)}
+
+    def get_misc(self, item):
+        sql = 'SELECT vector FROM misc WHERE item = ?'
+        return np.load(io.BytesIO(self._find_one(sql, item)))
+
+    def find_translations(self, text, lang):
+        sql = 'SELECT gloss, priority FROM dict WHERE lang = ? AND lemma = ?'
+        return self.conn.execute(sql, (lang, text)).fetchall()
+
+    def has_glosses(self, lang):
+        # False for files compiled before the glosses table was added
+        if self._has_glosses is None:
+            sql = 'SELECT 1 FROM sqlite_master WHERE name = ?'
+            self._has_glosses = self._find_one(sql, 'glosses') is not None
+        return self._has_glosses
+
+    def find_glosses(self, texts, lang):
+        if self.has_glosses(lang):
+            sql = 'SELECT lemma, glosses FROM glosses ' \
+                  'WHERE lang = ? AND lemma IN (%s)'
+            return {lemma: json.loads(glosses) for lemma, glosses
+                    in self._find_many(sql, texts, (lang,))}
+        sql = 'SELECT lemma, gloss, priority FROM dict ' \
+              'WHERE lang = ? AND lemma IN (%s) ORDER BY rowid'
+        rows = self._find_many(sql, texts, (lang,))
+        return {lemma: rank_glosses(entries)
+                for lemma, entries in group_entries(rows).items()}
+
+    def iter_glosses(self, lang):
+        if self.has_glosses(lang):
+            sql = 'SELECT lemma, glosses FROM glosses WHERE lang = ?'
+            for lemma, glosses in self.conn.execute(sql, (lang,)):
+                yield lemma, json.loads(glosses)
+            return
+        sql = 'SELECT lemma, gloss, priority FROM dict WHERE lang = ? ' \
+              'ORDER BY rowid'
+        rows = self.conn.execute(sql, (lang,))
+        for lemma, entries in group_entries(rows).items():
+            yield lemma, rank_glosses(entries)
+
+    def languages(self):
+        sql = 'SELECT DISTINCT lang FROM dict'
+        return [row[0] for row in self.conn.execute(sql)]
+
+
+def build_sqlite_kb(mongo_kb, path, batch_size=10000):
+    '''
+    Compile the MongoDB collections of mongo_kb into a SQLite file.
+    '''
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE mention_table (mention TEXT PRIMARY KEY, entities TEXT)
+            WITHOUT ROWID;
+        CREATE TABLE etypes (kbid TEXT PRIMARY KEY, etype TEXT)
+            WITHOUT ROWID;
+        CREATE TABLE entity_embeddings (item TEXT PRIMARY KEY, vector BLOB)
+            WITHOUT ROWID;
+        CREATE TABLE word_embeddings (item TEXT PRIMARY KEY, vector BLOB)
+            WITHOUT ROWID;
+        CREATE TABLE misc (item TEXT PRIMARY KEY, vector BLOB)
+            WITHOUT ROWID;
+        CREATE TABLE dict (lang TEXT, lemma TEXT, gloss TEXT,
+                           priority NUMERIC);
+        CREATE TABLE glosses (lang TEXT, lemma TEXT, glosses TEXT,
+                              PRIMARY KEY (lang, lemma)) WITHOUT ROWID;
+    ''')
+
+    def insert(sql, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                conn.executemany(sql, batch)
+                batch = []
+        conn.executemany(sql, batch)
+
+    db_kb, db_emb, db_dict = mongo_kb.db_kb, mongo_kb.db_emb, mongo_kb.db_dict
+    insert('INSERT OR REPLACE INTO mention_table VALUES (?, ?)',
+           ((i['mention'], json.dumps(i['entities']))
+            for i in db_kb['mention_table'].find()))
+    insert('INSERT OR REPLACE INTO etypes VALUES (?, ?)',
+           ((i['kbid'], i['etype']) for i in db_kb['etypes'].find()))
+    for collection in VECTOR_COLLECTIONS:
+        sql = 'INSERT OR REPLACE INTO %s VALUES (?, ?)' % collection
+        insert(sql, ((i['item'], cPickle.loads(i['vector'])
+                      .astype(np.float32).tobytes())
+                     for i in db_emb[collection].find()))
+    for i in db_emb['misc'].find():
+        buf = io.BytesIO()
+        np.save(buf, cPickle.loads(i['vector']))
+        conn.execute('INSERT OR REPLACE INTO misc VALUES (?, ?)',
+                     (i['item'], buf.getvalue()))
+    for lang in mongo_kb.languages():
+        insert('INSERT INTO dict VALUES (?, ?, ?, ?)',
+               ((lang, i['lemma'], i['gloss'], i['priority'])
+                for i in db_dict[lang].find()))
+        # Ranked glosses precomputed per lemma
+        insert('INSERT INTO glosses VALUES (?, ?, ?)',
+               ((lang, lemma, json.dumps(glosses))
+                for lemma, glosses in mongo_kb.iter_glosses(lang)))
+    conn.execute('CREATE INDEX dict_lang_lemma ON dict (lang, lemma)')
+    conn.commit()
+    conn.close()
+
+
+def get_mongo_kb(config):
+    return MongoKB(config.get('mongodb', 'host'),
+                   config.getint('mongodb', 'port'),
+                   kb=config.get('mongodb', 'kb'),
+                   dict=config.get('mongodb', 'dict'),
+                   emb=config.get('mongodb', 'emb'))
+
+
+def open_kb(config):
+    '''
+    KB backend selected by the [kb] section of config.
+    '''
+    backend = config.get('kb', 'backend', fallback='mongodb')
+    if backend == 'sqlite':
+        return SQLiteKB(config.get('kb', 'path'))
+    elif backend == 'mongodb':
+        return get_mongo_kb(config)
+    raise ValueError('Unknown KB backend: %s' % backend)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('USAGE: <OUTPUT SQLITE PATH>')
+        sys.exit()
+    from edl.engine import get_engine
+    build_sqlite_kb(get_mongo_kb(get_engine().config), sys.argv[1])
+    print('KB compiled to %s' % sys.argv[1])
@@ -1,27 +1,68 @@
-import functools
-from configparser import ConfigParser
-from collections import defaultdict
-from pymongo import MongoClient
+'''
+Glosses of non-English mentions from the dictionary of their language,
+ranked by total priority. Run
 
+    python -m edl.translator [<LANG> ...]
 
-config_path = 'global.conf'
-config = ConfigParser()
-config.read(config_path)
-host = config.get('mongodb', 'host')
-port = config.getint('mongodb', 'port')
-db_name = config.get('mongodb', 'dict')
-client = MongoClient(host=host, port=port)
-db = client[db_name]
+to precompute the ranked glosses of every lemma into the <lang>.glosses
+collections of the dict database, and list high-traffic languages in
+[translation] preload to serve them from memory.
+'''
+import sys
+from edl import metrics
+from edl import storage
+from edl.engine import Engine, get_engine, cached
 
 
-@functools.lru_cache(maxsize=None)
+@metrics.timed('translation')
+@cached('get_translation')
 def get_translation(text, lang):
-    query = {'lemma': text}
-    collection = db[lang]
-    response = collection.find(query)
-    count = defaultdict(int)
-    for i in response:
-        count[i['gloss']] += i['priority']
-    res = [i for i, c in sorted(count.items(),
-                                key=lambda x: x[1], reverse=True)]
+    engine = get_engine()
+    glossary = engine.glossary(lang)
+    if glossary is not None:
+        return list(glossary.get(text, ()))
+    return storage.rank_glosses(engine.kb.find_translations(text, lang))
+
+
+@metrics.timed('translation')
+def get_translations(texts, lang):
+    '''
+    {text: glosses} for all texts, e.g. the mentions of a document. The
+    texts missing from the get_translation cache are looked up in one
+    query.
+    '''
+    engine = get_engine()
+    cache = get_translation.get_cache()
+    res = {}
+    missing = []
+    for text in texts:
+        if text in res:
+            continue
+        value = cache.get((text, lang), None)
+        if value is None:
+            missing.append(text)
+            res[text] = None
+        else:
+            res[text] = value
+    if not missing:
+        return res
+
+    glossary = engine.glossary(lang)
+    if glossary is None:
+        found = engine.kb.find_glosses(missing, lang)
+    else:
+        found = glossary
+    for text in missing:
+        value = list(found.get(text, ()))
+        cache.put((text, lang), value)
+        res[text] = value
     return res
+
+
+if __name__ == '__main__':
+    if '-h' in sys.argv[1:] or '--help' in sys.argv[1:]:
+        print('USAGE: [<LANG> ...], default: every language')
+        sys.exit()
+    kb = storage.get_mongo_kb(Engine().config)
+    for lang in sys.argv[1:] or kb.languages():
+        print('%s: %s lemmas' % (lang, kb.compile_glosses(lang)))
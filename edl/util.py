@@ -1,7 +1,10 @@
+import io
 import re
+import bisect
 import ujson as json
 import logging
 from edl.models.text import EntityMention, NominalMention, Entity
+from edl.models.batch import MentionBatch
 
 
 logger = logging.getLogger()
@@ -10,88 +13,118 @@ logging.root.setLevel(level=logging.INFO)
 
 
 def read_tac_bio_format(data):
+    return list(iter_tac_bio_format(data))
+
+
+def iter_tac_bio_format(data):
+    '''
+    Yield the entity mentions of BIO data one sentence at a time, data is
+    a string or an iterable of lines such as an open file.
+    '''
+    if isinstance(data, str):
+        data = io.StringIO(data)
+    sent = []
+    for line in data:
+        line = line.rstrip('\r\n')
+        if line.strip():
+            sent.append(line)
+        elif sent:
+            yield from read_tac_bio_sentence(sent)
+            sent = []
+    if sent:
+        yield from read_tac_bio_sentence(sent)
+
+
+def read_tac_bio_batch(data):
+    '''
+    The entity mentions of BIO data as a MentionBatch.
+    '''
+    batch = MentionBatch()
+    for em in iter_tac_bio_format(data):
+        batch.append(em)
+    return batch
+
+
+def read_tac_bio_sentence(sent):
     res = []
-    data = re.split('\n\s*\n', data)
-    for d in data:
-        sent_mentions = []
-        sent_context = []
-        sent = d.split('\n')
-        curr_mention = []
-        for i, line in enumerate(sent):
-            if not line:
-                continue
+    sent_mentions = []
+    sent_context = []
+    curr_mention = []
+    for i, line in enumerate(sent):
+        if not line:
+            continue
 
-            ann = line.split(' ')
-            assert len(ann) >= 3
-            tok = ann[0]
-            offset = ann[1]
-            if ann[-1] == 'O':
-                tag, etype = ('O', None)
+        ann = line.split(' ')
+        assert len(ann) >= 3
+        tok = ann[0]
+        offset = ann[1]
+        if ann[-1] == 'O':
+            tag, etype = ('O', None)
+        else:
+            tag, etype = ann[-1].split('-')
+
+        if tag == 'O':
+            if curr_mention:
+                sent_mentions.append(curr_mention)
+                curr_mention = []
+        elif tag ==  'B':
+            if curr_mention:
+                sent_mentions.append(curr_mention)
+            curr_mention = [(tok, offset, etype)]
+        elif tag == 'I':
+            try:
+                assert curr_mention != []
+            except AssertionError:
+                msg = 'No B-tag: %s, skip this tag' % line
+                logger.warning(msg)
+            curr_mention.append((tok, offset, etype))
+        if i == len(sent) - 1 and curr_mention:
+            sent_mentions.append(curr_mention)
+
+        sent_context.append(tok)
+
+    for i, mention in enumerate(sent_mentions):
+        mention_text = ''
+        mention_text_tok = []
+        mention_etype = None
+        mention_beg_char = 0
+        mention_end_char = 0
+        mention_docid = None
+        for j, (text, offset, etype) in enumerate(mention):
+            m = re.match('(.+):(\d+)-(\d+)', offset)
+            docid = m.group(1)
+            tok_beg_char = int(m.group(2))
+            tok_end_char = int(m.group(3))
+            if j == 0:
+                mention_text += text
+                mention_text_tok.append(text)
+                mention_beg_char = int(tok_beg_char)
             else:
-                tag, etype = ann[-1].split('-')
-
-            if tag == 'O':
-                if curr_mention:
-                    sent_mentions.append(curr_mention)
-                    curr_mention = []
-            elif tag ==  'B':
-                if curr_mention:
-                    sent_mentions.append(curr_mention)
-                curr_mention = [(tok, offset, etype)]
-            elif tag == 'I':
+                space = ' ' * (int(tok_beg_char)-int(mention_end_char)-1)
+                mention_text += space + text
+                mention_text_tok.append(text)
+            mention_end_char = int(tok_end_char)
+            if mention_etype:
                 try:
-                    assert curr_mention != []
+                    assert mention_etype == etype
                 except AssertionError:
-                    msg = 'No B-tag: %s, skip this tag' % line
+                    msg = 'Unconsistent entity type: %s %s %s, ' \
+                          'use the latest one' % (text, offset, etype)
                     logger.warning(msg)
-                curr_mention.append((tok, offset, etype))
-            if i == len(sent) - 1 and curr_mention:
-                sent_mentions.append(curr_mention)
-
-            sent_context.append(tok)
-
-        for i, mention in enumerate(sent_mentions):
-            mention_text = ''
-            mention_text_tok = []
-            mention_etype = None
-            mention_beg_char = 0
-            mention_end_char = 0
-            mention_docid = None
-            for j, (text, offset, etype) in enumerate(mention):
-                m = re.match('(.+):(\d+)-(\d+)', offset)
-                docid = m.group(1)
-                tok_beg_char = int(m.group(2))
-                tok_end_char = int(m.group(3))
-                if j == 0:
-                    mention_text += text
-                    mention_text_tok.append(text)
-                    mention_beg_char = int(tok_beg_char)
-                else:
-                    space = ' ' * (int(tok_beg_char)-int(mention_end_char)-1)
-                    mention_text += space + text
-                    mention_text_tok.append(text)
-                mention_end_char = int(tok_end_char)
-                if mention_etype:
-                    try:
-                        assert mention_etype == etype
-                    except AssertionError:
-                        msg = 'Unconsistent entity type: %s %s %s, ' \
-                              'use the latest one' % (text, offset, etype)
-                        logger.warning(msg)
-                mention_etype = etype
-                if mention_docid:
-                    assert mention_docid == docid
-                mention_docid = docid
-            assert len(mention_text) == (mention_end_char -
-                                         mention_beg_char) + 1
-
-            res.append(EntityMention(mention_text,
-                                     beg=mention_beg_char,
-                                     end=mention_end_char,
-                                     text_tok=mention_text_tok,
-                                     docid=mention_docid,
-                                     context=sent_context,
-                                     etype=mention_etype))
+            mention_etype = etype
+            if mention_docid:
+                assert mention_docid == docid
+            mention_docid = docid
+        assert len(mention_text) == (mention_end_char -
+                                     mention_beg_char) + 1
+
+        res.append(EntityMention(mention_text,
+                                 beg=mention_beg_char,
+                                 end=mention_end_char,
+                                 text_tok=mention_text_tok,
+                                 docid=mention_docid,
+                                 context=sent_context,
+                                 etype=mention_etype))
     return res
 
 
@@ -133,6 +166,9 @@ def read_tac_tab_format(pdata, read_trans=None):
 
 
 def get_tac_tab_format(entitymentions, add_trans=False, kbid_format='kbid'):
+    if isinstance(entitymentions, MentionBatch):
+        assert kbid_format == 'kbid'
+        return entitymentions.to_tac_tab_format(add_trans=add_trans)
     res = []
     for em in entitymentions:
         res.append(em.to_tac_tab_format(add_trans=add_trans,
@@ -152,13 +188,17 @@ def get_tac_tab_format_corpus(corpus, add_trans=False, kbid_format='kbid'):
     return res
 
 
-def add_tac_runid_and_mid(tab, runid, mid_prefix):
-    count = 0
+def add_tac_runid_and_mid(tab, runid, mid_prefix, start=0):
+    '''
+    Mention ids are numbered from start, returns the next unused number.
+    '''
+    count = start
     for n in range(len(tab)):
         menid = '{}_MENTION_'.format(mid_prefix.replace(' ', '_')) + \
                 '{number:0{width}d}'.format(width=7, number=count)
         tab[n] = [runid, menid] + tab[n]
         count += 1
+    return count
 
 
 def read_corenlp_json_format(pdata, docid=None, lang='eng'):
@@ -206,20 +246,57 @@ def get_entitymention_offset_table(entitymentions):
     return res
 
 
-def align_corenlp_coref_with_entitymention(coref, em_offset_table, sentences):
+class OffsetIndex(object):
+    '''
+    Entity mentions of a document by (beg, end) character offsets, with
+    exact lookups and a sorted index of the mentions covering a character.
+    '''
+
+    def __init__(self, entitymentions):
+        self.table = get_entitymention_offset_table(entitymentions)
+        offsets = sorted(self.table)
+        self.begs = [beg for beg, _ in offsets]
+        # Largest end of the mentions starting before each position
+        self.max_ends = []
+        max_end = None
+        for _, end in offsets:
+            if max_end is None or end > max_end:
+                max_end = end
+            self.max_ends.append(max_end)
+
+    def get(self, beg, end):
+        return self.table.get((beg, end))
+
+    def covers(self, char):
+        '''
+        Whether a mention spans char, beg <= char <= end.
+        '''
+        i = bisect.bisect_right(self.begs, char)
+        return i > 0 and self.max_ends[i - 1] >= char
+
+
+def get_corenlp_coref_offsets(coref, sentences):
+    '''
+    (mention, char_beg, char_end) of each mention of a coref chain.
+    '''
+    res = []
     for c in coref:
-        sent_num = c['sentNum'] - 1
-        tok_beg = c['startIndex'] - 1
-        tok_end = c['endIndex'] - 1
-        toks = sentences[sent_num]['tokens'][tok_beg:tok_end]
-        char_beg = toks[0]['characterOffsetBegin']
-        char_end = toks[-1]['characterOffsetEnd'] - 1
-        if (char_beg, char_end) in em_offset_table:
-            return em_offset_table[(char_beg, char_end)]
+        tokens = sentences[c['sentNum'] - 1]['tokens']
+        char_beg = tokens[c['startIndex'] - 1]['characterOffsetBegin']
+        char_end = tokens[c['endIndex'] - 2]['characterOffsetEnd'] - 1
+        res.append((c, char_beg, char_end))
+    return res
+
+
+def align_corenlp_coref_with_entitymention(offsets, em_index):
+    for _, char_beg, char_end in offsets:
+        em = em_index.get(char_beg, char_end)
+        if em:
+            return em
     return False
 
 
-def find_valid_corenlp_coref(coref, em_offset_table, sentences):
+def find_valid_corenlp_coref(offsets, em_index):
     '''
       1. coref should not be entitymention
       2. coref shoudl not overlap with entitymention
@@ -231,16 +308,10 @@ def find_valid_corenlp_coref(coref, em_offset_table, sentences):
         # 'PRONOMINAL': 'PRO'
     }
     res = []
-    for c in coref:
-        sent_num = c['sentNum'] - 1
-        tok_beg = c['startIndex'] - 1
-        tok_end = c['endIndex'] - 1
-        toks = sentences[sent_num]['tokens'][tok_beg:tok_end]
-        char_beg = toks[0]['characterOffsetBegin']
-        char_end = toks[-1]['characterOffsetEnd'] - 1
-        if (char_beg, char_end) in em_offset_table:
+    for c, char_beg, char_end in offsets:
+        if em_index.get(char_beg, char_end):
             continue
-        if any(beg <= char_beg <= end for (beg, end) in em_offset_table.keys()):
+        if em_index.covers(char_beg):
             continue
         if c['type'] not in MTYPES:
             continue
@@ -255,17 +326,15 @@ def add_corenlp_nominalmentions(entitymentions, corenlp_res):
         'entitymention': 0,
         'nominalmention': 0
     }
-    em_offset_table = get_entitymention_offset_table(entitymentions)
+    em_index = OffsetIndex(entitymentions)
     sentences = corenlp_res['sentences']
     corefs = corenlp_res['corefs'] if 'corefs' in corenlp_res else []
     for i in corefs:
-        aligned_em = align_corenlp_coref_with_entitymention(corefs[i],
-                                                            em_offset_table,
-                                                            sentences)
+        offsets = get_corenlp_coref_offsets(corefs[i], sentences)
+        aligned_em = align_corenlp_coref_with_entitymention(offsets,
+                                                            em_index)
         if aligned_em:
-            nominalmentions = find_valid_corenlp_coref(corefs[i],
-                                                       em_offset_table,
-                                                       sentences)
+            nominalmentions = find_valid_corenlp_coref(offsets, em_index)
             if nominalmentions:
                 count['entitymention'] += 1
             for nm in nominalmentions:
@@ -1,56 +1,136 @@
-import functools
-from configparser import ConfigParser
-from pymongo import MongoClient
-import _pickle as cPickle
 import numpy as np
+from edl import metrics
+from edl.engine import get_engine, cached
 
 
-config_path = 'global.conf'
-config = ConfigParser()
-config.read(config_path)
-host = config.get('mongodb', 'host')
-port = config.getint('mongodb', 'port')
-db_name = config.get('mongodb', 'emb')
-client = MongoClient(host=host, port=port)
-db = client[db_name]
-collection_entity_emb = db['entity_embeddings']
-collection_word_emb = db['word_embeddings']
-_W = cPickle.loads(db['misc'].find_one({'item': 'W'})['vector'])
-_b = cPickle.loads(db['misc'].find_one({'item': 'b'})['vector'])
+def get_word_vector(word):
+    word_emb = get_engine().word_emb
+    if word_emb is not None:
+        return word_emb.get(word)
+    return _get_word_vector(word)
 
 
-@functools.lru_cache(maxsize=None)
-def get_word_vector(word):
-    query = {'item': word}
-    response = collection_word_emb.find_one(query)
-    if response:
-        return cPickle.loads(response['vector'])
-    return None
+@cached('get_word_vector')
+def _get_word_vector(word):
+    return get_engine().kb.find_vector('word_embeddings', word)
 
 
-@functools.lru_cache(maxsize=None)
 def get_entity_vector(kbid):
-    query = {'item': 'en.wikipedia.org/wiki/%s' % kbid}
-    response = collection_entity_emb.find_one(query)
-    if response:
-        return cPickle.loads(response['vector'])
-    return None
+    entity_emb = get_engine().entity_emb
+    if entity_emb is not None:
+        return entity_emb.get('en.wikipedia.org/wiki/%s' % kbid)
+    return _get_entity_vector(kbid)
+
+
+@cached('get_entity_vector')
+def _get_entity_vector(kbid):
+    item = 'en.wikipedia.org/wiki/%s' % kbid
+    return get_engine().kb.find_vector('entity_embeddings', item)
+
+
+def _get_cached(cache, keys, res):
+    '''
+    Copy cached vectors of keys into res, returns the keys not cached.
+    '''
+    missing = set()
+    for key in keys:
+        vec = cache.get((key,), missing)
+        if vec is missing:
+            missing.add(key)
+        elif vec is not None:
+            res[key] = vec
+    return missing
+
+
+def _put_cached(cache, keys, res):
+    for key in keys:
+        cache.put((key,), res.get(key))
 
 
-@functools.lru_cache(maxsize=None)
+@metrics.timed('entity_vectors')
+def get_entity_vectors(kbids):
+    res = {}
+    items = {'en.wikipedia.org/wiki/%s' % kbid: kbid for kbid in set(kbids)}
+    entity_emb = get_engine().entity_emb
+    if entity_emb is not None:
+        for item, kbid in items.items():
+            vec = entity_emb.get(item)
+            if vec is not None:
+                res[kbid] = vec
+        return res
+    missing = _get_cached(_get_entity_vector.get_cache(), items.values(), res)
+    if not missing:
+        return res
+    items = {item: kbid for item, kbid in items.items() if kbid in missing}
+    found = get_engine().kb.find_vectors('entity_embeddings', items)
+    for item, vec in found.items():
+        res[items[item]] = vec
+    _put_cached(_get_entity_vector.get_cache(), missing, res)
+    return res
+
+
+@metrics.timed('word_vectors')
+def get_word_vectors(words):
+    res = {}
+    words = set(words)
+    word_emb = get_engine().word_emb
+    if word_emb is not None:
+        for word in words:
+            vec = word_emb.get(word)
+            if vec is not None:
+                res[word] = vec
+        return res
+    missing = _get_cached(_get_word_vector.get_cache(), words, res)
+    if not missing:
+        return res
+    res.update(get_engine().kb.find_vectors('word_embeddings', missing))
+    _put_cached(_get_word_vector.get_cache(), missing, res)
+    return res
+
+
+@cached('get_text_vector')
 def get_text_vector(text):
     if not text:
         return None
-    vectors = []
-    for i in text:
-        vec = get_word_vector(i.lower())
-        if vec is not None:
-            vectors.append(vec)
-    if not vectors:
+    ret = get_text_vectors([text])[0]
+    if not ret.any():
         return None
+    return ret
+
+
+@metrics.timed('text_vectors')
+def get_text_vectors(texts):
+    '''
+    Text vectors of a batch of token sequences as one (len(texts), dim)
+    matrix, with a zero row for texts that have no known word.
+    '''
+    engine = get_engine()
+    word_emb = engine.word_emb
+    tokens = [[i.lower() for i in text] for text in texts]
+    if word_emb is not None:
+        rows = [word_emb.rows(toks) for toks in tokens]
+        rows = [r[r >= 0] for r in rows]
+        take = word_emb.take
+    else:
+        known = get_word_vectors(i for toks in tokens for i in toks)
+        words = {word: n for n, word in enumerate(known)}
+        rows = [np.array([words[i] for i in toks if i in words],
+                         dtype=np.int64) for toks in tokens]
+        vectors = np.array(list(known.values())).reshape(len(words),
+                                                         engine.W.shape[0])
+        take = vectors.__getitem__
 
-    ret = np.mean(vectors, axis=0)
-    ret = np.dot(ret, _W)
-    ret += _b
-    ret /= np.linalg.norm(ret, 2)
+    counts = np.array([len(r) for r in rows])
+    ret = np.zeros((len(texts), engine.W.shape[1]), dtype=np.float32)
+    found = np.flatnonzero(counts)
+    if not len(found):
+        return ret
+    # One gather, segment means, then a single GEMM for the whole batch
+    gathered = take(np.concatenate([rows[i] for i in found]))
+    starts = np.concatenate([[0], np.cumsum(counts[found])[:-1]])
+    means = np.add.reduceat(gathered, starts, axis=0) / counts[found, None]
+    means = means.astype(gathered.dtype)
+    projected = np.dot(means, engine.W) + engine.b
+    projected /= np.linalg.norm(projected, 2, axis=1, keepdims=True)
+    ret[found] = projected
     return ret
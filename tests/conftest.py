@@ -0,0 +1,101 @@
+import os
+import sys
+import random
+import _pickle as cPickle
+import numpy as np
+import pytest
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from edl import storage
+from edl.engine import Engine
+
+
+DIM = 8
+WORDS = ['w%d' % i for i in range(300)]
+KBIDS = ['E%d' % i for i in range(200)]
+MENTIONS = ['mention %d' % i for i in range(100)]
+ETYPES = ['PER', 'ORG', 'GPE']
+
+
+def populate(client):
+    '''
+    A small KB: some entities have no type or no vector, some words have
+    no vector, every zh lemma has a few glosses.
+    '''
+    rng = random.Random(0)
+    nrng = np.random.RandomState(0)
+
+    def vector(*shape):
+        return cPickle.dumps(nrng.randn(*shape).astype(np.float32))
+
+    db_emb = client['emb_ntee']
+    db_emb['misc'].insert_many([{'item': 'W', 'vector': vector(DIM, DIM)},
+                                {'item': 'b', 'vector': vector(DIM)}])
+    db_emb['word_embeddings'].insert_many(
+        [{'item': w, 'vector': vector(DIM)} for w in WORDS[:250]])
+    db_emb['entity_embeddings'].insert_many(
+        [{'item': 'en.wikipedia.org/wiki/%s' % kbid, 'vector': vector(DIM)}
+         for kbid in KBIDS[:180]])
+    db_kb = client['kb']
+    db_kb['etypes'].insert_many([{'kbid': kbid, 'etype': rng.choice(ETYPES)}
+                                 for kbid in KBIDS[:190]])
+    db_kb['mention_table'].insert_many(
+        [{'mention': m,
+          'entities': [[kbid, rng.random()]
+                       for kbid in rng.sample(KBIDS, rng.randint(1, 15))]}
+         for m in MENTIONS])
+    client['dict']['zh'].insert_many(
+        [{'lemma': 'z%d' % i, 'gloss': rng.choice(MENTIONS),
+          'priority': rng.randint(1, 5)} for i in range(60) for _ in range(3)])
+
+
+@pytest.fixture(scope='session')
+def kb():
+    mongomock = pytest.importorskip('mongomock')
+    client = mongomock.MongoClient()
+    populate(client)
+    return storage.MongoKB(None, None, client=client)
+
+
+@pytest.fixture
+def engine(kb):
+    '''
+    An engine on the test KB with empty caches.
+    '''
+    with Engine(kb=kb) as engine:
+        yield engine
+
+
+@pytest.fixture
+def make_bio():
+    '''
+    make_bio(n_sentences, docid, lang): BIO data with repeated mentions,
+    a few unknown ones, and zh lemmas for lang='zh'.
+    '''
+    rng = random.Random(1)
+
+    def make_bio(n_sentences=20, docid='DOC', lang='en'):
+        lines = []
+        offset = 0
+        for _ in range(n_sentences):
+            for _ in range(rng.randint(5, 15)):
+                if rng.random() < 0.2:
+                    if lang == 'zh':
+                        tokens = ['z%d' % rng.randint(0, 70)]
+                    else:
+                        tokens = ('mention %d' %
+                                  rng.randint(0, 110)).split()
+                    etype = rng.choice(ETYPES)
+                    tags = ['B-' + etype] + \
+                           ['I-' + etype] * (len(tokens) - 1)
+                else:
+                    tokens = [rng.choice(WORDS + ['oov'])]
+                    tags = ['O']
+                for token, tag in zip(tokens, tags):
+                    lines.append('%s %s:%d-%d %s' %
+                                 (token, docid, offset,
+                                  offset + len(token) - 1, tag))
+                    offset += len(token) + 1
+            lines.append('')
+        return '\n'.join(lines)
+    return make_bio
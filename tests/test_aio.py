@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import pytest
+from conftest import ROOT
+pytest.importorskip('quart')
+sys.path.insert(0, os.path.join(ROOT, 'edl', 'api'))
+import aio
+import api
+
+
+def test_linking_coalesced(engine, monkeypatch):
+    calls = []
+    lock = threading.Lock()
+
+    def process_mention(mention, lang='en', etype=None):
+        with lock:
+            calls.append((mention, lang, etype))
+        time.sleep(0.2)
+        return {'mention': mention}
+    monkeypatch.setattr(api, 'process_mention', process_mention)
+
+    async def run():
+        client = aio.app.test_client()
+        urls = ['/linking?mention=a&lang=en'] * 8 + \
+               ['/linking?mention=b&lang=en'] * 4
+        responses = await asyncio.gather(*[client.get(i) for i in urls])
+        return [await i.get_json() for i in responses]
+    res = asyncio.run(run())
+    assert sorted(calls) == [('a', 'en', None), ('b', 'en', None)]
+    assert res == [{'mention': 'a'}] * 8 + [{'mention': 'b'}] * 4
+    assert not aio.inflight
+
+
+def test_linking_bio(engine, make_bio):
+    bio = make_bio(30)
+    expected = api.process_bio(bio, 'en')
+
+    async def run():
+        client = aio.app.test_client()
+        res = []
+        response = await client.post('/linking_bio',
+                                     form={'bio_str': bio, 'lang': 'en'})
+        res.append(await response.get_data(as_text=True))
+        response = await client.post('/linking_bio?lang=en', data=bio)
+        res.append(await response.get_data(as_text=True))
+        response = await client.post('/linking_bio?lang=en&timing=1',
+                                     data=bio)
+        res.append(await response.get_data(as_text=True))
+        return res, response.headers
+    res, headers = asyncio.run(run())
+    assert res == [expected] * 3
+    # Stages run on the thread pool are timed
+    assert 'tab_format' in headers['Server-Timing']
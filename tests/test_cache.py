@@ -0,0 +1,88 @@
+import random
+from collections import OrderedDict
+import numpy as np
+import pytest
+from edl.cache import Cache, approx_size, parse_limit
+
+
+def test_lru_eviction():
+    rng = random.Random(0)
+    cache = Cache('test', maxsize=10)
+    reference = OrderedDict()
+    for _ in range(2000):
+        key = rng.randrange(30)
+        if rng.random() < 0.5:
+            value = cache.get(key)
+            assert value == reference.get(key)
+            if key in reference:
+                reference.move_to_end(key)
+        else:
+            cache.put(key, -key)
+            reference[key] = -key
+            reference.move_to_end(key)
+            if len(reference) > 10:
+                reference.popitem(last=False)
+        assert cache.items() == list(reference.items())
+
+
+def test_lfu_eviction():
+    rng = random.Random(0)
+    cache = Cache('test', maxsize=10, policy='lfu')
+    # key -> [frequency, time of the last frequency change]
+    reference = {}
+    for t in range(2000):
+        key = rng.randrange(30)
+        if rng.random() < 0.5:
+            value = cache.get(key)
+            assert value == (-key if key in reference else None)
+            if key in reference:
+                reference[key] = [reference[key][0] + 1, t]
+        elif key in reference:
+            cache.put(key, -key)
+            reference[key] = [reference[key][0] + 1, t]
+        else:
+            cache.put(key, -key)
+            if len(reference) == 10:
+                # Least frequent, the longest at that frequency first
+                del reference[min(reference, key=reference.get)]
+            reference[key] = [1, t]
+        assert [k for k, _ in cache.items()] == \
+            sorted(reference, key=reference.get)
+
+
+def test_maxbytes():
+    cache = Cache('test', maxbytes=1000)
+    for i in range(20):
+        cache.put(i, np.zeros(10 * (i % 5 + 1), dtype=np.float32))
+        values = [v for _, v in cache.items()]
+        assert cache.bytes == sum(approx_size(v) for v in values) <= 1000
+    # Replacing a value updates the byte count
+    key, _ = cache.items()[-1]
+    cache.put(key, np.zeros(2, dtype=np.float32))
+    assert cache.bytes == sum(approx_size(v) for _, v in cache.items())
+    # A value larger than the limit is kept alone
+    cache.put('big', np.zeros(1000, dtype=np.float32))
+    assert [k for k, _ in cache.items()] == ['big']
+
+
+def test_stats():
+    cache = Cache('test', maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.get('c')
+    cache.put('c', 3)
+    assert 'b' not in cache and len(cache) == 2
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 1, 1)
+    assert stats['hit_ratio'] == 0.5
+    cache.clear()
+    assert len(cache) == 0 and cache.stats()['bytes'] == 0
+
+
+def test_parse_limit():
+    assert parse_limit('100000') == (100000, None)
+    assert parse_limit('512MB') == (None, 512 * 1024 ** 2)
+    assert parse_limit(' 2 gb ') == (None, 2 * 1024 ** 3)
+    with pytest.raises(ValueError):
+        parse_limit('10 items')
@@ -0,0 +1,207 @@
+import random
+import pytest
+import jellyfish
+from edl import cluster
+from edl.models.text import EntityMention
+
+
+def make_texts(n, seed=0):
+    '''
+    Mention texts with spelling variants and translations.
+    '''
+    rng = random.Random(seed)
+    names = [''.join(rng.choice('abcdeklmnorstu')
+                     for _ in range(rng.randint(4, 14))) for _ in range(n // 4)]
+    res = []
+    for _ in range(n):
+        text = list(rng.choice(names))
+        for _ in range(rng.choice([0, 0, 1, 2])):
+            text[rng.randrange(len(text))] = rng.choice('aeioukmnrst')
+        translations = [rng.choice('fghij') * 4] if rng.random() < .2 else []
+        res.append((''.join(text).title(), translations))
+    return res
+
+
+def make_corpus(texts):
+    return {'DOC': [EntityMention(text, translations=list(translations))
+                    for text, translations in texts]}
+
+
+def nilids(corpus):
+    return [em.entity.kbid for em in corpus['DOC']]
+
+
+def test_cluster_state_batches(tmpdir):
+    texts = make_texts(400)
+    single = make_corpus(texts)
+    cluster.ClusterState('en').cluster(single)
+
+    path = str(tmpdir.join('state.json'))
+    batches = []
+    for i in range(0, len(texts), 150):
+        state = cluster.ClusterState.load(path, 'en')
+        batch = make_corpus(texts[i:i+150])
+        state.cluster(batch)
+        state.save(path)
+        batches += nilids(batch)
+    assert batches == nilids(single)
+
+    with pytest.raises(ValueError):
+        cluster.ClusterState.load(path, 'zh')
+
+
+def parallel_reference(texts):
+    '''
+    nil_clustering_parallel without indexes: each text is linked to the
+    closest earlier text, then to the texts sharing a translation.
+    '''
+    designators, stop_words, morph = cluster.load_resources(None)
+    keys = {}
+    for text, _ in texts:
+        lower = text.lower()
+        keys.setdefault(lower, cluster.trim_text(cluster.normalize_text(
+            lower, designators, stop_words, morph)))
+    uniq = list(dict.fromkeys(keys.values()))
+    uf = cluster.UnionFind(len(uniq))
+    for i, text in enumerate(uniq):
+        if len(text) <= 5:
+            continue
+        similar = [(jellyfish.levenshtein_distance(text, uniq[j]), j)
+                   for j in range(i)]
+        similar = [s for s in similar if s[0] <= len(text) // 8]
+        if similar:
+            uf.union(i, min(similar)[1])
+    position = {text: i for i, text in enumerate(uniq)}
+    translation_map = {}
+    for text, translations in texts:
+        i = position[keys[text.lower()]]
+        for translation in translations:
+            if translation in translation_map:
+                uf.union(i, translation_map[translation])
+            else:
+                translation_map[translation] = i
+    roots = {}
+    res = []
+    for text, _ in texts:
+        root = uf.find(position[keys[text.lower()]])
+        res.append(roots.setdefault(root, 'NIL{:07d}'.format(len(roots))))
+    return res
+
+
+def test_nil_clustering_parallel():
+    texts = make_texts(600)
+    reference = parallel_reference(texts)
+    for workers, chunk_size in [(1, 10000), (2, 37)]:
+        corpus = make_corpus(texts)
+        cluster.nil_clustering_parallel(corpus, 'en', workers=workers,
+                                        chunk_size=chunk_size)
+        assert nilids(corpus) == reference
+
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_nil_clustering_parallel_bound(seed):
+    texts = make_texts(600, seed=seed)
+    parallel = make_corpus(texts)
+    cluster.nil_clustering_parallel(parallel, 'en', workers=1)
+    parallel = nilids(parallel)
+    serial = make_corpus(texts)
+    cluster.nil_clustering(serial, 'en')
+    serial = nilids(serial)
+
+    # Merges are transitive, so there are fewer clusters, by at most 10%
+    assert len(set(parallel)) <= len(set(serial))
+    assert len(set(parallel)) >= 0.9 * len(set(serial))
+    # and nearly every serial cluster is inside one parallel cluster
+    clusters = {}
+    for i, j in zip(serial, parallel):
+        clusters.setdefault(i, set()).add(j)
+    split = [i for i in clusters.values() if len(i) > 1]
+    assert len(split) <= 0.02 * len(clusters)
+
+
+def naive_similar(texts):
+    '''
+    The Similar stage as an O(n^2) loop over the clusters found so far,
+    NIL ids of texts without translations.
+    '''
+    designators, stop_words, morph = cluster.load_resources(None)
+    lowers = list(dict.fromkeys(text.lower() for text, _ in texts))
+    normalized = list(dict.fromkeys(
+        cluster.normalize_text(i, designators, stop_words, morph)
+        for i in lowers))
+    trimmed = list(dict.fromkeys(cluster.trim_text(i) for i in normalized))
+    # Texts that started a cluster, the only ones compared with
+    new_clusters = {}
+    clusters = {}
+    for text in trimmed:
+        similar = []
+        if len(text) > 5:
+            for other, nilid in new_clusters.items():
+                distance = jellyfish.levenshtein_distance(text, other)
+                if distance < len(text) // 8 + 1:
+                    similar.append((nilid, distance))
+            similar = sorted(similar, key=lambda x: x[1])
+        if similar:
+            clusters[text] = similar[0][0]
+        else:
+            clusters[text] = 'NIL{:07d}'.format(len(new_clusters))
+            new_clusters[text] = clusters[text]
+    return [clusters[cluster.trim_text(cluster.normalize_text(
+        text.lower(), designators, stop_words, morph))]
+        for text, _ in texts]
+
+
+def test_nil_clustering_similar():
+    texts = [(text, []) for text, _ in make_texts(600)]
+    corpus = make_corpus(texts)
+    cluster.nil_clustering(corpus, 'en')
+    assert nilids(corpus) == naive_similar(texts)
+
+
+def naive_group(texts, groups):
+    '''
+    The Group stage as it was written before the group index, NIL ids of
+    texts that are each in a cluster of their own before it.
+    '''
+    uniq = list(dict.fromkeys(texts))
+    found = [group for group in groups
+             if any(mention in uniq for mention in group)]
+    clusters = {}
+    for group in found:
+        clusters[group[0]] = 'NIL{:07d}'.format(len(clusters))
+    res = {}
+    for text in uniq:
+        group_text = None
+        for group in groups:
+            if text in group:
+                group_text = group[0]
+                break
+        if group_text and group_text in clusters:
+            res[text] = clusters[group_text]
+        elif text in clusters:
+            res[text] = clusters[text]
+        else:
+            clusters[text] = 'NIL{:07d}'.format(len(clusters))
+            res[text] = clusters[text]
+    return [res[text] for text in texts]
+
+
+def test_nil_clustering_group():
+    rng = random.Random(1)
+    names = list(dict.fromkeys(''.join(rng.choice('bcdfgklmnprstvz')
+                                       for _ in range(8))
+                               for _ in range(200)))
+    texts = [rng.choice(names) for _ in range(400)]
+    # Some group mentions never appear, and mentions are in several groups
+    groups = [rng.sample(names + ['unseen%d' % i for i in range(20)],
+                         rng.randint(1, 5)) for _ in range(80)]
+    corpus = make_corpus([(text, []) for text in texts])
+    cluster.nil_clustering(corpus, 'en')
+    # Each text is its own cluster before the Group stage
+    assert len(set(nilids(corpus))) == len(set(texts))
+
+    corpus = make_corpus([(text, []) for text in texts])
+    cluster.nil_clustering(corpus, 'en', resources={'group': groups})
+    assert nilids(corpus) == naive_group(texts, groups)
+    assert len(set(nilids(corpus))) < len(set(texts))
@@ -0,0 +1,47 @@
+import os
+from configparser import ConfigParser
+import numpy as np
+from edl import util
+from edl import linker
+from edl.engine import Engine
+from edl.embedding import export_embedding, quantize_embedding
+from conftest import ROOT
+
+
+def write_config(path, entity):
+    config = ConfigParser()
+    config.read(os.path.join(ROOT, 'global.conf'))
+    config.set('embedding', 'entity', entity)
+    with open(path, 'w') as f:
+        config.write(f)
+
+
+def link(kb, config_path, bio):
+    with Engine(config_path, kb=kb):
+        ems = util.read_tac_bio_format(bio)
+        linker.link_entitymentions(ems)
+    return ems
+
+
+def test_normalized_embedding(kb, make_bio, tmpdir):
+    path = str(tmpdir.join('entity'))
+    export_embedding(kb.db_emb['entity_embeddings'], path)
+    quantize_embedding(path, path + '.float16', dtype='float16',
+                       normalize=True)
+    bio = make_bio()
+    res = {}
+    for name in ['entity', 'entity.float16']:
+        config_path = str(tmpdir.join('%s.conf' % name))
+        write_config(config_path, str(tmpdir.join(name)))
+        res[name] = link(kb, config_path, bio)
+
+    for em in res['entity.float16']:
+        for ce in em.candidates:
+            if ce.vector is not None:
+                assert ce.norm == 1.0
+    for em, other in zip(res['entity'], res['entity.float16']):
+        assert [ce.kbid for ce in em.candidates] == \
+            [ce.kbid for ce in other.candidates]
+        np.testing.assert_allclose(em.features['CONTEXT_SIMILARITY'],
+                                   other.features['CONTEXT_SIMILARITY'],
+                                   atol=1e-3)
@@ -0,0 +1,118 @@
+import os
+import random
+from configparser import ConfigParser
+import jellyfish
+import pytest
+from edl import util
+from edl import linker
+from edl import translator
+from edl.engine import Engine
+from edl.fuzzy import SymmetricDeleteIndex, build_index
+from conftest import ROOT, MENTIONS
+
+
+def typo(rng, text):
+    text = list(text)
+    for _ in range(rng.randint(0, 2)):
+        i = rng.randrange(len(text))
+        op = rng.choice(['sub', 'del', 'ins', 'swap'])
+        if op == 'sub':
+            text[i] = rng.choice('abcde 0123')
+        elif op == 'del' and len(text) > 1:
+            del text[i]
+        elif op == 'ins':
+            text.insert(i, rng.choice('abcde 0123'))
+        elif i + 1 < len(text):
+            text[i], text[i + 1] = text[i + 1], text[i]
+    return ''.join(text)
+
+
+def brute_force_search(keys, text, k, max_distance, min_length):
+    if len(text) < min_length:
+        return []
+    keys = [key for key in keys if len(key) >= min_length - max_distance]
+    res = []
+    for i, key in enumerate(keys):
+        d = jellyfish.damerau_levenshtein_distance(text, key)
+        if key != text and d <= max_distance:
+            res.append((d, i, key))
+    return [(d, key) for d, i, key in sorted(res)[:k]]
+
+
+@pytest.mark.parametrize('max_distance', [1, 2])
+def test_symmetric_delete_index(tmpdir, max_distance):
+    rng = random.Random(max_distance)
+    names = [''.join(rng.choice('abcde') for _ in range(rng.randint(2, 9)))
+             for _ in range(300)]
+    keys = list(dict.fromkeys(typo(rng, rng.choice(names))
+                              for _ in range(600)))
+    path = str(tmpdir.join('index'))
+    n = build_index(keys, path, max_distance=max_distance)
+    index = SymmetricDeleteIndex(path)
+    assert len(index) == n
+    for _ in range(300):
+        text = typo(rng, rng.choice(names))
+        assert index.search(text, 5) == \
+            brute_force_search(keys, text, 5, max_distance, 4)
+        assert index.search(text, 3, max_distance=0) == []
+
+
+def test_merge_fuzzy_entries():
+    entries = {'a': [('X', 0.6), ('Y', 0.4)], 'b': [('X', 1.0)]}
+    res = linker.merge_fuzzy_entries([(1, 'a'), (2, 'b')], entries, 10, 0.5)
+    # Weights 0.5 and 0.25, scaled by 0.5 ** 1 over their sum
+    assert [kbid for kbid, _ in res] == ['X', 'Y']
+    assert res[0][1] == pytest.approx((0.5 * 0.6 + 0.25) * 0.5 / 0.75)
+    assert res[1][1] == pytest.approx(0.5 * 0.4 * 0.5 / 0.75)
+
+
+@pytest.fixture
+def fuzzy_engine(kb, tmpdir):
+    path = str(tmpdir.join('mention_table'))
+    build_index(kb.iter_mentions(), path, max_distance=2)
+    config = ConfigParser()
+    config.read(os.path.join(ROOT, 'global.conf'))
+    config.set('fuzzy', 'index', path)
+    config_path = str(tmpdir.join('fuzzy.conf'))
+    with open(config_path, 'w') as f:
+        config.write(f)
+    with Engine(config_path, kb=kb) as engine:
+        yield engine
+
+
+def test_fuzzy_entries(fuzzy_engine):
+    rng = random.Random(0)
+    keys = list(fuzzy_engine.kb.iter_mentions())
+    texts = [typo(rng, rng.choice(MENTIONS)) for _ in range(100)]
+    res = linker.get_fuzzy_entries(texts, 10)
+    for text in texts:
+        matches = brute_force_search(keys, text, 5, 2, 4)
+        if not matches:
+            assert text not in res
+            continue
+        entries = fuzzy_engine.kb.find_mentions([key for _, key in matches],
+                                                10)
+        assert res[text] == linker.merge_fuzzy_entries(matches, entries, 10,
+                                                       0.5)
+
+
+def test_fuzzy_fallback_only_without_candidates(fuzzy_engine, make_bio,
+                                                monkeypatch):
+    searched = []
+    get_fuzzy_entries = linker.get_fuzzy_entries
+
+    def record(mentions, n):
+        searched.extend(mentions)
+        return get_fuzzy_entries(mentions, n)
+    monkeypatch.setattr(linker, 'get_fuzzy_entries', record)
+
+    ems = util.read_tac_bio_format(make_bio(30, lang='zh'))
+    translations = translator.get_translations([em.text for em in ems], 'zh')
+    for em in ems:
+        em.translations = translations[em.text]
+    linker.add_candidate_entities_batch(ems, lang='zh')
+    with_candidates = set(em.text.lower() for em in ems if em.translations
+                          and linker.get_candidate_entities_multi_mentions(
+                              tuple(em.translations), 10))
+    assert searched
+    assert not with_candidates & set(searched)
@@ -0,0 +1,97 @@
+from edl import util
+from edl import linker
+from edl import translator
+from edl import metrics
+from edl.engine import Engine
+from edl.models.text import EntityMention, CandidateEntity
+
+
+def results(entitymentions):
+    res = []
+    for em in entitymentions:
+        res.append((em.text, em.translations,
+                    [ce.kbid for ce in em.candidates],
+                    None if em.confidences is None
+                    else em.confidences.tolist(),
+                    {k: v.tolist() for k, v in em.features.items()},
+                    em.entity.kbid if em.entity else None))
+    return res
+
+
+def link_single(entitymentions, lang):
+    '''
+    Each mention on its own, through the single-mention functions.
+    '''
+    rankings = ['CONTEXT_SIMILARITY'] if lang == 'en' else []
+    for em in entitymentions:
+        if lang != 'en':
+            em.translations = translator.get_translation(em.text, lang)
+        linker.add_candidate_entities(em, lang=lang)
+        linker.rank_candidate_entities(em, etype=em.etype,
+                                       rankings=rankings)
+
+
+def test_batch_linking_matches_single(kb, make_bio):
+    for lang in ['en', 'zh']:
+        bio = make_bio(30, lang=lang)
+        with Engine(kb=kb):
+            single = util.read_tac_bio_format(bio)
+            link_single(single, lang)
+        with Engine(kb=kb):
+            batch = util.read_tac_bio_format(bio)
+            linker.link_entitymentions(batch, lang=lang, context='off')
+            # The single path reads what the batch path cached
+            cached = util.read_tac_bio_format(bio)
+            link_single(cached, lang)
+        assert any(em.candidates for em in batch)
+        assert results(batch) == results(single)
+        assert results(cached) == results(single)
+        assert util.get_tac_tab_format(batch, add_trans=True) == \
+            util.get_tac_tab_format(single, add_trans=True)
+
+
+def test_reuse_exact_matches_off(kb, make_bio):
+    docs = [(make_bio(30, 'D%d' % i, lang), lang)
+            for i, lang in enumerate(['en', 'zh', 'en', 'zh'])]
+    res = {}
+    for context in ['off', 'exact']:
+        res[context] = []
+        with Engine(kb=kb):
+            for bio, lang in docs:
+                ems = util.read_tac_bio_format(bio)
+                linker.link_entitymentions(ems, lang=lang, context=context)
+                res[context].append(results(ems))
+    assert res['exact'] == res['off']
+
+
+def test_reuse_ratio(kb, make_bio):
+    bio = make_bio(30, lang='zh')
+    with Engine(kb=kb):
+        with metrics.breakdown() as timing:
+            linker.link_entitymentions(util.read_tac_bio_format(bio),
+                                       lang='zh')
+        first = timing['reuse']
+        with metrics.breakdown() as timing:
+            linker.link_entitymentions(util.read_tac_bio_format(bio),
+                                       lang='zh')
+    assert 0 < metrics.reuse_ratio(first) < 1
+    assert metrics.reuse_ratio(timing['reuse']) == 1.0
+
+
+def test_fuzzy_not_timed_without_index(engine, make_bio):
+    assert engine.fuzzy_index is None
+    ems = util.read_tac_bio_format(make_bio())
+    with metrics.breakdown() as timing:
+        linker.link_entitymentions(ems)
+    assert 'candidates' in timing['stages']
+    assert 'fuzzy' not in timing['stages']
+
+
+def test_rank_zero_features(engine):
+    em = EntityMention('mention')
+    em.candidates = tuple(CandidateEntity('E%d' % i, 'PER', None, None,
+                                          0.0, 0.0) for i in range(4))
+    linker.rank_candidate_entities(em, etype='PER')
+    assert em.confidences.tolist() == [0.25] * 4
+    assert [ce.kbid for ce in em.candidates] == ['E0', 'E1', 'E2', 'E3']
+    assert em.entity.kbid == 'E0'
@@ -0,0 +1,126 @@
+import numpy as np
+from edl import util
+from edl import linker
+from edl import snapshot
+from edl.cache import Cache
+from edl.engine import Engine
+
+
+def assert_same(a, b):
+    assert type(a) == type(b) or (isinstance(a, tuple) and
+                                  isinstance(b, tuple))
+    if isinstance(a, np.ndarray):
+        assert a.dtype == b.dtype
+        np.testing.assert_array_equal(a, b)
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b)
+        for i, j in zip(a, b):
+            assert_same(i, j)
+    elif isinstance(a, dict):
+        assert list(a) == list(b)
+        for k in a:
+            assert_same(a[k], b[k])
+    else:
+        assert a == b
+
+
+def link(docs):
+    res = []
+    for bio, lang in docs:
+        ems = util.read_tac_bio_format(bio)
+        linker.link_entitymentions(ems, lang=lang)
+        res.append(util.get_tac_tab_format(ems, add_trans=True))
+    return res
+
+
+def test_snapshot_round_trip_with_reuse(kb, engine, make_bio, tmp_path):
+    docs = [(make_bio(20, 'D%d' % i, lang), lang)
+            for i, lang in enumerate(['en', 'zh', 'en'])]
+    expected = link(docs)
+    assert len(engine.cache('link_entitymentions'))
+
+    dumped = engine.dump_snapshot(str(tmp_path))
+    assert set(dumped) == set(engine.caches)
+    with Engine(kb=kb) as other:
+        loaded = other.load_snapshot(str(tmp_path))
+        assert loaded == dumped
+        assert_same_caches(engine.caches, other)
+        # Every mention is served from the reloaded results
+        assert link(docs) == expected
+        assert other.cache('link_entitymentions').stats()['misses'] == 0
+
+
+def assert_same_caches(caches, other):
+    for name, cache in caches.items():
+        items = list(cache.items())
+        assert [k for k, _ in other.cache(name).items()] == \
+            [k for k, _ in items]
+        for key, value in items:
+            assert_same(value, other.cache(name).get(key))
+
+
+def test_snapshot_round_trip(kb, engine, make_bio, tmp_path):
+    bio = make_bio(20)
+    ems = util.read_tac_bio_format(bio)
+    linker.link_entitymentions(ems, context='off')
+    expected = util.get_tac_tab_format(ems)
+    # Touch an early entry so that the LRU order differs from insertion
+    cache = engine.cache('get_candidate_entities')
+    first = next(iter(cache.items()))[0]
+    cache.get(first)
+
+    dumped = engine.dump_snapshot(str(tmp_path))
+    assert dumped['get_candidate_entities'] == len(cache)
+    with Engine(kb=kb) as other:
+        other.load_snapshot(str(tmp_path))
+        assert list(other.cache('get_candidate_entities').items())[-1][0] \
+            == first
+        assert_same_caches(engine.caches, other)
+        ems = util.read_tac_bio_format(bio)
+        linker.link_entitymentions(ems, context='off')
+        assert util.get_tac_tab_format(ems) == expected
+        for name, cache in other.caches.items():
+            assert cache.stats()['misses'] == 0, name
+
+
+def test_snapshot_matrix_mismatch(kb, engine, make_bio, tmp_path):
+    linker.link_entitymentions(util.read_tac_bio_format(make_bio(5)),
+                               context='off')
+    engine.dump_snapshot(str(tmp_path))
+    path = str(tmp_path / 'get_candidate_entities')
+    first = open(path + '.jsonl').read()
+    linker.link_entitymentions(util.read_tac_bio_format(make_bio(5)),
+                               context='off')
+    engine.dump_snapshot(str(tmp_path))
+    # One matrix per cache, the one of the last dump
+    names = [i.name for i in tmp_path.iterdir()
+             if i.name.startswith('get_candidate_entities.')]
+    assert len(names) == 2
+
+    # The index of the first dump with the matrix of the second
+    with open(path + '.jsonl', 'w') as f:
+        f.write(first)
+    with Engine(kb=kb) as other:
+        loaded = other.load_snapshot(str(tmp_path))
+        assert loaded['get_candidate_entities'] == 0
+        assert loaded['get_etype'] > 0
+
+
+def test_snapshot_lfu(tmp_path):
+    cache = Cache('test', maxsize=4, policy='lfu')
+    for i in range(4):
+        cache.put(('k%d' % i,), np.full(3, i, dtype=np.float32))
+    for i, n in [(0, 3), (1, 1), (3, 2)]:
+        for _ in range(n):
+            cache.get(('k%d' % i,))
+    path = str(tmp_path / 'test')
+    snapshot.dump_cache(cache, path)
+    other = Cache('test', maxsize=4, policy='lfu')
+    assert snapshot.load_cache(other, path) == 4
+    assert [(k, f) for k, _, f in other.items(frequencies=True)] == \
+        [(k, f) for k, _, f in cache.items(frequencies=True)]
+    # k2 was never read and goes first, as in the original cache
+    for c in [cache, other]:
+        c.put(('k4',), np.zeros(3, dtype=np.float32))
+    assert ('k2',) not in other
+    assert [k for k, _ in other.items()] == [k for k, _ in cache.items()]
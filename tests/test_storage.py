@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from edl import storage
+from conftest import KBIDS, MENTIONS
+
+
+@pytest.fixture(scope='module')
+def sqlite_kb(kb, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('kb') / 'kb.sqlite')
+    storage.build_sqlite_kb(kb, path)
+    return storage.SQLiteKB(path)
+
+
+def test_mentions(kb, sqlite_kb):
+    mentions = MENTIONS + ['unknown', 'mention 100']
+    for n in [1, 5, 10]:
+        assert sqlite_kb.find_mentions(mentions, n) == \
+            kb.find_mentions(mentions, n)
+        for mention in mentions:
+            assert sqlite_kb.find_mention(mention, n) == \
+                kb.find_mention(mention, n)
+    assert sorted(sqlite_kb.iter_mentions()) == sorted(kb.iter_mentions())
+
+
+def test_etypes(kb, sqlite_kb):
+    kbids = KBIDS + ['unknown']
+    assert sqlite_kb.find_etypes(kbids) == kb.find_etypes(kbids)
+    for kbid in kbids:
+        assert sqlite_kb.find_etype(kbid) == kb.find_etype(kbid)
+
+
+def test_translations(kb, sqlite_kb):
+    lemmas = ['z%d' % i for i in range(70)]
+    assert sqlite_kb.languages() == kb.languages()
+    for lemma in lemmas:
+        assert sqlite_kb.find_translations(lemma, 'zh') == \
+            kb.find_translations(lemma, 'zh')
+    assert sqlite_kb.find_glosses(lemmas, 'zh') == \
+        kb.find_glosses(lemmas, 'zh')
+    assert dict(sqlite_kb.iter_glosses('zh')) == \
+        dict(kb.iter_glosses('zh'))
+
+
+def test_vectors(kb, sqlite_kb):
+    items = ['en.wikipedia.org/wiki/%s' % kbid for kbid in KBIDS]
+    res = sqlite_kb.find_vectors('entity_embeddings', items)
+    expected = kb.find_vectors('entity_embeddings', items)
+    assert sorted(res) == sorted(expected)
+    for item in expected:
+        np.testing.assert_array_equal(res[item], expected[item])
+        np.testing.assert_array_equal(
+            sqlite_kb.find_vector('entity_embeddings', item),
+            kb.find_vector('entity_embeddings', item))
+    for item in ['W', 'b']:
+        np.testing.assert_array_equal(sqlite_kb.get_misc(item),
+                                      kb.get_misc(item))
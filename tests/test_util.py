@@ -0,0 +1,64 @@
+import io
+import random
+from edl import util
+from edl.models.text import EntityMention
+
+
+BIO = '''Barack B-PER
+Obama I-PER
+visited O
+Beijing B-GPE
+
+He O
+met O
+Xi B-PER
+Jinping I-PER'''
+
+
+def bio_lines(text, docid='DOC'):
+    lines = []
+    offset = 0
+    for line in text.split('\n'):
+        if not line:
+            lines.append('')
+            continue
+        token, tag = line.split(' ')
+        lines.append('%s %s:%d-%d %s' % (token, docid, offset,
+                                         offset + len(token) - 1, tag))
+        offset += len(token) + 1
+    return '\n'.join(lines)
+
+
+def mentions(entitymentions):
+    return [(em.text, em.beg, em.end, em.etype) for em in entitymentions]
+
+
+def test_read_bio_keeps_last_mention():
+    bio = bio_lines(BIO)
+    expected = [('Barack Obama', 0, 11, 'PER'), ('Beijing', 21, 27, 'GPE'),
+                ('Xi Jinping', 36, 45, 'PER')]
+    # With or without trailing newlines, as a string or as lines
+    for data in [bio, bio + '\n', bio + '\n\n', bio + '\r\n',
+                 io.StringIO(bio + '\n'), (bio + '\n').splitlines(True)]:
+        assert mentions(util.read_tac_bio_format(data)) == expected
+    batch = util.read_tac_bio_batch(bio + '\n')
+    assert mentions(batch.entitymentions()) == expected
+
+
+def test_offset_index_covers():
+    rng = random.Random(0)
+    # Nested and overlapping mentions, offsets are unique in a document
+    offsets = set()
+    for _ in range(200):
+        beg = rng.randint(0, 500)
+        offsets.add((beg, beg + rng.choice([0, 1, 3, 10, 40])))
+    ems = [EntityMention('x', beg=beg, end=end)
+           for beg, end in sorted(offsets, key=lambda x: rng.random())]
+    index = util.OffsetIndex(ems)
+    for char in range(-5, 560):
+        assert index.covers(char) == \
+            any(em.beg <= char <= em.end for em in ems), char
+    for em in ems:
+        assert index.get(em.beg, em.end).beg == em.beg
+    assert index.get(-1, -1) is None
+    assert not util.OffsetIndex([]).covers(0)